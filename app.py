@@ -28,17 +28,33 @@ st.markdown("""
 
 import datetime
 from pathlib import Path
-import tempfile
 
 import os
-import torch
-import whisper
+import queue
+import secrets
+import uuid
+from functools import partial
 import streamlit as st
+from dotenv import load_dotenv
 from pydub import AudioSegment
 
+from jobs import TranscriptionQueue, QUEUED, RUNNING, DONE, FAILED
+from transcription import decode_audio, transcribe_chunked
+from transcript_cache import TranscriptCache, hash_audio
+from audio import Transcoder
+from audio_server import AudioServer, content_type
+from blobs import BLOBS_DIR_NAME, BlobStore
+from waveform import compute_peaks, pcm_peaks, read_duration, read_peaks, waveform_svg, write_peaks
+from features import load_mel, load_pcm, session_mel, session_pcm, to_float
+from batching import BatchScheduler, log_mel, transcribe_batched
+from inference import InferenceSlots, available_cpus, plan_slots
+from profiles import FIELDS, default_profile, read_profile, resolve, transcribe_options, write_profile
+from live import LiveSession, whisper_words
+from segments import find_offset, read_segments, segments_from_words, write_segments
+import models
+from storage import PatientStore, audio_file, load_manifest, read_metadata, read_transcript, session_entry, update_manifest
+from search import NameIndex, SessionIndex, normalize_name
 
-# Fix for torch
-torch.classes.__path__ = [] # add this line to manually set it to empty
 
 # Custom styling
 st.markdown("""
@@ -161,12 +177,62 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
+# Deployment settings, read from the environment or a .env file
+load_dotenv()
+# Whisper models offered in the model selectbox
+SERVED_MODELS = os.getenv("TERAPIA_MODELS", "tiny,base,small,tiny-int8,base-int8,small-int8").split(",")
+# Memory that loaded models may use together
+MODEL_BUDGET_MB = int(os.getenv("TERAPIA_MODEL_BUDGET_MB", "3072"))
+# Models loaded and warmed up when the server starts
+PRELOAD_MODELS = [name for name in os.getenv("TERAPIA_PRELOAD_MODELS", "base").split(",") if name]
+# Sessions transcoded to Opus at the same time once transcribed
+TRANSCODE_WORKERS = int(os.getenv("TERAPIA_TRANSCODE_WORKERS", "2"))
+# Store the time of every word besides segment times, at some extra decoding cost
+WORD_TIMESTAMPS = os.getenv("TERAPIA_WORD_TIMESTAMPS", "0") == "1"
+# Default decode profile, which patients may override: the language (empty
+# to detect it), beam size (0 for greedy), whether failed windows are decoded
+# again at higher temperatures, and a prompt with the expected vocabulary
+DEFAULT_PROFILE = default_profile(
+    language=os.getenv("TERAPIA_LANGUAGE", "es"),
+    beam_size=int(os.getenv("TERAPIA_BEAM_SIZE", "0")),
+    fallback=os.getenv("TERAPIA_FALLBACK", "0") == "1",
+    initial_prompt=os.getenv("TERAPIA_INITIAL_PROMPT", ""),
+)
+# Model calls run at the same time and torch threads for each, by default
+# slots of a few threads covering the cores; pinning keeps each slot on its cores
+INFERENCE_SLOTS = int(os.getenv("TERAPIA_INFERENCE_SLOTS", "0")) or None
+THREADS_PER_SLOT = int(os.getenv("TERAPIA_THREADS_PER_SLOT", "0")) or None
+PIN_CPUS = os.getenv("TERAPIA_PIN_CPUS", "0") == "1"
+# Windows of concurrent transcriptions decoded together, and how long the
+# first window of a batch waits for others
+BATCH_SIZE = int(os.getenv("TERAPIA_BATCH_SIZE", "8"))
+BATCH_WAIT_MS = int(os.getenv("TERAPIA_BATCH_WAIT_MS", "50"))
+# Share of the model budget the worker processes of chunked transcription may
+# take for their copies of the model, so a long session leaves room for others
+CHUNKED_BUDGET_SHARE = float(os.getenv("TERAPIA_CHUNKED_BUDGET_SHARE", "0.5"))
+# Transcription jobs run at the same time, feeding their windows to the batches
+TRANSCRIPTION_JOBS = int(os.getenv("TERAPIA_TRANSCRIPTION_JOBS", "4"))
+# Space for the decoded samples kept next to sessions so other models skip
+# decoding them again, about 115 MB per hour of audio; 0 turns the cache off
+FEATURE_CACHE_BYTES = int(float(os.getenv("TERAPIA_FEATURE_CACHE_GB", "10")) * 1024 ** 3)
+# Session audio is streamed from its own port when a base URL says how browsers
+# reach it, e.g. through the same reverse proxy as the app. Without one, as on
+# hosts that only expose the app's port, the player gets the file from Streamlit
+AUDIO_PORT = int(os.getenv("TERAPIA_AUDIO_PORT", "8502"))
+AUDIO_BASE_URL = os.getenv("TERAPIA_AUDIO_BASE_URL")
+# Signs the audio URLs; a random one makes them invalid after a restart
+AUDIO_SECRET = os.getenv("TERAPIA_AUDIO_SECRET") or secrets.token_hex(32)
+
 # Initialize data directories
 DATA_DIR = Path("data")
 PATIENTS_FILE = DATA_DIR / "patients.txt"
+PATIENTS_DB = DATA_DIR / "patients.db"
+SEARCH_DB = DATA_DIR / "search.db"
 SESSIONS_DIR = DATA_DIR / "sessions"
+BLOBS_DIR = DATA_DIR / BLOBS_DIR_NAME
 AUDIO_DIR = DATA_DIR / "audio"
 TRANSCRIPT_DIR = DATA_DIR / "transcripts"
+CACHE_DIR = DATA_DIR / "cache"
 
 # Create necessary directories
 DATA_DIR.mkdir(exist_ok=True)
@@ -174,10 +240,15 @@ SESSIONS_DIR.mkdir(exist_ok=True)
 AUDIO_DIR.mkdir(exist_ok=True)
 TRANSCRIPT_DIR.mkdir(exist_ok=True)
 
-UPLOAD_DIR = "uploads"
+# Session history rows shown per page
+SESSIONS_PER_PAGE = 10
+
+# Languages offered in the decode profile editor, empty to detect it
+PROFILE_LANGUAGES = {"": "Detectar automáticamente", "es": "Español", "en": "Inglés", "ca": "Catalán", "pt": "Portugués", "fr": "Francés"}
+PROFILE_BEAM_SIZES = [0, 3, 5]
+
 TRANSCRIPT_DIR = "transcripts"
 
-os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(TRANSCRIPT_DIR, exist_ok=True)
 
 # Initialize session state variables
@@ -188,74 +259,264 @@ if 'user_type' not in st.session_state:
 if 'current_transcript' not in st.session_state:
     st.session_state.current_transcript = ""
 
-if 'current_audio' not in st.session_state:
-    st.session_state.current_audio = None
-
 # Initialize audio-related session state variables
-if 'audio_recording' not in st.session_state:
-    st.session_state.audio_recording = None
 if 'file_uploader' not in st.session_state:
     st.session_state.file_uploader = None
-if 'audio_file_path' not in st.session_state:
-    st.session_state.audio_file_path = None
-if 'uploaded_file' not in st.session_state:
-    st.session_state.uploaded_file = None
+# Path, hash and name of the last upload or recording, staged on disk
+if 'staged_audio' not in st.session_state:
+    st.session_state.staged_audio = None
+# Recording being transcribed live, and the transcript of the last one
+if 'live_session' not in st.session_state:
+    st.session_state.live_session = None
+if 'live_transcript' not in st.session_state:
+    st.session_state.live_transcript = None
+if 'current_job' not in st.session_state:
+    st.session_state.current_job = None
+
+@st.cache_resource
+def get_model_manager():
+    """Whisper models shared by all sessions, within the deployment's memory budget."""
+    return models.ModelManager(MODEL_BUDGET_MB * 1024 * 1024, SERVED_MODELS)
 
 @st.cache_resource
-def load_model(model_name: str):
-    """Load the selected Whisper model."""
-    return whisper.load_model(model_name)
+def get_inference_slots():
+    """Threads that run every model call of the server, each with its share of the cores."""
+    slots, threads = plan_slots(len(available_cpus()), INFERENCE_SLOTS, THREADS_PER_SLOT)
+    return InferenceSlots(slots, threads, PIN_CPUS)
 
-# Modified audio transcription function that can handle both file paths and audio data
-def transcribe_audio(audio_input, model_name: str):
+@st.cache_resource
+def start_preloading():
+    """Load and warm up the default models in the background, once per server process."""
+    return models.Preloader(get_model_manager(), PRELOAD_MODELS, get_inference_slots())
+
+@st.cache_resource
+def get_transcript_cache():
+    """Cache of transcription results keyed by audio content, model and options."""
+    return TranscriptCache(CACHE_DIR / "transcripts")
+
+@st.cache_resource
+def get_batch_scheduler():
+    """Decodes the windows of all running transcriptions together, once per server process."""
+    return BatchScheduler(get_model_manager(), BATCH_SIZE, BATCH_WAIT_MS / 1000, slots=get_inference_slots())
+
+def batch_features(audio_path: str, model_name: str, session_dir=None):
+    """Samples and log-mel frames for batched decoding, from the session's cache when it has one."""
+    n_mels = models.n_mels(model_name)
+    if session_dir and FEATURE_CACHE_BYTES > 0:
+        pcm = load_pcm(session_dir)
+        session_mel(session_dir, n_mels, FEATURE_CACHE_BYTES)
+        return pcm, load_mel(session_dir, n_mels)
+    audio = decode_audio(audio_path)
+    return audio, log_mel(audio, n_mels)
+
+def transcribe_file(audio_path: str, model_name: str, chunked=False, session_dir=None):
     """
-    Transcribe audio using Whisper.
-    
-    Args:
-        audio_input: Either a file path (str) or audio data (bytes or numpy array)
-        model_name: Name of the Whisper model to use
+    Transcribe an audio file into Whisper's result dict, raising on failure (used by background jobs).
+    The audio of a session is decoded once and read from its cached samples afterwards.
     """
-    model = load_model(model_name)
-    
-    # If audio_input is already a string (file path), use it directly
-    if isinstance(audio_input, str):
-        if os.path.exists(audio_input):
-            try:
-                result = model.transcribe(audio_input)
-                return result["text"]
-            except Exception as e:
-                st.error(f"Error transcribing file path: {e}")
-                return "Transcription failed. Please check FFmpeg installation and audio format."
-    
-    # If audio_input is not a string, it's likely a file-like object or bytes
-    # Create a temporary file to save the audio
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as temp_file:
-        temp_path = temp_file.name
-    
-    try:
-        # If it's a file-like object with getbuffer method
-        if hasattr(audio_input, 'getbuffer'):
-            with open(temp_path, 'wb') as f:
-                f.write(audio_input.getbuffer())
-        # If it's bytes directly
-        elif isinstance(audio_input, bytes):
-            with open(temp_path, 'wb') as f:
-                f.write(audio_input)
+    if session_dir and read_duration(session_dir) is None:
+        write_session_waveform(session_dir)
+    cache = get_transcript_cache()
+    # Blobs are named by the hash of their content, which is not read again
+    audio_hash = Path(audio_path).name if Path(audio_path).parent.parent == BLOBS_DIR else hash_audio(audio_path)
+    # The patient's decode profile, part of the cache key
+    profile = resolve(DEFAULT_PROFILE, session_dir.parent if session_dir else None)
+    options = {"chunked": chunked, "profile": profile}
+    decode_options = transcribe_options(profile)
+    if WORD_TIMESTAMPS:
+        options["word_timestamps"] = decode_options["word_timestamps"] = True
+    # Word timestamps are aligned by model.transcribe itself, they are not batched
+    batched = not chunked and not WORD_TIMESTAMPS and BATCH_SIZE > 1
+    if batched:
+        options["batched"] = True
+
+    result = cache.get(audio_hash, model_name, options)
+    if result is None:
+        if session_dir and FEATURE_CACHE_BYTES > 0:
+            audio_path = str(session_pcm(session_dir, FEATURE_CACHE_BYTES))
+        if chunked:
+            # Long recordings are split at pauses and decoded by a process pool
+            # whose workers hold their own copy of the model, within their share
+            # of the budget, reserved while the pool of that model runs
+            manager = get_model_manager()
+            manager.check_allowed(model_name)
+            share = int(manager.budget_bytes * CHUNKED_BUDGET_SHARE)
+            slots = get_inference_slots()
+            # The workers run on the inference slots, at most one per slot
+            workers = max(1, min(slots.slots, share // models.estimate_bytes(model_name)))
+            result = transcribe_chunked(audio_path, model_name, workers, manager, slots, **decode_options)
+        elif batched:
+            get_model_manager().check_allowed(model_name)
+            audio, mel = batch_features(audio_path, model_name, session_dir)
+            result = transcribe_batched(
+                get_batch_scheduler(), model_name, audio, mel, profile["language"] or None,
+                profile["initial_prompt"] or None, profile["beam_size"], profile["fallback"],
+            )
         else:
-            st.error(f"Unsupported audio input type: {type(audio_input)}")
-            os.unlink(temp_path)
-            return "Transcription failed. Unsupported audio input type."
-            
-        # Now transcribe the temporary file
-        result = model.transcribe(temp_path)
-        return result["text"]
-    except Exception as e:
-        st.error(f"Error in transcription: {e}")
-        return f"Transcription failed: {str(e)}"
-    finally:
-        # Clean up the temporary file
-        if os.path.exists(temp_path):
-            os.unlink(temp_path)
+            # Decoded straight from ffmpeg's output, never through a temporary file
+            audio = to_float(load_pcm(session_dir)) if audio_path.endswith(".npy") else decode_audio(audio_path)
+            result = get_inference_slots().run_model(
+                get_model_manager(), model_name, lambda model: model.transcribe(audio, **decode_options),
+            )
+        cache.put(audio_hash, model_name, options, result)
+    return result
+
+@st.cache_resource
+def get_blob_store():
+    """Content-addressed store holding the audio of every session once."""
+    return BlobStore(BLOBS_DIR)
+
+@st.cache_resource
+def get_transcoder():
+    """Background transcoding of session audio to Opus, once per server process."""
+    return Transcoder(get_blob_store(), TRANSCODE_WORKERS)
+
+def update_session_history(session_dir, transcript):
+    """Refresh the manifest entry and search index of a session once its transcript is written."""
+    metadata = read_metadata(session_dir)
+    update_manifest(session_dir.parent, session_entry(session_dir, metadata, transcript))
+    get_session_index().update(session_dir.parent.name, session_dir.name, metadata["date"], metadata["notes"], transcript)
+    # Whisper is done with the original audio, store it compactly
+    get_transcoder().submit(session_dir)
+
+@st.cache_resource
+def get_transcription_queue():
+    """Start the background transcription workers once per server process."""
+    return TranscriptionQueue(SESSIONS_DIR, transcribe_file, TRANSCRIPTION_JOBS, on_done=update_session_history)
+
+def stage_audio(uploaded_file):
+    """
+    Stream an upload or recording to the blob store's staging directory once,
+    and return its path, hash and name, kept in session state instead of the file.
+    """
+    staged = st.session_state.staged_audio
+    # Saving a session moves the staged file into the store, where its blob may
+    # have been released since, e.g. once transcoded, so then it is staged again
+    if staged is None or staged["file_id"] != uploaded_file.file_id or not (
+        Path(staged["path"]).exists() or get_blob_store().path(staged["hash"]).exists()
+    ):
+        uploaded_file.seek(0)
+        path, audio_hash = get_blob_store().stage(uploaded_file)
+        staged = {"file_id": uploaded_file.file_id, "path": str(path), "hash": audio_hash, "name": uploaded_file.name}
+        st.session_state.staged_audio = staged
+    return staged
+
+def queue_transcription(patient_id, session_notes, audio, model_name, chunked=False, refresh=False):
+    """Save the session with its staged audio and queue the transcription in the background."""
+    if refresh:
+        # Forget previous results for this recording so Whisper runs again
+        get_transcript_cache().invalidate(audio["hash"])
+
+    session_data = {
+        "date": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "notes": session_notes
+    }
+    session_id = save_session(patient_id, session_data, "", audio)
+    session_dir = SESSIONS_DIR / patient_id / session_id
+    get_transcription_queue().submit(session_dir, model_name, chunked)
+    st.session_state.current_job = str(session_dir)
+
+def transcribe_window(model_name, profile, audio, prompt):
+    """Word-timestamped transcription of one window of a live recording."""
+    # Live windows are decoded once at temperature 0, only language and beams apply
+    options = {key: value for key, value in transcribe_options(profile).items() if key in ("language", "beam_size")}
+    return get_inference_slots().run_model(
+        get_model_manager(), model_name, whisper_words, audio, prompt or profile["initial_prompt"], **options,
+    )
+
+def live_transcription(patient_id, session_notes, model_name):
+    """
+    Record from the microphone over WebRTC, showing the transcript as it is
+    spoken, and save the session with it when the recording stops.
+    """
+    try:
+        import av
+        from streamlit_webrtc import WebRtcMode, webrtc_streamer
+    except ImportError:
+        st.warning("La transcripción en vivo requiere el paquete streamlit-webrtc")
+        return
+
+    ctx = webrtc_streamer(
+        key="live_recording",
+        mode=WebRtcMode.SENDONLY,
+        audio_receiver_size=1024,
+        media_stream_constraints={"video": False, "audio": True},
+    )
+    live = st.session_state.live_session
+
+    if ctx.state.playing and ctx.audio_receiver:
+        if live is None:
+            # Written to disk as it arrives, the recording is never held in memory
+            wav_path = get_blob_store().staging_dir / f"live-{uuid.uuid4().hex}.wav"
+            st.session_state.live_transcript = None
+            live = st.session_state.live_session = LiveSession(wav_path, partial(transcribe_window, model_name, resolve(DEFAULT_PROFILE, SESSIONS_DIR / patient_id)))
+        resampler = av.AudioResampler(format="s16", layout="mono", rate=models.SAMPLE_RATE)
+        placeholder = st.empty()
+        # Runs until the stop button reruns the script
+        while ctx.state.playing:
+            try:
+                frames = ctx.audio_receiver.get_frames(timeout=1)
+            except queue.Empty:
+                continue
+            for frame in frames:
+                for resampled in resampler.resample(frame):
+                    live.feed(resampled.to_ndarray().reshape(-1))
+            committed, tentative = live.transcriber.text()
+            placeholder.markdown(f"🔴 {format_duration(live.seconds)}\n\n{committed} *{tentative}*")
+
+    elif live is not None:
+        st.session_state.live_session = None
+        with st.spinner("Terminando la transcripción..."):
+            transcript = live.finish()
+        with open(live.wav_path, "rb") as f:
+            path, audio_hash = get_blob_store().stage(f)
+        live.wav_path.unlink()
+
+        session_data = {
+            "date": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "notes": session_notes
+        }
+        staged = {"path": str(path), "hash": audio_hash, "name": "live.wav"}
+        with st.spinner("Guardando la sesión..."):
+            session_id = save_session(patient_id, session_data, transcript, staged)
+            session_dir = SESSIONS_DIR / patient_id / session_id
+            write_segments(session_dir, segments_from_words(live.transcriber.committed))
+            write_session_waveform(session_dir)
+        get_transcoder().submit(session_dir)
+        st.session_state.live_transcript = transcript
+
+    if st.session_state.live_transcript is not None and not ctx.state.playing:
+        st.text_area("Transcripción", st.session_state.live_transcript, height=300)
+        st.success("¡Sesión guardada con su transcripción!")
+
+@st.fragment(run_every=2)
+def poll_transcription_job(session_dir):
+    """Refresh the job state every few seconds until it finishes."""
+    job = get_transcription_queue().status(session_dir)
+    if job is None or job["status"] in (DONE, FAILED):
+        # Rerun the whole page to show the result
+        st.rerun()
+    elif job["status"] == QUEUED:
+        st.info("⏳ Transcripción en cola...")
+    else:
+        st.info(f"🎙️ Transcribiendo con el modelo {job['model']}...")
+
+def show_transcription_job(session_dir):
+    job = get_transcription_queue().status(session_dir)
+    if job is None:
+        return
+
+    if job["status"] in (QUEUED, RUNNING):
+        poll_transcription_job(session_dir)
+    elif job["status"] == DONE:
+        transcript_file = Path(session_dir) / "transcript.txt"
+        with open(transcript_file, "r", encoding="utf-8", errors="replace") as f:
+            transcript_text = f.read()
+        st.text_area("Transcripción", transcript_text, height=300)
+        st.download_button("Descargar Transcripción", transcript_text, file_name=Path(session_dir).name + ".txt", mime="text/plain")
+        st.success("¡Transcripción completada y guardada en la sesión!")
+    else:
+        st.error(f"Error en la transcripción: {job.get('error', 'desconocido')}")
 
 @st.cache_data
 def convert_to_mp3(input_path: str, output_path: str):
@@ -264,53 +525,63 @@ def convert_to_mp3(input_path: str, output_path: str):
     audio.export(output_path, format="mp3")
     return output_path
 
+@st.cache_resource
+def get_audio_server():
+    """
+    Start the range-request audio server once per server process, or None when
+    browsers have no public URL to reach it or its port is taken.
+    """
+    if not AUDIO_BASE_URL:
+        return None
+    try:
+        return AudioServer(SESSIONS_DIR, AUDIO_SECRET, port=AUDIO_PORT, base_url=AUDIO_BASE_URL)
+    except OSError:
+        return None
+
+@st.cache_resource
+def get_patient_store():
+    """Indexed patient database, migrated from patients.txt on first use."""
+    return PatientStore(PATIENTS_DB, legacy_file=PATIENTS_FILE)
+
+@st.cache_resource
+def get_session_index():
+    """Full-text index of session notes and transcripts, built from the archive on first use."""
+    index = SessionIndex(SEARCH_DB)
+    if index.is_empty():
+        sessions = []
+        for session_dir in sorted(SESSIONS_DIR.glob("*/*")):
+            if session_dir.is_dir():
+                metadata = read_metadata(session_dir)
+                sessions.append((session_dir.parent.name, session_dir.name, metadata["date"], metadata["notes"], read_transcript(session_dir)))
+        index.rebuild(sessions)
+    return index
+
+@st.cache_resource
+def get_name_index():
+    """In-memory index for prefix and typo-tolerant patient name search."""
+    return NameIndex(get_all_patients())
+
+def find_patients(query):
+    """Patients whose name best matches a partial or misspelled query, best first."""
+    return get_name_index().search(query)
+
 def get_next_patient_id():
     """Generate the next available patient ID as a number."""
-    patients = get_all_patients()
-    if not patients:
-        return 1
-    # Get the highest ID and add 1
-    max_id = max(int(p[0]) for p in patients)
-    return max_id + 1
+    return get_patient_store().next_id()
 
 def save_patient(patient_name):
     """Save a new patient with an automatically generated ID."""
-    # Create patients file if it doesn't exist
-    if not PATIENTS_FILE.exists():
-        PATIENTS_FILE.write_text("")
-    
-    # Generate new patient ID
-    patient_id = get_next_patient_id()
-    
-    # Append new patient
-    with open(PATIENTS_FILE, "a") as f:
-        f.write(f"{patient_id}|{patient_name}\n")
+    patient_id = get_patient_store().add(patient_name)
+    get_name_index().add(patient_id, patient_name)
     return True
 
 def get_patient(patient_name):
-    if not PATIENTS_FILE.exists():
-        return None
-    
-    with open(PATIENTS_FILE, "r") as f:
-        for line in f:
-            pid, name = line.strip().split("|")
-            if name == patient_name:
-                return (pid, name)
-    return None
+    return get_patient_store().get_by_name(patient_name)
 
 def get_all_patients():
-    if not PATIENTS_FILE.exists():
-        return []
-    
-    patients = []
-    with open(PATIENTS_FILE, "r") as f:
-        for line in f:
-            if line.strip():
-                pid, name = line.strip().split("|")
-                patients.append((pid, name))
-    return patients
-
-def save_session(patient_id, session_data, transcript, audio_path=None):
+    return get_patient_store().all()
+
+def save_session(patient_id, session_data, transcript, staged_audio=None):
     patient_dir = SESSIONS_DIR / patient_id
     patient_dir.mkdir(exist_ok=True)
     
@@ -318,87 +589,212 @@ def save_session(patient_id, session_data, transcript, audio_path=None):
     session_dir = patient_dir / session_id
     session_dir.mkdir(exist_ok=True)
     
+    # The audio is stored once in the blob store, however many sessions save it
+    audio_name = blob_hash = None
+    if staged_audio:
+        audio_name = "audio" + (Path(staged_audio["name"]).suffix.lower() or ".wav")
+        blob_hash = get_blob_store().add_staged(staged_audio["path"], staged_audio["hash"])
+
     # Save session metadata
     metadata_file = session_dir / "metadata.txt"
     with open(metadata_file, "w") as f:
         f.write(f"Date: {session_data['date']}\n")
         f.write(f"Notes: {session_data['notes']}\n")
-        if audio_path:
-            # Save audio file as audio.mp3 in the session directory
-            audio_file = session_dir / "audio.mp3"
-            with open(audio_file, "wb") as f_audio:
-                f_audio.write(audio_path.getbuffer())
-            # Store the relative path to the audio file
-            f.write(f"Audio: audio.mp3\n")
+        if staged_audio:
+            f.write(f"Audio: {audio_name}\n")
+            f.write(f"Audio-Blob: {blob_hash}\n")
     
     # Save transcript
     transcript_file = session_dir / "transcript.txt"
     with open(transcript_file, "w") as f:
         f.write(transcript)
     
+    # Add the session to the patient's history manifest
+    metadata = {"date": session_data["date"], "notes": session_data["notes"], "audio": audio_name, "audio_blob": blob_hash}
+    update_manifest(patient_dir, session_entry(session_dir, metadata, transcript))
+    get_session_index().update(patient_id, session_id, session_data["date"], session_data["notes"], transcript)
+    
     return session_id
 
+def write_session_waveform(session_dir):
+    """
+    Write the duration and waveform peaks shown in the history, decoding the
+    audio once and keeping its samples for the transcription, and refresh the
+    session's manifest entry with them. Run by the transcription job, since an
+    hour of audio takes seconds to decode.
+    """
+    metadata = read_metadata(session_dir)
+    try:
+        if FEATURE_CACHE_BYTES > 0:
+            session_pcm(session_dir, FEATURE_CACHE_BYTES)
+            write_peaks(session_dir, *pcm_peaks(load_pcm(session_dir), models.SAMPLE_RATE))
+        else:
+            write_peaks(session_dir, *compute_peaks(audio_file(session_dir, metadata)))
+    except RuntimeError:
+        return
+    update_manifest(session_dir.parent, session_entry(session_dir, metadata))
+
 def load_patient_sessions(patient_id):
-    patient_session_dir = SESSIONS_DIR / patient_id
-    if not patient_session_dir.exists():
-        return []
-
-    sessions = []
-    for session_dir in patient_session_dir.glob("*"):
-        if session_dir.is_dir():
-            session_data = {}
-            metadata_file = session_dir / "metadata.txt"
-            lines = []
-            try:
-                with open(metadata_file, "r", encoding="utf-8") as f:
-                    lines = f.readlines()
-            except UnicodeDecodeError:
-                try:
-                    with open(metadata_file, "r", encoding="latin-1") as f:
-                        lines = f.readlines()
-                except UnicodeDecodeError:
-                    try:
-                        with open(metadata_file, "r", encoding="windows-1252") as f:
-                            lines = f.readlines()
-                    except UnicodeDecodeError:
-                        try:
-                            with open(metadata_file, "r", errors='replace') as f:
-                                lines = f.readlines()
-                        except:
-                            lines = ["Date: Error", "Notes: Error", "Audio: Error"]
-
-            if lines:
-                try:
-                    session_data["date"] = lines[0].replace("Date: ", "").strip()
-                    session_data["notes"] = lines[1].replace("Notes: ", "").strip()
-                    if len(lines) > 2 and lines[2].startswith("Audio: "):
-                        session_data["audio"] = lines[2].replace("Audio: ", "").strip()
-                    else:
-                        session_data["audio"] = None
-                except IndexError:
-                    session_data["date"] = "Error"
-                    session_data["notes"] = "Error"
-                    session_data["audio"] = "Error"
+    """List a patient's sessions, newest first, from the history manifest."""
+    sessions = load_manifest(SESSIONS_DIR / patient_id)
+    for session in sessions:
+        session["session_dir"] = str(SESSIONS_DIR / patient_id / session["session_id"])
+    return sessions
+
+def format_duration(seconds):
+    if seconds is None:
+        return "—"
+    seconds = int(seconds)
+    return f"{seconds // 60}:{seconds % 60:02d} min"
+
+def format_timestamp(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}" if seconds >= 3600 else f"{seconds // 60}:{seconds % 60:02d}"
+
+def seek(seek_key, seconds):
+    st.session_state[seek_key] = int(seconds)
+
+def render_session_details(session, key):
+    """Notes, audio and transcript of one session, only rendered once it is opened."""
+    metadata = read_metadata(session["session_dir"])
+    st.markdown("**Notas:**")
+    st.write(metadata["notes"])
+    
+    # Where the player starts, moved by the slider and the transcript lines
+    seek_key = f"{key}_seek"
+    has_audio = False
+    if session.get("audio"):
+        audio = audio_file(session["session_dir"], metadata)
+        if audio and audio.exists():
+            has_audio = True
+            st.markdown("**Grabación de Audio:**")
+            start_time = st.session_state.get(seek_key, 0)
+            waveform = read_peaks(session["session_dir"])
+            if waveform and waveform[0] >= 1:
+                # Scrubbing over the waveform starts the player at that point
+                duration, peaks = waveform
+                st.session_state[seek_key] = min(start_time, int(duration))
+                start_time = st.slider("Posición", 0, int(duration), format="%d s", key=seek_key)
+                st.markdown(waveform_svg(peaks, bars=300, height=48, position=start_time / duration), unsafe_allow_html=True)
+            audio_server = get_audio_server()
+            if audio_server:
+                # The browser streams the recording and seeks with range requests
+                session_dir = Path(session["session_dir"])
+                st.audio(audio_server.url(session_dir.parent.name, session_dir.name), start_time=start_time)
             else:
-                session_data["date"] = "No Date"
-                session_data["notes"] = "No Notes"
-                session_data["audio"] = None
+                # Blobs have no extension and transcoded ones hold Opus, so
+                # Streamlit is told the type instead of guessing audio/wav
+                st.audio(str(audio), format=content_type(audio, metadata), start_time=start_time)
+        else:
+            st.warning("Archivo de audio no encontrado")
+    
+    st.markdown("**Transcripción:**")
+    segments = read_segments(session["session_dir"])
+    if not segments or not has_audio:
+        st.write(read_transcript(session["session_dir"]))
+        return
+    # One line per segment, its time starts the player there
+    with st.container(height=400):
+        for i, segment in enumerate(segments):
+            col1, col2 = st.columns([1, 8])
+            with col1:
+                st.button(format_timestamp(segment["start"]), key=f"{key}_segment_{i}", on_click=seek, args=(seek_key, segment["start"]))
+            with col2:
+                st.write(segment["text"].strip())
 
-            transcript_file = session_dir / "transcript.txt"
-            try:
-                with open(transcript_file, "r", errors='replace') as f: # force the use of replace.
-                    session_data["transcript"] = f.read()
-            except:
-                session_data["transcript"] = "Error reading transcript"
+def render_decode_profile(patient_id):
+    """Editor of the decoding settings a patient overrides over the deployment's default profile."""
+    patient_dir = SESSIONS_DIR / patient_id
+    overrides = read_profile(patient_dir)
+    languages = dict(PROFILE_LANGUAGES)
+    if overrides.get("language") not in languages and "language" in overrides:
+        # A code set by hand in the file
+        languages[overrides["language"]] = overrides["language"]
+
+    def beam_label(beam_size):
+        return "Voraz (más rápida)" if beam_size == 0 else f"Beam search ({beam_size} haces)"
 
-            session_data["session_dir"] = str(session_dir)
-            sessions.append(session_data)
+    def with_default(format_value, default):
+        return lambda value: f"Predeterminado: {format_value(default)}" if value is None else format_value(value)
 
-    return sorted(sessions, key=lambda x: x["date"], reverse=True)
+    with st.expander("Perfil de transcripción del paciente"):
+        st.caption("Ajustes de Whisper para las sesiones de este paciente. «Predeterminado» usa el perfil del servidor.")
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            options = [None, *languages]
+            language = st.selectbox(
+                "Idioma", options, index=options.index(overrides.get("language")),
+                format_func=with_default(lambda v: languages.get(v, v), DEFAULT_PROFILE["language"]),
+                key=f"profile_{patient_id}_language",
+            )
+        with col2:
+            options = [None, *sorted({*PROFILE_BEAM_SIZES, overrides.get("beam_size", 0)})]
+            beam_size = st.selectbox(
+                "Búsqueda", options, index=options.index(overrides.get("beam_size")),
+                format_func=with_default(beam_label, DEFAULT_PROFILE["beam_size"]),
+                key=f"profile_{patient_id}_beam_size",
+            )
+        with col3:
+            options = [None, False, True]
+            fallback = st.selectbox(
+                "Reintentar con temperatura", options, index=options.index(overrides.get("fallback")),
+                format_func=with_default(lambda v: "Sí" if v else "No", DEFAULT_PROFILE["fallback"]),
+                key=f"profile_{patient_id}_fallback",
+            )
+        initial_prompt = st.text_area(
+            "Vocabulario esperado (prompt inicial)", overrides.get("initial_prompt", ""),
+            placeholder=DEFAULT_PROFILE["initial_prompt"] or "Ej. nombres, términos clínicos...",
+            help="Vacío usa el del perfil predeterminado.", key=f"profile_{patient_id}_initial_prompt",
+        )
+
+        if st.button("Guardar perfil", key=f"profile_{patient_id}_save"):
+            values = {"language": language, "beam_size": beam_size, "fallback": fallback, "initial_prompt": initial_prompt.strip() or None}
+            write_profile(patient_dir, {field: values[field] for field in FIELDS if values[field] is not None})
+            st.success("¡Perfil guardado! Se aplica a las próximas transcripciones.")
+
+def render_session_history(patient_id, key):
+    """
+    Paginated session history of a patient.
+    
+    Only a header row per session (date, duration, notes preview and waveform
+    thumbnail) is sent to the browser; the transcript and audio of a session
+    load when it is opened.
+    """
+    sessions = load_patient_sessions(patient_id)
+    if not sessions:
+        st.info("📭 No se encontraron sesiones")
+        return
+    
+    n_pages = (len(sessions) - 1) // SESSIONS_PER_PAGE + 1
+    page = 1
+    if n_pages > 1:
+        page = st.number_input(f"Página (de {n_pages})", min_value=1, max_value=n_pages, value=1, key=f"{key}_page")
+    
+    open_key = f"{key}_open"
+    for session in sessions[(page - 1) * SESSIONS_PER_PAGE:page * SESSIONS_PER_PAGE]:
+        is_open = st.session_state.get(open_key) == session["session_id"]
+        col1, col2 = st.columns([5, 1])
+        with col1:
+            st.markdown(f'**Sesión del {session["date"]}** · {format_duration(session.get("duration"))} · {session["notes"]}')
+            waveform = read_peaks(session["session_dir"])
+            if waveform:
+                st.markdown(waveform_svg(waveform[1]), unsafe_allow_html=True)
+        with col2:
+            if st.button("Cerrar" if is_open else "Abrir", key=f'{key}_{session["session_id"]}', use_container_width=True):
+                st.session_state[open_key] = None if is_open else session["session_id"]
+                st.rerun()
+        if is_open:
+            with st.container(border=True):
+                render_session_details(session, key=f'{key}_{session["session_id"]}')
 
 def therapist_interface():
     st.markdown('<h1 class="section-title"><i class="fas fa-user-md icon"></i>Panel del Terapeuta</h1>', unsafe_allow_html=True)
     
+    preloader = start_preloading()
+    if not preloader.ready():
+        status = ", ".join(f"{name} ({state})" for name, state in preloader.status.items())
+        st.info(f"Preparando modelos de transcripción: {status}")
+    
     # Patient management section
     patients = get_all_patients()
     if patients:
@@ -441,10 +837,12 @@ def therapist_interface():
         if selected_patient == "Seleccionar un paciente":
             st.warning("Por favor seleccione un paciente")
         else:
+            render_decode_profile(selected_patient.split("(ID: ")[1].rstrip(")"))
+
             # Session Content
             session_notes = st.text_area("Notas de la Sesión", placeholder="Ingrese las notas de la sesión aquí...", height=150, key="session_notes")
 
-            input_option = st.radio("¿Cómo desea agregar el audio?", options=["Subir un archivo", "Grabar audio ahora"], index=1)
+            input_option = st.radio("¿Cómo desea agregar el audio?", options=["Subir un archivo", "Grabar audio ahora", "Grabar con transcripción en vivo"], index=1)
             
             uploaded_file = None
 
@@ -453,31 +851,28 @@ def therapist_interface():
             elif input_option == "Subir un archivo":
                 uploaded_file = st.file_uploader("Subir un archivo de audio", type=["wav", "mp3", "ogg", "wma", "aac", "flac", "mp4", "flv"], key="file_uploader")
 
-            if uploaded_file and input_option == "Subir un archivo":
-                file_path = os.path.join(UPLOAD_DIR, uploaded_file.name)
-                with open(file_path, "wb") as f:
-                    f.write(uploaded_file.getbuffer())
-                
+            if input_option == "Grabar con transcripción en vivo":
+                model_name = st.selectbox("Elija un modelo de Whisper", SERVED_MODELS, index=SERVED_MODELS.index("base") if "base" in SERVED_MODELS else 0, key="live_model")
+                patient_id = selected_patient.split("(ID: ")[1].rstrip(")")
+                live_transcription(patient_id, session_notes, model_name)
+
+            elif uploaded_file and input_option == "Subir un archivo":
                 st.success(f"Archivo subido: {uploaded_file.name}")
                 
                 col1, col2 = st.columns(2)
                 with col1:
-                    st.audio(file_path)
+                    st.audio(uploaded_file)
                 
                 with col2:
-                    available_models = whisper.available_models()
-                    model_name = st.selectbox("Elija un modelo de Whisper", available_models, index=available_models.index("base"))
+                    model_name = st.selectbox("Elija un modelo de Whisper", SERVED_MODELS, index=SERVED_MODELS.index("base") if "base" in SERVED_MODELS else 0)
+                    chunked = st.checkbox("Transcribir por partes en paralelo (sesiones largas)")
+                    refresh = st.checkbox("Volver a transcribir (ignorar caché)")
                 
                 if st.button("Generar Transcripción"):
-                    with st.spinner("Transcribiendo..."):
-                        transcript_text = transcribe_audio(file_path, model_name)
-                        st.text_area("Transcripción", transcript_text, height=300)
-                        st.download_button("Descargar Transcripción", transcript_text, file_name=uploaded_file.name + ".txt", mime="text/plain")
-                        st.success("¡Transcripción completada!")
-                        
-                        # Store transcript and audio in session state
-                        st.session_state.current_transcript = transcript_text
-                        st.session_state.current_audio = uploaded_file
+                    # Extract patient ID from selection
+                    patient_id = selected_patient.split("(ID: ")[1].rstrip(")")
+                    queue_transcription(patient_id, session_notes, stage_audio(uploaded_file), model_name, chunked, refresh)
+                    st.success("¡Sesión guardada! La transcripción se genera en segundo plano.")
             
             elif uploaded_file and input_option == "Grabar audio ahora":
                 st.success("¡Grabación completada!")
@@ -488,39 +883,19 @@ def therapist_interface():
                     st.write("Grabación guardada en archivo")
                 
                 with col2:
-                    available_models = whisper.available_models()
-                    model_name = st.selectbox("Elija un modelo de Whisper", available_models, index=available_models.index("base"))
+                    model_name = st.selectbox("Elija un modelo de Whisper", SERVED_MODELS, index=SERVED_MODELS.index("base") if "base" in SERVED_MODELS else 0)
+                    chunked = st.checkbox("Transcribir por partes en paralelo (sesiones largas)")
+                    refresh = st.checkbox("Volver a transcribir (ignorar caché)")
                 
                 if st.button("Generar Transcripción"):
-                    with st.spinner("Transcribiendo..."):
-                        transcript_text = transcribe_audio(uploaded_file, model_name)
-                        st.text_area("Transcripción", transcript_text, height=300)
-                        st.download_button("Descargar Transcripción", transcript_text, file_name="grabacion.txt", mime="text/plain")
-                        st.success("¡Transcripción completada!")
-                        
-                        # Store transcript and audio in session state
-                        st.session_state.current_transcript = transcript_text
-                        st.session_state.current_audio = uploaded_file
-            
-            # Save button
-            if 'current_transcript' in st.session_state and st.session_state.current_transcript:
-                if st.button("Guardar Sesión", use_container_width=True):
                     # Extract patient ID from selection
                     patient_id = selected_patient.split("(ID: ")[1].rstrip(")")
-                    patient_name = selected_patient.split(" (ID:")[0]
-                    
-                    session_data = {
-                        "date": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                        "notes": session_notes
-                    }
-                    
-                    if save_session(patient_id, session_data, st.session_state.current_transcript, st.session_state.current_audio):
-                        st.success("¡Sesión guardada exitosamente!")
-                        # Clear only the transcript and audio state
-                        st.session_state.current_transcript = None
-                        st.session_state.current_audio = None
-                    else:
-                        st.error("Error al guardar la sesión. Por favor intente nuevamente.")
+                    queue_transcription(patient_id, session_notes, stage_audio(uploaded_file), model_name, chunked, refresh)
+                    st.success("¡Sesión guardada! La transcripción se genera en segundo plano.")
+            
+            # Status of the last queued transcription
+            if st.session_state.current_job:
+                show_transcription_job(st.session_state.current_job)
 
     st.markdown("---")
     st.markdown('<h1 class="section-title"><i class="fas fa-search icon"></i>Buscar Paciente</h1>', unsafe_allow_html=True)
@@ -528,7 +903,14 @@ def therapist_interface():
     patient_name = st.text_input("Ingrese el Nombre del Paciente", placeholder="Ingrese el nombre del paciente existente")
     
     if patient_name:
-        patient = get_patient(patient_name)
+        patient = None
+        candidates = find_patients(patient_name)
+        if candidates and normalize_name(candidates[0][1]) == normalize_name(patient_name):
+            patient = candidates[0]
+        elif candidates:
+            options = [f"{name} (ID: {pid})" for pid, name in candidates]
+            choice = st.radio("Pacientes encontrados", options, key="patient_candidates")
+            patient = candidates[options.index(choice)]
         if patient:
             st.write(f'<i class="fas fa-user icon"></i>Nombre del Paciente: {patient[1]}', unsafe_allow_html=True)
             
@@ -537,26 +919,49 @@ def therapist_interface():
             
             # Display previous sessions
             st.markdown("### Sesiones Anteriores")
-            sessions = load_patient_sessions(patient[0])
-            for session in sessions:
-                with st.expander(f'Sesión del {session["date"]}', expanded=False):
-                    st.markdown("**Notas:**")
-                    st.write(session["notes"])
-                    st.markdown("**Transcripción:**")
-                    st.write(session["transcript"])
-                    
-                    # Check for audio file
-                    audio_path = session.get("audio")
-                    if audio_path:
-                        audio_file = Path(session["session_dir"]) / audio_path
-                        if audio_file.exists():
-                            st.markdown("**Grabación de Audio:**")
-                            st.audio(str(audio_file))
-                        else:
-                            st.warning("Archivo de audio no encontrado")
+            render_session_history(patient[0], key="therapist_history")
         else:
             st.error("❌ ¡Paciente no encontrado!")
 
+    st.markdown("---")
+    render_session_search()
+
+def render_session_search():
+    """Ranked full-text search over the notes and transcripts of every session."""
+    st.markdown('<h1 class="section-title"><i class="fas fa-file-alt icon"></i>Buscar en Sesiones</h1>', unsafe_allow_html=True)
+    
+    patients = dict(get_all_patients())
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        query = st.text_input("Buscar en notas y transcripciones", placeholder="Ej. insomnio, ansiedad...")
+    with col2:
+        scope = st.selectbox("Pacientes", ["Todos los pacientes"] + [f"{name} (ID: {pid})" for pid, name in patients.items()])
+    
+    if query:
+        patient_id = None if scope == "Todos los pacientes" else scope.split("(ID: ")[1].rstrip(")")
+        results = get_session_index().search(query, patient_id)
+        if not results:
+            st.info("No se encontraron sesiones")
+        for result in results:
+            patient_name = patients.get(result["patient_id"], result["patient_id"])
+            session_dir = SESSIONS_DIR / result["patient_id"] / result["session_id"]
+            key = f'search_{result["patient_id"]}_{result["session_id"]}'
+            col1, col2 = st.columns([5, 1])
+            with col1:
+                st.markdown(f'**{patient_name}** · Sesión del {result["date"]}')
+                st.caption(result["snippet"])
+            # Hits in the transcript open the session with the player at the matching line
+            segments = read_segments(session_dir)
+            offset = find_offset(segments, query) if segments else None
+            with col2:
+                if offset is not None and st.button(f"▶ {format_timestamp(offset)}", key=f"{key}_play", use_container_width=True):
+                    st.session_state.search_open = key
+                    seek(f"{key}_seek", offset)
+            if st.session_state.get("search_open") == key:
+                with st.container(border=True):
+                    session = {"session_dir": str(session_dir), "audio": read_metadata(session_dir)["audio"]}
+                    render_session_details(session, key=key)
+
 def patient_interface():
     st.markdown('<h1 class="section-title"><i class="fas fa-user icon"></i>Portal del Paciente</h1>', unsafe_allow_html=True)
     
@@ -566,24 +971,7 @@ def patient_interface():
         patient = get_patient(patient_id)
         if patient:
             st.write(f'<i class="fas fa-hand-sparkles icon"></i>¡Bienvenido, {patient[1]}!', unsafe_allow_html=True)
-            sessions = load_patient_sessions(patient[0])
-            if sessions:
-                for session in sessions:
-                    with st.expander(f'Sesión del {session["date"]}'):
-                        st.markdown("**Notas:**")
-                        st.write(session["notes"])
-                        st.markdown("**Transcripción:**")
-                        st.write(session["transcript"])
-                        if session.get("audio"):
-                            try:
-                                uploaded_file = Path(session["session_dir"]) / session["audio"]
-                                if uploaded_file.exists():
-                                    st.markdown("**Grabación de Audio:**")
-                                    st.audio(str(uploaded_file))
-                            except Exception:
-                                st.warning("Archivo de audio no encontrado")
-            else:
-                st.info("📭 No se encontraron sesiones")
+            render_session_history(patient[0], key="patient_history")
         else:
             st.error("❌ ¡ID de paciente no encontrado!")
 
@@ -666,6 +1054,11 @@ def homepage():
     """, unsafe_allow_html=True)
 
 def main():
+    # Start background services on the first page load of the server:
+    # model warm-up and the resumption of pending transcription jobs
+    start_preloading()
+    get_transcription_queue()
+    
     # Initialize session state for page navigation
     if 'current_page' not in st.session_state:
         st.session_state.current_page = 'Inicio'
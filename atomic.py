@@ -0,0 +1,22 @@
+"""Atomic replacement of the small files kept next to sessions and patients.
+
+Readers of job states, manifests, metadata, transcripts, segments, peaks and
+profiles run in other threads and processes while these files are written,
+so each one is written to a temporary file first and renamed over the old
+one, which readers then see either whole or not at all.
+"""
+import os
+from pathlib import Path
+
+
+def write_atomic(path, data):
+    """Replace ``path`` with ``data``, bytes or text written as UTF-8, in one rename."""
+    path = Path(path)
+    tmp_file = path.with_suffix(".tmp")
+    if isinstance(data, bytes):
+        with open(tmp_file, "wb") as f:
+            f.write(data)
+    else:
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            f.write(data)
+    os.replace(tmp_file, path)
@@ -0,0 +1,185 @@
+"""Compact storage of session audio.
+
+Recordings and uploads are saved as they arrive, in practice 48 kHz 16-bit PCM
+WAV (about 10 MB per minute). Once a session is transcribed, its audio is
+transcoded in the background to mono Opus in an OGG container at a speech
+bitrate. The result is decoded back and its duration compared with the
+original before it is added to the blob store, the metadata is pointed at it
+and the original is released, so a failed or truncated transcode never loses
+audio.
+
+Run as a script to process the sessions already in the archive:
+
+    python audio.py transcode --workers 4   # transcode to Opus
+    python audio.py peaks --workers 4       # write the waveform peaks of older sessions
+"""
+import argparse
+import logging
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from jobs import QUEUED, RUNNING, read_job
+from blobs import BLOBS_DIR_NAME, BlobStore
+from features import load_pcm
+from models import SAMPLE_RATE
+from storage import audio_file, read_metadata, session_entry, update_manifest, update_metadata
+from waveform import PEAKS_FILE, compute_peaks, pcm_peaks, write_peaks
+
+# Name given to the transcoded audio in the metadata
+OPUS_FILE = "audio.ogg"
+OPUS_FORMAT = "ogg/opus"
+# Plenty for a single voice, about 0.2 MB per minute
+OPUS_BITRATE = "24k"
+# Opus pads the start and end of the stream by a few milliseconds
+DURATION_TOLERANCE_SECONDS = 0.25
+
+logger = logging.getLogger(__name__)
+
+
+def decoded_duration(audio_file):
+    """Decode a whole file with ffmpeg and return its duration in seconds.
+
+    Raises ``subprocess.CalledProcessError`` if any part of the file fails to decode.
+    """
+    result = subprocess.run(
+        ["ffmpeg", "-nostdin", "-v", "error", "-xerror", "-i", str(audio_file), "-f", "null", "-progress", "pipe:1", "-"],
+        capture_output=True, text=True, check=True,
+    )
+    # -progress reports the position reached as out_time_us=..., the last one is the end
+    positions = [line.split("=", 1)[1] for line in result.stdout.splitlines() if line.startswith("out_time_us=")]
+    if not positions or not positions[-1].isdigit():
+        raise ValueError(f"No audio decoded from {audio_file}")
+    return int(positions[-1]) / 1e6
+
+
+def needs_transcoding(session_dir):
+    """Whether a session has audio that is not Opus yet."""
+    metadata = read_metadata(session_dir)
+    if metadata["audio_format"] == OPUS_FORMAT:
+        return False
+    audio = audio_file(session_dir, metadata)
+    return bool(audio) and audio.exists()
+
+
+def is_transcribing(session_dir):
+    job = read_job(session_dir)
+    return bool(job) and job.get("status") in (QUEUED, RUNNING)
+
+
+def transcode_session(session_dir, store, bitrate=OPUS_BITRATE):
+    """
+    Transcode the audio of a session to Opus into a ``BlobStore``, verify it
+    and release the original.
+
+    Returns the bytes reclaimed, 0 if there was nothing to do. Raises on failure,
+    leaving the original audio and metadata untouched.
+    """
+    session_dir = Path(session_dir)
+    if not needs_transcoding(session_dir):
+        return 0
+
+    metadata = read_metadata(session_dir)
+    source = audio_file(session_dir, metadata)
+    tmp_file = session_dir / "audio.tmp"
+    try:
+        subprocess.run(
+            ["ffmpeg", "-nostdin", "-v", "error", "-y", "-i", str(source), "-vn", "-ac", "1",
+             "-c:a", "libopus", "-b:a", bitrate, "-application", "voip", "-f", "ogg", str(tmp_file)],
+            capture_output=True, check=True,
+        )
+        expected = decoded_duration(source)
+        actual = decoded_duration(tmp_file)
+        if abs(expected - actual) > DURATION_TOLERANCE_SECONDS:
+            raise ValueError(f"Transcoded audio lasts {actual:.2f} s instead of {expected:.2f} s")
+    except Exception:
+        tmp_file.unlink(missing_ok=True)
+        raise
+
+    reclaimed = source.stat().st_size - tmp_file.stat().st_size
+    try:
+        blob_hash = store.add(tmp_file)
+    finally:
+        tmp_file.unlink()
+    update_metadata(session_dir, {"Audio": OPUS_FILE, "Audio-Format": OPUS_FORMAT, "Audio-Blob": blob_hash})
+    if metadata["audio_blob"]:
+        # Deleted unless another session saved the same recording
+        store.release(metadata["audio_blob"])
+    else:
+        source.unlink()
+    update_manifest(session_dir.parent, session_entry(session_dir))
+    return reclaimed
+
+
+def write_session_peaks(session_dir):
+    """Compute and write the waveform peaks of a session's audio. Returns True if it has audio."""
+    session_dir = Path(session_dir)
+    audio = audio_file(session_dir)
+    if not audio or not audio.exists():
+        return False
+    pcm = load_pcm(session_dir)
+    write_peaks(session_dir, *(pcm_peaks(pcm, SAMPLE_RATE) if pcm is not None else compute_peaks(audio)))
+    update_manifest(session_dir.parent, session_entry(session_dir))
+    return True
+
+
+class Transcoder:
+    """Transcodes sessions on a few background threads; ffmpeg does the work in its own processes."""
+
+    def __init__(self, store, workers=2):
+        self.store = store
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="transcode")
+
+    def submit(self, session_dir):
+        future = self._executor.submit(transcode_session, session_dir, self.store)
+        future.add_done_callback(lambda f: self._report(session_dir, f))
+        return future
+
+    def _report(self, session_dir, future):
+        # The original audio is kept, the next migration run tries again
+        if future.exception() is not None:
+            logger.warning("Transcoding %s failed: %s", session_dir, future.exception())
+
+
+def run_parallel(function, session_dirs, workers):
+    """Call ``function`` on every session directory from a thread pool; returns the results and failure count."""
+    results = []
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(function, d): d for d in session_dirs}
+        for future in as_completed(futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                failed += 1
+                print(f"{futures[future]}: {e}")
+    return results, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["transcode", "peaks"])
+    parser.add_argument("--data-dir", default="data", type=Path)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--bitrate", default=OPUS_BITRATE)
+    args = parser.parse_args()
+
+    session_dirs = [d for d in sorted((args.data_dir / "sessions").glob("*/*")) if d.is_dir()]
+
+    if args.command == "transcode":
+        # Sessions waiting for Whisper are transcoded by the server once transcribed
+        store = BlobStore(args.data_dir / BLOBS_DIR_NAME)
+        session_dirs = [d for d in session_dirs if needs_transcoding(d) and not is_transcribing(d)]
+        print(f"{len(session_dirs)} sessions to transcode")
+        reclaimed, failed = run_parallel(lambda d: transcode_session(d, store, args.bitrate), session_dirs, args.workers)
+        print(f"{len(reclaimed)} transcoded, {failed} failed, {sum(reclaimed) / 1024 / 1024:.1f} MB reclaimed")
+    else:
+        session_dirs = [d for d in session_dirs if not (d / PEAKS_FILE).exists()]
+        print(f"{len(session_dirs)} sessions without peaks")
+        written, failed = run_parallel(write_session_peaks, session_dirs, args.workers)
+        print(f"{sum(written)} peaks files written, {failed} failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""Streaming of session audio over HTTP, with byte ranges.
+
+``st.audio`` given a file reads all of it into the server's memory and sends it
+with the page. Instead, the session player is given the URL of this server,
+which streams the file from disk in small blocks and answers Range requests,
+so playback starts at once and seeking only fetches the part that is played.
+
+Streamlit has no way to add routes to its own server, so this runs a small
+threaded HTTP server on a port of its own. URLs are signed with an HMAC and
+expire, so recordings cannot be fetched by guessing patient and session ids.
+The app only starts it when the deployment gives the public URL browsers
+reach that port at (``TERAPIA_AUDIO_BASE_URL``).
+"""
+import hashlib
+import hmac
+import mimetypes
+import re
+import threading
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+from storage import audio_file, read_metadata
+
+BLOCK_SIZE = 64 * 1024
+URL_LIFETIME_SECONDS = 6 * 3600
+
+FORMAT_TYPES = {"ogg/opus": "audio/ogg"}
+
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)$")
+
+
+def content_type(audio, metadata):
+    """MIME type of a session's audio, checking the content of files saved as audio.mp3."""
+    if metadata["audio_format"] in FORMAT_TYPES:
+        return FORMAT_TYPES[metadata["audio_format"]]
+    with open(audio, "rb") as f:
+        header = f.read(12)
+    # Recordings were saved as WAV under an .mp3 name
+    if header[:4] == b"RIFF" and header[8:12] == b"WAVE":
+        return "audio/wav"
+    # Blobs are named by their hash, the metadata keeps the original name
+    return mimetypes.guess_type(metadata["audio"] or audio.name)[0] or "application/octet-stream"
+
+
+def parse_range(header, size):
+    """Return the ``(start, end)`` bytes, end included, asked by a Range header, or None if not satisfiable."""
+    match = RANGE_PATTERN.match(header.strip())
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+    first, last = match.groups()
+    if first == "":
+        # "bytes=-500" is the last 500 bytes
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start > end or start >= size:
+        return None
+    return start, end
+
+
+class AudioServer:
+    """Serves the audio of the sessions under ``sessions_dir`` at signed URLs."""
+
+    def __init__(self, sessions_dir, secret, host="0.0.0.0", port=8502, base_url=None):
+        self.sessions_dir = Path(sessions_dir).resolve()
+        self.secret = secret.encode() if isinstance(secret, str) else secret
+        self.base_url = (base_url or f"http://localhost:{port}").rstrip("/")
+
+        server = self
+
+        class Handler(AudioRequestHandler):
+            audio_server = server
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, name="audio-server", daemon=True).start()
+
+    def _signature(self, path, expires):
+        return hmac.new(self.secret, f"{path}|{expires}".encode(), hashlib.sha256).hexdigest()
+
+    def url(self, patient_id, session_id, lifetime=URL_LIFETIME_SECONDS):
+        """Signed URL of a session's audio, valid for ``lifetime`` seconds."""
+        path = f"/audio/{patient_id}/{session_id}"
+        # Rounded so the URL, and the browser's cached audio, stay the same across reruns
+        expires = (int(time.time()) // lifetime + 2) * lifetime
+        return f"{self.base_url}{path}?" + urlencode({"expires": expires, "signature": self._signature(path, expires)})
+
+    def resolve(self, path, query):
+        """Audio file and metadata for a request, or None if the URL is invalid, expired or the audio is missing."""
+        params = parse_qs(query)
+        try:
+            expires = int(params["expires"][0])
+            signature = params["signature"][0]
+        except (KeyError, ValueError):
+            return None
+        if expires < time.time() or not hmac.compare_digest(signature, self._signature(path, expires)):
+            return None
+
+        parts = path.strip("/").split("/")
+        if len(parts) != 3 or parts[0] != "audio":
+            return None
+        session_dir = (self.sessions_dir / parts[1] / parts[2]).resolve()
+        if session_dir.parent.parent != self.sessions_dir:
+            return None
+        metadata = read_metadata(session_dir)
+        audio = audio_file(session_dir, metadata)
+        if not audio or not audio.is_file():
+            return None
+        return audio, metadata
+
+
+class AudioRequestHandler(BaseHTTPRequestHandler):
+    audio_server = None
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def _serve(self, send_body):
+        url = urlsplit(self.path)
+        found = self.audio_server.resolve(url.path, url.query)
+        if found is None:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        audio, metadata = found
+
+        size = audio.stat().st_size
+        start, end = 0, size - 1
+        status = HTTPStatus.OK
+        if "Range" in self.headers:
+            byte_range = parse_range(self.headers["Range"], size)
+            if byte_range is None:
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            start, end = byte_range
+            status = HTTPStatus.PARTIAL_CONTENT
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type(audio, metadata))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Cache-Control", "private, max-age=3600")
+        if status == HTTPStatus.PARTIAL_CONTENT:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if not send_body:
+            return
+
+        remaining = end - start + 1
+        try:
+            with open(audio, "rb") as f:
+                f.seek(start)
+                while remaining > 0:
+                    block = f.read(min(BLOCK_SIZE, remaining))
+                    if not block:
+                        break
+                    self.wfile.write(block)
+                    remaining -= len(block)
+        except (BrokenPipeError, ConnectionResetError):
+            # Browsers drop the connection when the listener seeks elsewhere
+            pass
+
+    def log_message(self, format, *args):
+        # Every seek is a request, keep them out of the server's output
+        pass
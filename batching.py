@@ -0,0 +1,308 @@
+"""Batched Whisper decoding shared by concurrent transcriptions.
+
+When several transcriptions run at once, each calling ``model.transcribe`` on
+the shared model, they only compete for the same cores. Instead, every
+recording is cut at pauses into windows of at most 30 seconds, the input size
+of Whisper, and the log-mel frames of the windows of every pending job are
+sent to one ``BatchScheduler``. Its thread decodes them together with
+``whisper.decode``, so the encoder and the decoder run on batches.
+
+A batch is sent as soon as it is full, or once its oldest window has waited
+``max_wait`` seconds, so a single user is not kept waiting for company.
+Batches are filled taking one window of every job in turn, so a long session
+does not hold back a short one queued after it.
+
+Windows are decoded independently, with timestamps, and split into segments
+at the timestamp tokens. Windows that look like a failed decode (repetitive
+or unlikely text) are decoded again at higher temperatures, as
+``model.transcribe`` does, in batches of their own.
+"""
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+import numpy as np
+
+import models
+from models import SAMPLE_RATE
+from transcription import split_on_silence
+
+# Whisper's input: 30 s of 10 ms mel frames
+N_FRAMES = 3000
+HOP_LENGTH = 160
+FRAMES_PER_SECOND = SAMPLE_RATE // HOP_LENGTH
+# Timestamp tokens are 20 ms apart
+TIME_PRECISION = 0.02
+# Windows end at a pause after this, or are cut at the quietest point. A
+# tail shorter than a second is added to the last window, so it stays under 30 s.
+WINDOW_TARGET_SECONDS = 20
+WINDOW_MAX_SECONDS = 29
+
+# Defaults of model.transcribe
+TEMPERATURES = (0.0, 0.2, 0.4, 0.6, 0.8, 1.0)
+COMPRESSION_RATIO_THRESHOLD = 2.4
+LOGPROB_THRESHOLD = -1.0
+NO_SPEECH_THRESHOLD = 0.6
+BEST_OF = 5
+
+
+def log_mel(audio, n_mels=80):
+    """Log-mel frames of float32 samples as ``(frames, n_mels)``, like ``features.load_mel``."""
+    models.import_torch()
+    import whisper
+
+    return whisper.log_mel_spectrogram(audio, n_mels).T.numpy()
+
+
+def timestamp_segments(tokens, timestamp_begin, eot):
+    """
+    Split the tokens of a window at its timestamp tokens into
+    ``(start, end, text_tokens)`` with times in seconds from the start of the window.
+    """
+    segments = []
+    start = None
+    text = []
+    for token in tokens:
+        if token == eot:
+            break
+        if token < timestamp_begin:
+            text.append(token)
+            continue
+        # A timestamp closes the text before it and opens the next segment;
+        # the pair <|t|><|t|> between segments only opens it once
+        seconds = (token - timestamp_begin) * TIME_PRECISION
+        if text:
+            segments.append((start or 0.0, seconds, text))
+            text = []
+        start = seconds
+    if text:
+        # Text after the last timestamp runs to the end of the window
+        segments.append((start or 0.0, None, text))
+    return segments
+
+
+def whisper_decode(model, mels, options):
+    """Decode a batch of ``(n_mels, N_FRAMES)`` windows into dicts of plain values."""
+    torch = models.import_torch()
+    import whisper
+    from whisper.tokenizer import get_tokenizer
+
+    tokenizer = get_tokenizer(model.is_multilingual, num_languages=model.num_languages, task="transcribe")
+    mel = torch.from_numpy(np.stack(mels)).to(model.device)
+    results = whisper.decode(model, mel, whisper.DecodingOptions(fp16=False, **options))
+
+    windows = []
+    for result in results:
+        segments = [
+            (start, end, tokenizer.decode(text), text)
+            for start, end, text in timestamp_segments(result.tokens, tokenizer.timestamp_begin, tokenizer.eot)
+        ]
+        windows.append({
+            "language": result.language,
+            "segments": segments,
+            "avg_logprob": result.avg_logprob,
+            "compression_ratio": result.compression_ratio,
+            "no_speech_prob": result.no_speech_prob,
+            "temperature": result.temperature,
+        })
+    return windows
+
+
+class BatchScheduler:
+    """
+    Decodes the windows of all pending transcriptions on one thread, in batches.
+
+    ``decode`` is called as ``decode(model, mels, options)`` with a list of
+    ``(n_mels, N_FRAMES)`` arrays and returns one result per window. Given
+    ``InferenceSlots``, batches are decoded on them, as many at a time as
+    there are slots; the next batch is only formed once a slot is free, so
+    windows queued meanwhile make it larger.
+
+    Whoever submits windows holds their model, acquired from the manager,
+    until they are decoded, as ``transcribe_batched`` does for a whole job.
+    The model is then resident for every batch, which only takes another
+    reference to it and never waits for memory on a slot.
+    """
+
+    def __init__(self, manager, max_batch=8, max_wait=0.05, decode=whisper_decode, slots=None):
+        self.manager = manager
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.decode = decode
+        self.slots = slots
+        self._free = threading.Semaphore(slots.slots if slots else 1)
+        # Batches run and windows decoded, for the mean batch size
+        self.batches = 0
+        self.windows = 0
+
+        # (model, options) -> job -> queued (mel, future, time) of that job
+        self._groups = OrderedDict()
+        self._condition = threading.Condition()
+        threading.Thread(target=self._run, name="batch-decoding", daemon=True).start()
+
+    def submit(self, model_name, mel, options, job):
+        """Queue a window of a job, returning a ``Future`` of its result."""
+        future = Future()
+        key = (model_name, tuple(sorted(options.items())))
+        with self._condition:
+            jobs = self._groups.setdefault(key, OrderedDict())
+            jobs.setdefault(job, deque()).append((mel, future, time.monotonic()))
+            self._condition.notify()
+        return future
+
+    def _oldest(self, key):
+        return min(windows[0][2] for windows in self._groups[key].values())
+
+    def _size(self, key):
+        return sum(len(windows) for windows in self._groups[key].values())
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._groups:
+                self._condition.wait()
+            # The group whose oldest window has waited longest goes first
+            key = min(self._groups, key=self._oldest)
+            deadline = self._oldest(key) + self.max_wait
+            while self._size(key) < self.max_batch and (remaining := deadline - time.monotonic()) > 0:
+                self._condition.wait(remaining)
+
+            # One window of each job in turn; jobs served move to the back
+            jobs = self._groups[key]
+            batch = []
+            while jobs and len(batch) < self.max_batch:
+                for job in list(jobs):
+                    if len(batch) == self.max_batch:
+                        break
+                    windows = jobs[job]
+                    batch.append(windows.popleft())
+                    if windows:
+                        jobs.move_to_end(job)
+                    else:
+                        del jobs[job]
+            if not jobs:
+                del self._groups[key]
+        return key, batch
+
+    def _run(self):
+        while True:
+            self._free.acquire()
+            key, batch = self._next_batch()
+            if self.slots:
+                self.slots.submit(self._decode, key, batch).add_done_callback(lambda _: self._free.release())
+            else:
+                self._decode(key, batch)
+                self._free.release()
+
+    def _decode(self, key, batch):
+        model_name, options = key
+        try:
+            # Held by the jobs of the batch, so this does not wait for memory
+            with self.manager.acquire(model_name) as model:
+                results = self.decode(model, [mel for mel, _, _ in batch], dict(options))
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        with self._condition:
+            self.batches += 1
+            self.windows += len(batch)
+        for (_, future, _), result in zip(batch, results):
+            future.set_result(result)
+
+
+def _window(mel, first, last):
+    # Frames first:last of a (frames, n_mels) spectrogram as Whisper's padded input
+    window = np.zeros((mel.shape[1], N_FRAMES), np.float32)
+    window[:, :last - first] = mel[first:last].T
+    return window
+
+
+def _is_silence(result):
+    return result["no_speech_prob"] > NO_SPEECH_THRESHOLD and result["avg_logprob"] < LOGPROB_THRESHOLD
+
+
+def _needs_fallback(result):
+    if _is_silence(result):
+        return False
+    return result["compression_ratio"] > COMPRESSION_RATIO_THRESHOLD or result["avg_logprob"] < LOGPROB_THRESHOLD
+
+
+def transcribe_batched(scheduler, model_name, audio, mel, language=None, initial_prompt=None, beam_size=0, fallback=True):
+    """
+    Transcribe a recording through a ``BatchScheduler``.
+
+    Args:
+        audio: 16 kHz mono samples, float32 or int16, used to place the windows at pauses
+        mel: Log-mel frames of the whole recording as ``(frames, n_mels)``,
+            e.g. the memory map of ``features.load_mel``
+        language: Language code, detected for every window when not given
+        initial_prompt: Text given to Whisper as context for every window
+        beam_size: Beam search at temperature 0 with this many beams, greedy when 0
+        fallback: Decode failed windows again at higher temperatures
+
+    Returns a dict like ``model.transcribe`` with the text, segments and language.
+    The model is held for the whole job, so it is not evicted between batches.
+    """
+    frames = [
+        (start // HOP_LENGTH, min(end // HOP_LENGTH, len(mel)))
+        for start, end in split_on_silence(audio, WINDOW_TARGET_SECONDS, WINDOW_MAX_SECONDS)
+    ]
+    frames = [(first, last) for first, last in frames if last > first]
+    options = {"without_timestamps": False}
+    if language:
+        options["language"] = language
+    if initial_prompt:
+        options["prompt"] = initial_prompt
+
+    job = object()
+    results = {}
+    pending = list(range(len(frames)))
+    with scheduler.manager.acquire(model_name):
+        for temperature in TEMPERATURES if fallback else TEMPERATURES[:1]:
+            decode_options = {**options, "temperature": temperature}
+            if temperature > 0:
+                decode_options["best_of"] = BEST_OF
+            elif beam_size > 0:
+                decode_options["beam_size"] = beam_size
+            # Windows are made as they are queued, two batches ahead, so a long
+            # session does not hold all of its mel windows at once
+            in_flight = deque()
+            for i in pending:
+                if len(in_flight) == 2 * scheduler.max_batch:
+                    j, future = in_flight.popleft()
+                    results[j] = future.result()
+                in_flight.append((i, scheduler.submit(model_name, _window(mel, *frames[i]), decode_options, job)))
+            for j, future in in_flight:
+                results[j] = future.result()
+            # The last decode is kept when every temperature fails
+            pending = [i for i in pending if _needs_fallback(results[i])]
+            if not pending:
+                break
+
+    segments = []
+    for i, (first, last) in enumerate(frames):
+        result = results[i]
+        if _is_silence(result):
+            continue
+        offset = first / FRAMES_PER_SECOND
+        duration = (last - first) / FRAMES_PER_SECOND
+        for start, end, text, tokens in result["segments"]:
+            segments.append({
+                "id": len(segments),
+                "start": round(offset + min(start, duration), 2),
+                "end": round(offset + min(duration if end is None else end, duration), 2),
+                "text": text,
+                "tokens": [int(t) for t in tokens],
+                "temperature": result["temperature"],
+                "avg_logprob": result["avg_logprob"],
+                "compression_ratio": result["compression_ratio"],
+                "no_speech_prob": result["no_speech_prob"],
+            })
+
+    languages = [results[i]["language"] for i in range(len(frames)) if not _is_silence(results[i])]
+    return {
+        "text": "".join(s["text"] for s in segments),
+        "segments": segments,
+        "language": language or (max(set(languages), key=languages.count) if languages else None),
+    }
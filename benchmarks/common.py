@@ -0,0 +1,60 @@
+"""Helpers shared by the benchmark scripts."""
+import re
+import sys
+import unicodedata
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+SESSIONS_DIR = REPO_ROOT / "data" / "sessions"
+
+# Make the app modules importable when a script is run from this directory
+sys.path.insert(0, str(REPO_ROOT))
+
+
+def session_audio_files(limit=None):
+    """Return the audio files of the stored sessions, the benchmark corpus."""
+    from storage import audio_file
+
+    files = []
+    for session_dir in sorted(SESSIONS_DIR.glob("*/*")):
+        # Audio is in the blob store or, for older sessions, the session directory
+        audio = audio_file(session_dir)
+        if audio and audio.exists():
+            files.append(str(audio))
+    return files[:limit] if limit else files
+
+
+def normalize_words(text):
+    """Lowercase words without accents or punctuation."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return re.findall(r"\w+", text)
+
+
+def word_error_rate(reference, hypothesis):
+    """Word-level edit distance divided by the number of reference words."""
+    ref = normalize_words(reference)
+    hyp = normalize_words(hypothesis)
+    if not ref:
+        return 0.0 if not hyp else 1.0
+
+    previous = list(range(len(hyp) + 1))
+    for i, ref_word in enumerate(ref, 1):
+        current = [i]
+        for j, hyp_word in enumerate(hyp, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (ref_word != hyp_word),
+            ))
+        previous = current
+    return previous[-1] / len(ref)
+
+
+def print_table(headers, rows):
+    """Print rows as an aligned plain-text table."""
+    rows = [[str(cell) for cell in row] for row in rows]
+    widths = [max(len(str(h)), *(len(r[i]) for r in rows)) for i, h in enumerate(headers)]
+    print("  ".join(str(h).ljust(w) for h, w in zip(headers, widths)))
+    for row in rows:
+        print("  ".join(cell.ljust(w) for cell, w in zip(row, widths)))
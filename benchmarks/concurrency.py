@@ -0,0 +1,91 @@
+"""Measure aggregate transcription throughput with concurrent jobs.
+
+Usage:
+    python benchmarks/concurrency.py --model base --jobs 1 2 4 8 --limit 4
+
+For every number of concurrent jobs, the recordings are transcribed once per
+job, all jobs at the same time, in two ways:
+
+- "default": one thread per job calling ``model.transcribe`` with torch's
+  default thread pool, which is as large as the machine, as the app did before
+  inference slots;
+- "slots": the same calls run through ``InferenceSlots``, one slot per job
+  with the cores shared out between them, optionally pinned (``--pin``).
+
+Throughput is seconds of audio transcribed per wall-clock second over all
+jobs. Every configuration runs in a fresh process so torch starts from its
+default thread settings.
+"""
+import argparse
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from common import print_table, session_audio_files
+
+
+def run_configuration(model_name, files, jobs, mode, pin):
+    """Transcribe the files once per job, ``jobs`` at a time, and return the throughput and threads used."""
+    import models
+    from inference import InferenceSlots, available_cpus, plan_slots
+    from transcription import SAMPLE_RATE, decode_audio
+
+    model = models.load_model(model_name)
+    audio = [decode_audio(path) for path in files]
+    audio_seconds = jobs * sum(len(a) for a in audio) / SAMPLE_RATE
+    # Excluded from the timings, like the server's preloading
+    models.warm_up(model)
+
+    slots = None
+    if mode == "slots":
+        _, threads = plan_slots(len(available_cpus()), slots=jobs)
+        slots = InferenceSlots(jobs, threads, pin)
+    else:
+        threads = models.import_torch().get_num_threads()
+
+    def job():
+        for samples in audio:
+            if slots:
+                slots.run(model.transcribe, samples, temperature=0.0, fp16=False)
+            else:
+                model.transcribe(samples, temperature=0.0, fp16=False)
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=job) for _ in range(jobs)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return audio_seconds / (time.perf_counter() - start), threads
+
+
+def measure(model_name, files, jobs, mode, pin):
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(run_configuration, model_name, files, jobs, mode, pin).result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="base")
+    parser.add_argument("--jobs", nargs="+", type=int, default=[1, 2, 4, 8], help="concurrent jobs to measure")
+    parser.add_argument("--limit", type=int, default=4, help="number of session recordings to use")
+    parser.add_argument("--pin", action="store_true", help="pin every slot to its own cores")
+    args = parser.parse_args()
+
+    files = session_audio_files(args.limit)
+    rows = []
+    baseline = None
+    for jobs in args.jobs:
+        for mode in ("default", "slots"):
+            throughput, threads = measure(args.model, files, jobs, mode, args.pin)
+            baseline = baseline or throughput
+            rows.append([jobs, mode, threads, jobs * threads, f"{throughput:.2f}x", f"{throughput / baseline:.2f}"])
+
+    print(f"{len(files)} recordings per job, model {args.model}{', pinned' if args.pin else ''}")
+    print_table(["jobs", "mode", "threads/job", "threads", "audio s per s", "vs 1 job default"], rows)
+
+
+if __name__ == "__main__":
+    main()
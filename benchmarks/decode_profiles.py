@@ -0,0 +1,59 @@
+"""Compare the speed and output of decode profiles.
+
+Usage:
+    python benchmarks/decode_profiles.py --model base --limit 10
+
+The session recordings are transcribed with Whisper's defaults (language
+detection, temperature fallback, greedy search) and with the profiles below.
+For each profile it reports the speed, the speed-up over the defaults and the
+WER of its transcripts against those of the defaults, which shows how much the
+output changes, not which is more accurate. Speed figures quoted for the
+profiles should come from running this on the benchmark corpus.
+"""
+import argparse
+import time
+
+from common import print_table, session_audio_files, word_error_rate
+
+PROFILES = {
+    "es": dict(language="es", fallback=True),
+    "es, greedy, no fallback": dict(language="es"),
+    "es, beam 5, no fallback": dict(language="es", beam_size=5),
+    "es, beam 5, fallback": dict(language="es", beam_size=5, fallback=True),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="base")
+    parser.add_argument("--limit", type=int, default=10, help="number of session recordings to use")
+    args = parser.parse_args()
+
+    import models
+    from profiles import default_profile, transcribe_options
+    from transcription import SAMPLE_RATE, decode_audio
+
+    files = session_audio_files(args.limit)
+    audio = [decode_audio(path) for path in files]
+    audio_seconds = sum(len(a) for a in audio) / SAMPLE_RATE
+    model = models.load_model(args.model)
+    models.warm_up(model)
+
+    def run(options):
+        start = time.perf_counter()
+        texts = [model.transcribe(samples, fp16=False, **options)["text"] for samples in audio]
+        return texts, time.perf_counter() - start
+
+    ref_texts, ref_seconds = run({})
+    rows = [["Whisper defaults", f"{audio_seconds / ref_seconds:.2f}x", "1.00x", "-"]]
+    for name, fields in PROFILES.items():
+        texts, seconds = run(transcribe_options(default_profile(**fields)))
+        wer = sum(word_error_rate(r, h) for r, h in zip(ref_texts, texts)) / max(len(files), 1)
+        rows.append([name, f"{audio_seconds / seconds:.2f}x", f"{ref_seconds / seconds:.2f}x", f"{wer:.1%}"])
+
+    print(f"{len(files)} recordings, {audio_seconds / 60:.1f} min of audio, model {args.model}")
+    print_table(["profile", "speed", "speed-up", "WER vs defaults"], rows)
+
+
+if __name__ == "__main__":
+    main()
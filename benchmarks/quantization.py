@@ -0,0 +1,80 @@
+"""Compare fp32 Whisper models with their int8 quantized variants.
+
+Usage:
+    python benchmarks/quantization.py --models base small --limit 10
+
+Every variant runs in a fresh process so its peak RSS is measured on its own.
+The WER of the int8 transcripts is computed against the fp32 transcripts of the
+same recordings, together with the speed-up and the memory saved.
+"""
+import argparse
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from common import print_table, session_audio_files, word_error_rate
+
+
+def run_variant(model_name, files):
+    """Transcribe the files with one model, returning texts, timings and peak RSS."""
+    import models
+    from transcription import SAMPLE_RATE, decode_audio
+
+    start = time.perf_counter()
+    model = models.load_model(model_name)
+    load_seconds = time.perf_counter() - start
+
+    texts = []
+    audio_seconds = 0.0
+    start = time.perf_counter()
+    for path in files:
+        audio = decode_audio(path)
+        audio_seconds += len(audio) / SAMPLE_RATE
+        texts.append(model.transcribe(audio, fp16=False)["text"])
+    transcribe_seconds = time.perf_counter() - start
+
+    # ru_maxrss is reported in kilobytes on Linux
+    rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return texts, load_seconds, transcribe_seconds, audio_seconds, rss_mb
+
+
+def measure(model_name, files):
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(run_variant, model_name, files).result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--models", nargs="+", default=["base", "small"])
+    parser.add_argument("--limit", type=int, default=10, help="number of session recordings to use")
+    args = parser.parse_args()
+
+    files = session_audio_files(args.limit)
+    rows = []
+    for model_name in args.models:
+        ref_texts, _, ref_seconds, audio_seconds, ref_rss = measure(model_name, files)
+        texts, load_seconds, seconds, _, rss = measure(model_name + "-int8", files)
+
+        wer = sum(word_error_rate(r, h) for r, h in zip(ref_texts, texts)) / max(len(files), 1)
+        rows.append([
+            model_name,
+            f"{audio_seconds / ref_seconds:.2f}x",
+            f"{audio_seconds / seconds:.2f}x",
+            f"{ref_seconds / seconds:.2f}x",
+            f"{ref_rss:.0f} MB",
+            f"{rss:.0f} MB",
+            f"{load_seconds:.1f} s",
+            f"{wer:.1%}",
+        ])
+
+    print(f"{len(files)} recordings")
+    print_table(
+        ["model", "fp32 speed", "int8 speed", "speed-up", "fp32 RSS", "int8 RSS", "int8 load", "WER delta"],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""Measure the cold-start cost of the app module.
+
+Usage:
+    python benchmarks/startup.py --runs 5
+
+Each measurement runs in a fresh interpreter. "app" is what every server
+start and script reload pays now that the transcription stack is imported
+lazily; "app + torch/whisper" is what it paid when app.py imported torch and
+whisper at the top, and what is now deferred to the first transcription.
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+
+from common import REPO_ROOT, print_table
+
+STATEMENTS = {
+    "app": "import app",
+    "app + torch/whisper": "import app, torch, whisper",
+    "torch/whisper alone": "import torch, whisper",
+}
+
+
+def time_import(statement):
+    code = (
+        "import time\n"
+        "start = time.perf_counter()\n"
+        f"{statement}\n"
+        "print(time.perf_counter() - start)\n"
+    )
+    # Importing app outside `streamlit run` only prints bare-mode warnings
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=REPO_ROOT, capture_output=True, text=True, check=True,
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = []
+    for label, statement in STATEMENTS.items():
+        times = [time_import(statement) for _ in range(args.runs)]
+        rows.append([label, f"{statistics.median(times):.2f} s", f"{min(times):.2f} s"])
+
+    print(f"median and best of {args.runs} runs")
+    print_table(["import", "median", "best"], rows)
+
+
+if __name__ == "__main__":
+    main()
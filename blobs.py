@@ -0,0 +1,225 @@
+"""Content-addressed store of session audio.
+
+Audio is stored once under the SHA-256 of its content, in ``blobs/ab/abcdef...``
+next to the sessions directory, and sessions reference it by that hash from
+their metadata (``Audio-Blob: ...``). Saving the same recording again, as on a
+retry or a re-upload, adds a reference instead of another copy. References are
+counted in a SQLite table and a blob is deleted with its last reference.
+
+Files are first streamed into a staging directory in fixed-size chunks while
+they are hashed, then renamed to their hash, so an upload is neither held in
+memory whole nor read twice.
+
+The name of a blob is its checksum, so integrity is checked by comparing it
+with the content, or cheaply with the size recorded when it was stored.
+
+Run as a script to maintain the store:
+
+    python blobs.py migrate   # move the audio of older sessions into the store
+    python blobs.py gc        # recount references, delete unreferenced blobs and old uploads
+    python blobs.py check     # compare every blob with its size, --full with its hash
+"""
+import argparse
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from transcript_cache import HASH_CHUNK_SIZE, hash_audio
+
+BLOBS_DIR_NAME = "blobs"
+STAGING_DIR_NAME = "staging"
+# Blobs stored or released this recently, and staged files this recent, are
+# left alone by garbage collection: their session may not be saved yet
+GC_GRACE_SECONDS = 3600
+
+
+def blob_path(root, blob_hash):
+    return Path(root) / blob_hash[:2] / blob_hash
+
+
+class BlobStore:
+    """Reference counted audio files named by the SHA-256 of their content."""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.staging_dir = self.root / STAGING_DIR_NAME
+        self.staging_dir.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self.root / "blobs.db", check_same_thread=False)
+        self._lock = threading.Lock()
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS blobs ("
+                "hash TEXT PRIMARY KEY, size INTEGER NOT NULL, refs INTEGER NOT NULL, updated REAL NOT NULL)"
+            )
+
+    def path(self, blob_hash):
+        return blob_path(self.root, blob_hash)
+
+    def stage(self, fileobj):
+        """
+        Copy a binary file object to the staging directory a chunk at a time,
+        hashing it on the way. Returns the staged path and the hash.
+        """
+        digest = hashlib.sha256()
+        fd, tmp_name = tempfile.mkstemp(dir=self.staging_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            for chunk in iter(lambda: fileobj.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+                f.write(chunk)
+        return Path(tmp_name), digest.hexdigest()
+
+    def add(self, audio_file):
+        """Store a copy of a file, if not stored yet, and add a reference to it. Returns its hash."""
+        with open(audio_file, "rb") as f:
+            return self.add_staged(*self.stage(f))
+
+    def add_staged(self, staged_path, blob_hash):
+        """
+        Move a file from ``stage()`` into the store, or drop it if its content is
+        stored already, and add a reference to it. The staged file may be gone
+        if the blob was stored from it before, e.g. when a session is saved again.
+
+        Raises ``FileNotFoundError`` when neither is there, as when that blob was
+        released since: the file has to be staged again.
+        """
+        target = self.path(blob_hash)
+        # Held while moving, so a release cannot delete the blob in between
+        with self._lock, self._conn:
+            if target.exists():
+                Path(staged_path).unlink(missing_ok=True)
+            elif Path(staged_path).exists():
+                target.parent.mkdir(exist_ok=True)
+                os.replace(staged_path, target)
+            else:
+                raise FileNotFoundError(f"Staged file {staged_path} was moved and blob {blob_hash} is no longer stored")
+
+            self._conn.execute(
+                "INSERT INTO blobs (hash, size, refs, updated) VALUES (?, ?, 1, ?) "
+                "ON CONFLICT (hash) DO UPDATE SET refs = refs + 1, updated = excluded.updated",
+                (blob_hash, target.stat().st_size, time.time()),
+            )
+        return blob_hash
+
+    def release(self, blob_hash):
+        """Remove a reference, deleting the blob when it was the last one."""
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE blobs SET refs = refs - 1, updated = ? WHERE hash = ?", (time.time(), blob_hash))
+            row = self._conn.execute("SELECT refs FROM blobs WHERE hash = ?", (blob_hash,)).fetchone()
+            if row and row[0] <= 0:
+                self._conn.execute("DELETE FROM blobs WHERE hash = ?", (blob_hash,))
+                self.path(blob_hash).unlink(missing_ok=True)
+
+    def refs(self, blob_hash):
+        with self._lock:
+            row = self._conn.execute("SELECT refs FROM blobs WHERE hash = ?", (blob_hash,)).fetchone()
+        return row[0] if row else 0
+
+    def recount(self, references):
+        """Set the reference counts from a ``{hash: count}`` of the hashes actually referenced."""
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE blobs SET refs = 0")
+            self._conn.executemany(
+                "UPDATE blobs SET refs = ? WHERE hash = ?", [(count, h) for h, count in references.items()]
+            )
+
+    def collect_garbage(self, grace_seconds=GC_GRACE_SECONDS):
+        """Delete unreferenced blobs and files unknown to the database. Returns the bytes freed."""
+        cutoff = time.time() - grace_seconds
+        freed = 0
+        with self._lock, self._conn:
+            rows = self._conn.execute("SELECT hash FROM blobs WHERE refs <= 0 AND updated < ?", (cutoff,)).fetchall()
+            for (blob_hash,) in rows:
+                path = self.path(blob_hash)
+                if path.exists():
+                    freed += path.stat().st_size
+                    path.unlink()
+                self._conn.execute("DELETE FROM blobs WHERE hash = ?", (blob_hash,))
+
+            # Left by a crash between writing a blob and recording it, or
+            # staged for a session that was never saved
+            known = {h for (h,) in self._conn.execute("SELECT hash FROM blobs")}
+            for path in [*self.root.glob("??/*"), *self.staging_dir.glob("*")]:
+                if path.name not in known and path.stat().st_mtime < cutoff:
+                    freed += path.stat().st_size
+                    path.unlink()
+        return freed
+
+    def check(self, full=False):
+        """Return the hashes of missing or damaged blobs, comparing sizes or, with ``full``, hashes."""
+        with self._lock:
+            rows = self._conn.execute("SELECT hash, size FROM blobs").fetchall()
+        damaged = []
+        for blob_hash, size in rows:
+            path = self.path(blob_hash)
+            if not path.exists() or path.stat().st_size != size or (full and hash_audio(path) != blob_hash):
+                damaged.append(blob_hash)
+        return damaged
+
+
+def migrate_session(store, session_dir):
+    """Move the audio file of a session saved before the store into it. Returns True if moved."""
+    from storage import read_metadata, update_metadata
+
+    metadata = read_metadata(session_dir)
+    audio_file = Path(session_dir) / (metadata["audio"] or "")
+    if metadata["audio_blob"] or not metadata["audio"] or not audio_file.is_file():
+        return False
+    blob_hash = store.add(audio_file)
+    update_metadata(session_dir, {"Audio-Blob": blob_hash})
+    audio_file.unlink()
+    return True
+
+
+def referenced_blobs(sessions_dir):
+    """Count the references to every blob from session metadata."""
+    from storage import read_metadata
+
+    references = {}
+    for session_dir in Path(sessions_dir).glob("*/*"):
+        if session_dir.is_dir():
+            blob_hash = read_metadata(session_dir)["audio_blob"]
+            if blob_hash:
+                references[blob_hash] = references.get(blob_hash, 0) + 1
+    return references
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["migrate", "gc", "check"])
+    parser.add_argument("--data-dir", default="data", type=Path)
+    parser.add_argument("--uploads-dir", default="uploads", type=Path, help="copies left by older versions of the uploader")
+    parser.add_argument("--full", action="store_true", help="check hashes instead of sizes")
+    args = parser.parse_args()
+
+    sessions_dir = args.data_dir / "sessions"
+    store = BlobStore(args.data_dir / BLOBS_DIR_NAME)
+
+    if args.command == "migrate":
+        moved = sum(migrate_session(store, d) for d in sorted(sessions_dir.glob("*/*")) if d.is_dir())
+        print(f"{moved} sessions moved into the blob store")
+
+    elif args.command == "gc":
+        store.recount(referenced_blobs(sessions_dir))
+        freed = store.collect_garbage()
+        # The uploader used to keep a copy of every file; the session has its own
+        cutoff = time.time() - GC_GRACE_SECONDS
+        uploads = [p for p in args.uploads_dir.glob("*") if p.is_file() and p.stat().st_mtime < cutoff]
+        for path in uploads:
+            freed += path.stat().st_size
+            path.unlink()
+        print(f"{len(uploads)} uploads deleted, {freed / 1024 / 1024:.1f} MB freed")
+
+    else:
+        damaged = store.check(full=args.full)
+        for blob_hash in damaged:
+            print(f"damaged or missing: {blob_hash}")
+        print(f"{len(damaged)} damaged blobs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""Decoded audio and log-mel features of sessions, cached on disk.
+
+``model.transcribe`` runs ffmpeg to decode and resample its input and then
+computes the log-mel spectrogram of it on every call, so transcribing a
+session again with another model pays for the same work each time. Instead, a
+session's audio is decoded once to 16 kHz mono int16 PCM in ``pcm.npy``
+(about 115 MB per hour), and its log-mel frames can be kept in ``mel80.npy``
+or ``mel128.npy`` as well. Both are plain NumPy files opened memory-mapped, so
+readers only page in the frames they use.
+
+The files can be rebuilt from the audio at any time, so the least recently
+used ones are deleted once they take more than the space allowed.
+
+Run as a script to manage the cache of the sessions already in the archive:
+
+    python features.py build --workers 4 [--mel 80]   # decode sessions not cached yet
+    python features.py prune --max-gb 10              # delete the least recently used
+"""
+import argparse
+import io
+import os
+import subprocess
+from pathlib import Path
+
+import numpy as np
+
+import models
+from models import SAMPLE_RATE
+from storage import audio_file
+
+PCM_FILE = "pcm.npy"
+PCM_DTYPE = np.dtype("<i2")
+MEL_DTYPE = np.dtype("<f4")
+# Whisper's STFT: 25 ms windows every 10 ms
+N_FFT = 400
+HOP_LENGTH = 160
+# Frames of log-mel computed at a time, one minute
+MEL_BLOCK_FRAMES = 6000
+DECODE_BLOCK_BYTES = 1024 * 1024
+
+
+def mel_file_name(n_mels):
+    # large-v3 and turbo use 128 mel bands, the other models 80
+    return f"mel{n_mels}.npy"
+
+
+def _npy_header(dtype, shape):
+    buffer = io.BytesIO()
+    np.lib.format.write_array_header_1_0(
+        buffer, {"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": shape}
+    )
+    return buffer.getvalue()
+
+
+def decode_pcm(audio, pcm_file):
+    """
+    Decode an audio file with ffmpeg to 16 kHz mono int16 samples in a ``.npy`` file.
+
+    The samples are streamed to disk as they are decoded. The length is only
+    known at the end, so the header is written then over room left for it.
+    """
+    pcm_file = Path(pcm_file)
+    tmp_file = pcm_file.with_suffix(".tmp")
+    # Headers are padded to 64 bytes, so any realistic length fits the same room
+    header_size = len(_npy_header(PCM_DTYPE, (0,)))
+    process = subprocess.Popen(
+        ["ffmpeg", "-nostdin", "-v", "error", "-threads", "0", "-i", str(audio),
+         "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(SAMPLE_RATE), "-"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    )
+    n_bytes = 0
+    try:
+        with open(tmp_file, "wb") as f, process.stdout:
+            f.write(b"\0" * header_size)
+            while block := process.stdout.read(DECODE_BLOCK_BYTES):
+                f.write(block)
+                n_bytes += len(block)
+            header = _npy_header(PCM_DTYPE, (n_bytes // PCM_DTYPE.itemsize,))
+            if len(header) != header_size:
+                raise ValueError(f"Audio too long to cache: {n_bytes} bytes")
+            f.truncate(header_size + n_bytes // PCM_DTYPE.itemsize * PCM_DTYPE.itemsize)
+            f.seek(0)
+            f.write(header)
+        stderr = process.stderr.read()
+        if process.wait() != 0:
+            raise RuntimeError(f"Failed to decode audio: {stderr.decode(errors='replace')}")
+    except BaseException:
+        process.kill()
+        tmp_file.unlink(missing_ok=True)
+        raise
+    finally:
+        process.stderr.close()
+    tmp_file.replace(pcm_file)
+    return pcm_file
+
+
+def _load(path):
+    try:
+        array = np.load(path, mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    # Marks the file as recently used for pruning
+    os.utime(path)
+    return array
+
+
+def load_pcm(session_dir):
+    """Cached samples of a session as a read-only int16 memory map, or None if not cached."""
+    return _load(Path(session_dir) / PCM_FILE)
+
+
+def to_float(pcm):
+    """int16 samples as the float32 between -1 and 1 that Whisper takes."""
+    return np.asarray(pcm, np.float32) / 32768.0
+
+
+def session_pcm(session_dir, max_bytes=None):
+    """
+    Path of a session's cached samples, decoding its audio first if needed.
+    With ``max_bytes``, older caches are pruned after a new one is written.
+
+    Raises ``FileNotFoundError`` if the session has no audio.
+    """
+    session_dir = Path(session_dir)
+    pcm_file = session_dir / PCM_FILE
+    if load_pcm(session_dir) is not None:
+        return pcm_file
+    audio = audio_file(session_dir)
+    if not audio or not audio.exists():
+        raise FileNotFoundError(f"No audio in {session_dir}")
+    decode_pcm(audio, pcm_file)
+    if max_bytes is not None:
+        prune(session_dir.parent.parent, max_bytes, keep=pcm_file)
+    return pcm_file
+
+
+def _mel_filters(n_mels):
+    models.import_torch()
+    from whisper.audio import mel_filters
+
+    return mel_filters("cpu", n_mels).numpy()
+
+
+def _reflected(samples, start, end):
+    # Samples start:end of the signal mirrored at both ends, like torch.stft(center=True)
+    index = np.abs(np.arange(start, end))
+    last = len(samples) - 1
+    index = np.where(index > last, 2 * last - index, index)
+    return to_float(samples[index])
+
+
+def compute_mel(pcm, mel_file, n_mels=80):
+    """
+    Write the log-mel spectrogram of int16 samples to a ``.npy`` file as
+    ``(frames, n_mels)`` float32, the same values as
+    ``whisper.log_mel_spectrogram`` transposed so a window is contiguous.
+
+    It is computed a minute at a time. Whisper clips and scales by the loudest
+    value of the whole recording, so that is applied in a second pass.
+    """
+    mel_file = Path(mel_file)
+    tmp_file = mel_file.with_suffix(".tmp")
+    filters = _mel_filters(n_mels)
+    window = (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(N_FFT) / N_FFT)).astype(np.float32)
+    # Whisper drops the last STFT frame
+    n_frames = len(pcm) // HOP_LENGTH if len(pcm) > N_FFT // 2 else 0
+
+    mel = np.lib.format.open_memmap(tmp_file, mode="w+", dtype=MEL_DTYPE, shape=(n_frames, n_mels))
+    try:
+        peak = -np.inf
+        for first in range(0, n_frames, MEL_BLOCK_FRAMES):
+            last = min(first + MEL_BLOCK_FRAMES, n_frames)
+            # Frame t covers samples 160t - 200 to 160t + 200
+            block = _reflected(pcm, first * HOP_LENGTH - N_FFT // 2, (last - 1) * HOP_LENGTH + N_FFT // 2)
+            frames = np.lib.stride_tricks.sliding_window_view(block, N_FFT)[::HOP_LENGTH]
+            magnitudes = np.abs(np.fft.rfft(frames * window, axis=1)) ** 2
+            log_spec = np.log10(np.maximum(magnitudes @ filters.T, 1e-10))
+            mel[first:last] = log_spec
+            peak = max(peak, float(log_spec.max()))
+
+        for first in range(0, n_frames, MEL_BLOCK_FRAMES):
+            block = mel[first:first + MEL_BLOCK_FRAMES]
+            mel[first:first + MEL_BLOCK_FRAMES] = (np.maximum(block, peak - 8.0) + 4.0) / 4.0
+        mel.flush()
+    except BaseException:
+        del mel
+        tmp_file.unlink(missing_ok=True)
+        raise
+    del mel
+    tmp_file.replace(mel_file)
+    return mel_file
+
+
+def load_mel(session_dir, n_mels=80):
+    """Cached log-mel frames of a session as a read-only ``(frames, n_mels)`` memory map, or None."""
+    return _load(Path(session_dir) / mel_file_name(n_mels))
+
+
+def session_mel(session_dir, n_mels=80, max_bytes=None):
+    """Path of a session's cached log-mel frames, computing them, and the samples, first if needed."""
+    session_dir = Path(session_dir)
+    mel_file = session_dir / mel_file_name(n_mels)
+    if load_mel(session_dir, n_mels) is not None:
+        return mel_file
+    compute_mel(np.load(session_pcm(session_dir, max_bytes), mmap_mode="r"), mel_file, n_mels)
+    if max_bytes is not None:
+        prune(session_dir.parent.parent, max_bytes, keep=mel_file)
+    return mel_file
+
+
+def cached_files(sessions_dir):
+    """Feature files of every session, least recently used first."""
+    files = [p for p in Path(sessions_dir).glob("*/*/*.npy") if p.name == PCM_FILE or p.name.startswith("mel")]
+    return sorted(files, key=lambda p: p.stat().st_mtime)
+
+
+def prune(sessions_dir, max_bytes, keep=None):
+    """Delete the least recently used feature files beyond ``max_bytes``. Returns the bytes freed."""
+    keep = Path(keep).resolve() if keep else None
+    files = [(p, p.stat().st_size) for p in cached_files(sessions_dir)]
+    total = sum(size for _, size in files)
+    freed = 0
+    for path, size in files:
+        if total <= max_bytes:
+            break
+        if path.resolve() == keep:
+            continue
+        path.unlink(missing_ok=True)
+        total -= size
+        freed += size
+    return freed
+
+
+def main():
+    from audio import run_parallel
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["build", "prune"])
+    parser.add_argument("--data-dir", default="data", type=Path)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--mel", type=int, choices=[80, 128], help="also compute log-mel frames with this many bands")
+    parser.add_argument("--max-gb", type=float, default=10.0)
+    args = parser.parse_args()
+
+    sessions_dir = args.data_dir / "sessions"
+    max_bytes = int(args.max_gb * 1024 ** 3)
+
+    if args.command == "build":
+        session_dirs = [d for d in sorted(sessions_dir.glob("*/*")) if d.is_dir() and audio_file(d)]
+        build = (lambda d: session_mel(d, args.mel)) if args.mel else session_pcm
+        built, failed = run_parallel(build, session_dirs, args.workers)
+        freed = prune(sessions_dir, max_bytes)
+        print(f"{len(built)} sessions cached, {failed} failed, {freed / 1024 ** 2:.1f} MB pruned")
+    else:
+        freed = prune(sessions_dir, max_bytes)
+        print(f"{freed / 1024 ** 2:.1f} MB pruned")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""CPU slots for running Whisper in the server process.
+
+torch runs every model call on an intra-op thread pool as large as the
+machine, so three transcriptions at once on 16 cores run 48 threads fighting
+over 16 cores. Instead, model calls are run by ``InferenceSlots``: a fixed
+number of slot threads, each with ``torch.set_num_threads`` set to its share
+of the cores, so the threads of all slots together match the core count.
+Callers wait for a free slot.
+
+Models are acquired from the ``ModelManager`` before waiting for a slot and
+held until the call is done; a batched transcription holds its model for the
+whole job. A call on a slot then never waits for room in the memory budget
+and always finishes, so callers waiting for a slot while holding a model and
+callers waiting for that model's memory cannot deadlock.
+
+Optionally each slot is pinned to its own cores with ``sched_setaffinity``,
+which on Linux applies to the calling thread and is inherited by the torch
+threads it starts, so slots do not migrate onto each other's caches.
+"""
+import os
+import threading
+from concurrent.futures import Future
+from queue import Queue
+
+import models
+
+# Beyond this, more threads on one call help less than another call in parallel
+DEFAULT_THREADS_PER_SLOT = 4
+
+
+def available_cpus():
+    """CPUs this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def plan_slots(cpus, slots=None, threads=None):
+    """
+    Number of slots and threads per slot for ``cpus`` cores, filling in what is
+    not given so that slots times threads covers the cores.
+    """
+    if slots and not threads:
+        threads = max(1, cpus // slots)
+    elif threads and not slots:
+        slots = max(1, cpus // threads)
+    elif not slots:
+        threads = min(cpus, DEFAULT_THREADS_PER_SLOT)
+        slots = max(1, cpus // threads)
+    return slots, threads
+
+
+class InferenceSlots:
+    """Runs model calls on ``slots`` threads of ``threads`` torch threads each, optionally pinned to their cores."""
+
+    def __init__(self, slots, threads, pin=False):
+        self.slots = slots
+        self.threads = threads
+        self.pin = pin
+        cpus = available_cpus()
+        self.cpu_sets = [
+            # Slots share the cores round-robin when there are more threads than cores
+            {cpus[(i * threads + j) % len(cpus)] for j in range(threads)}
+            for i in range(slots)
+        ]
+        self._tasks = Queue()
+        for i in range(slots):
+            threading.Thread(target=self._work, args=(i,), name=f"inference-{i}", daemon=True).start()
+
+    def submit(self, function, *args, **kwargs):
+        """Queue a call for the next free slot, returning a ``Future`` of its result."""
+        future = Future()
+        self._tasks.put((future, function, args, kwargs))
+        return future
+
+    def run(self, function, *args, **kwargs):
+        """Call ``function`` on a slot and return its result, waiting for a free slot first."""
+        return self.submit(function, *args, **kwargs).result()
+
+    def run_model(self, manager, model_name, function, *args, **kwargs):
+        """Call ``function(model, *args, **kwargs)`` on a slot, with the model acquired from ``manager`` before waiting for one."""
+        with manager.acquire(model_name) as model:
+            return self.run(function, model, *args, **kwargs)
+
+    def _configure(self, slot):
+        # Both settings apply to this thread and the threads it starts
+        if self.pin and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, self.cpu_sets[slot])
+        models.import_torch().set_num_threads(self.threads)
+
+    def _work(self, slot):
+        configured = False
+        while True:
+            future, function, args, kwargs = self._tasks.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                if not configured:
+                    # torch is imported by the first model call, not when the server starts
+                    self._configure(slot)
+                    configured = True
+                result = function(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
@@ -0,0 +1,128 @@
+"""Background transcription jobs.
+
+Transcriptions run on worker threads instead of the Streamlit script thread, so
+a long session no longer blocks the page and survives reruns. The state of each
+job is persisted in ``job.txt`` inside the session directory, next to the audio
+written by ``save_session()``, so queued work is picked up again after a server
+restart.
+"""
+import datetime
+import logging
+import queue
+import threading
+from pathlib import Path
+
+from atomic import write_atomic
+from segments import write_segments
+from storage import audio_file
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+JOB_FILE = "job.txt"
+AUDIO_FILE = "audio.mp3"
+TRANSCRIPT_FILE = "transcript.txt"
+
+logger = logging.getLogger(__name__)
+
+
+def read_job(session_dir):
+    """Return the job stored in a session directory as a dict, or None."""
+    job_file = Path(session_dir) / JOB_FILE
+    if not job_file.exists():
+        return None
+
+    job = {}
+    with open(job_file, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            key, sep, value = line.rstrip("\n").partition(": ")
+            if sep:
+                job[key.lower()] = value
+    return job
+
+
+def write_job(session_dir, **fields):
+    """Persist job fields, replacing the file atomically."""
+    job_file = Path(session_dir) / JOB_FILE
+    fields["updated"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # Keep every field on a single line
+    write_atomic(job_file, "".join(f"{key.capitalize()}: {str(value).replace(chr(10), ' ')}\n" for key, value in fields.items()))
+
+
+class TranscriptionQueue:
+    """Persistent queue of transcription jobs processed by worker threads.
+
+    ``transcribe`` is called as ``transcribe(audio_path, model_name, chunked,
+    session_dir)``, the session directory letting it cache the decoded audio,
+    and must return a result dict like Whisper's, with the text and its
+    segments, or raise on failure. ``on_done`` is called as
+    ``on_done(session_dir, text)`` after the transcript and segments are written.
+    """
+
+    def __init__(self, sessions_dir, transcribe, workers=1, on_done=None):
+        self.sessions_dir = Path(sessions_dir)
+        self.transcribe = transcribe
+        self.on_done = on_done
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+
+        self._recover()
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f"transcription-{i}", daemon=True).start()
+
+    def submit(self, session_dir, model_name, chunked=False):
+        """Queue the audio of a session directory for transcription."""
+        session_dir = Path(session_dir)
+        with self._lock:
+            write_job(session_dir, status=QUEUED, model=model_name, chunked=chunked)
+        self._queue.put((session_dir, model_name, chunked))
+
+    def status(self, session_dir):
+        """Return the persisted job of a session directory, or None."""
+        with self._lock:
+            return read_job(session_dir)
+
+    def _recover(self):
+        # Jobs left queued or running by a previous process are started again
+        for job_file in sorted(self.sessions_dir.glob(f"*/*/{JOB_FILE}")):
+            job = read_job(job_file.parent)
+            if job and job.get("status") in (QUEUED, RUNNING):
+                self.submit(job_file.parent, job.get("model", "base"), job.get("chunked") == "True")
+
+    def _work(self):
+        while True:
+            session_dir, model_name, chunked = self._queue.get()
+            try:
+                self._run(session_dir, model_name, chunked)
+            except Exception:
+                # Not even the failure could be written, e.g. with the disk full;
+                # the job is picked up again on restart, the worker goes on
+                logger.exception("Transcription job of %s could not be recorded", session_dir)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, session_dir, model_name, chunked):
+        with self._lock:
+            write_job(session_dir, status=RUNNING, model=model_name, chunked=chunked)
+
+        # Writing the results can fail too (disk full, index error), which
+        # fails the job like a failed transcription
+        try:
+            # The audio may be in the blob store or have been transcoded since
+            audio = audio_file(session_dir) or session_dir / AUDIO_FILE
+            result = self.transcribe(str(audio), model_name, chunked, session_dir)
+            text = result["text"]
+            with open(session_dir / TRANSCRIPT_FILE, "w", encoding="utf-8") as f:
+                f.write(text)
+            write_segments(session_dir, result["segments"])
+            if self.on_done:
+                self.on_done(session_dir, text)
+        except Exception as e:
+            with self._lock:
+                write_job(session_dir, status=FAILED, model=model_name, chunked=chunked, error=e)
+            return
+
+        with self._lock:
+            write_job(session_dir, status=DONE, model=model_name, chunked=chunked)
@@ -0,0 +1,174 @@
+"""Live transcription of a recording in progress.
+
+The microphone stream arrives in small chunks of 16 kHz PCM. Every couple of
+seconds the audio not yet settled is transcribed again as one rolling window,
+so each word is heard with the context around it. A word is only committed
+once two consecutive passes agree on it (local agreement), which keeps the
+text from flickering as the window grows; what follows is shown as tentative.
+The window is then cut after the last committed word, so it overlaps the next
+pass only by the audio still unsettled and never grows past Whisper's 30 s.
+
+When recording stops, only the last few seconds remain to be transcribed.
+"""
+import re
+import threading
+import wave
+
+import numpy as np
+
+from models import SAMPLE_RATE
+
+# Seconds of new audio between passes
+STEP_SECONDS = 2.0
+# Past this the window is cut even where passes disagree
+MAX_WINDOW_SECONDS = 25.0
+# Audio kept uncommitted when the window is cut without agreement
+KEEP_SECONDS = 5.0
+# Characters of committed text given to Whisper as context
+PROMPT_CHARS = 200
+
+
+def whisper_words(model, audio, prompt="", **options):
+    """Transcribe audio with word timestamps, returning ``(start, end, word)`` tuples."""
+    result = model.transcribe(
+        audio, word_timestamps=True, initial_prompt=prompt or None,
+        condition_on_previous_text=False, temperature=0.0, fp16=False, **options,
+    )
+    return [(w["start"], w["end"], w["word"]) for s in result["segments"] for w in s.get("words", [])]
+
+
+def _normalize(word):
+    return re.sub(r"[^\w]", "", word.lower())
+
+
+class LiveTranscriber:
+    """
+    Incremental transcription of a growing recording.
+
+    ``transcribe`` is called as ``transcribe(audio, prompt)`` on a background
+    thread with 16 kHz float32 samples and returns ``(start, end, word)``
+    tuples with times relative to the samples.
+    """
+
+    def __init__(self, transcribe, step_seconds=STEP_SECONDS, max_window_seconds=MAX_WINDOW_SECONDS):
+        self.transcribe = transcribe
+        self.step = int(step_seconds * SAMPLE_RATE)
+        self.max_window = int(max_window_seconds * SAMPLE_RATE)
+
+        self.committed = []
+        self._tentative = []
+        self._chunks = []
+        self._window = np.zeros(0, np.float32)
+        # Position of the window in the recording, in samples
+        self._offset = 0
+        self._pending = 0
+        # Set if a pass failed; the final pass is still tried on finish()
+        self.error = None
+
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="live-transcription", daemon=True)
+        self._thread.start()
+
+    def feed(self, samples):
+        """Add 16 kHz mono float32 samples at the end of the recording."""
+        with self._wake:
+            self._chunks.append(np.asarray(samples, np.float32))
+            self._pending += len(samples)
+            if self._pending >= self.step:
+                self._wake.notify()
+
+    def text(self):
+        """Committed and tentative text so far."""
+        with self._lock:
+            return "".join(w for _, _, w in self.committed).strip(), "".join(w for _, _, w in self._tentative).strip()
+
+    def finish(self):
+        """Transcribe what is left once recording stops and return the whole text."""
+        with self._wake:
+            self._stopped = True
+            self._wake.notify()
+        self._thread.join()
+        self._step(final=True)
+        return self.text()[0]
+
+    def _run(self):
+        while True:
+            with self._wake:
+                while not self._stopped and self._pending < self.step:
+                    self._wake.wait()
+                if self._stopped:
+                    return
+            try:
+                self._step()
+            except Exception as e:
+                # The recording itself goes on, the rest is transcribed at the end
+                self.error = e
+                return
+
+    def _step(self, final=False):
+        with self._lock:
+            if self._chunks:
+                self._window = np.concatenate([self._window, *self._chunks])
+                self._chunks = []
+            self._pending = 0
+            window, offset = self._window, self._offset
+            prompt = "".join(w for _, _, w in self.committed)[-PROMPT_CHARS:]
+        if len(window) == 0:
+            return
+
+        start = offset / SAMPLE_RATE
+        words = [(start + s, start + e, w) for s, e, w in self.transcribe(window, prompt)]
+
+        with self._lock:
+            if final:
+                agreed = words
+            else:
+                # Words on which this pass and the previous one agree are settled
+                n = 0
+                while (n < len(words) and n < len(self._tentative)
+                       and _normalize(words[n][2]) == _normalize(self._tentative[n][2])):
+                    n += 1
+                agreed = words[:n]
+            self.committed.extend(agreed)
+            self._tentative = words[len(agreed):]
+
+            # Cut the window after the last settled word, or keep only its end
+            # when passes keep disagreeing, so it stays within Whisper's 30 s
+            cut = int(agreed[-1][1] * SAMPLE_RATE) - offset if agreed else 0
+            if len(self._window) - cut > self.max_window:
+                cut = len(self._window) - int(KEEP_SECONDS * SAMPLE_RATE)
+                settled = [w for w in self._tentative if w[1] * SAMPLE_RATE <= offset + cut]
+                self.committed.extend(settled)
+                self._tentative = self._tentative[len(settled):]
+            if cut > 0:
+                self._window = self._window[cut:]
+                self._offset += cut
+                # Tentative words refer to the audio that was kept
+                self._tentative = [w for w in self._tentative if w[1] * SAMPLE_RATE > self._offset]
+
+
+class LiveSession:
+    """A recording written to a WAV file as it arrives and transcribed live."""
+
+    def __init__(self, wav_path, transcribe):
+        self.wav_path = wav_path
+        self._wav = wave.open(str(wav_path), "wb")
+        self._wav.setnchannels(1)
+        self._wav.setsampwidth(2)
+        self._wav.setframerate(SAMPLE_RATE)
+        self.transcriber = LiveTranscriber(transcribe)
+        self.seconds = 0.0
+
+    def feed(self, pcm):
+        """Add 16 kHz mono int16 samples."""
+        pcm = np.asarray(pcm, np.int16)
+        self._wav.writeframes(pcm.tobytes())
+        self.seconds += len(pcm) / SAMPLE_RATE
+        self.transcriber.feed(pcm.astype(np.float32) / 32768.0)
+
+    def finish(self):
+        """Close the recording and return the final transcript."""
+        self._wav.close()
+        return self.transcriber.finish()
@@ -0,0 +1,289 @@
+"""Loading of Whisper models, including int8 quantized variants for CPU.
+
+A model name ending in ``-int8`` (e.g. ``small-int8``) loads the checkpoint of
+the base model with its Linear layers dynamically quantized to int8. The
+quantized weights are written next to Whisper's downloaded checkpoints the
+first time, so later processes load them directly instead of quantizing again.
+
+``ModelManager`` keeps the loaded models of the server within a memory budget
+and ``Preloader`` loads and warms up the default models when the server starts.
+
+torch and whisper take seconds to import, so they are only imported when a
+model is first needed. Pages that never transcribe do not pay for them.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+
+import numpy as np
+
+QUANTIZED_SUFFIX = "-int8"
+# Whisper models take 16 kHz mono audio
+SAMPLE_RATE = 16000
+DOWNLOAD_ROOT = os.path.join(os.getenv("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "whisper")
+
+# Same list as whisper.available_models() in openai-whisper 20240930, kept
+# here so the model selectbox does not import whisper
+WHISPER_MODELS = [
+    "tiny.en", "tiny", "base.en", "base", "small.en", "small", "medium.en", "medium",
+    "large-v1", "large-v2", "large-v3", "large", "large-v3-turbo", "turbo",
+]
+
+# Approximate parameter counts, used to make room before a model is loaded
+MODEL_PARAMETERS = {
+    "tiny": 39e6,
+    "base": 74e6,
+    "small": 244e6,
+    "medium": 769e6,
+    "large": 1550e6,
+    "turbo": 809e6,
+}
+
+
+def available_models():
+    """Names of the Whisper checkpoints followed by their int8 variants."""
+    return WHISPER_MODELS + [name + QUANTIZED_SUFFIX for name in WHISPER_MODELS]
+
+
+def is_quantized(model_name: str):
+    return model_name.endswith(QUANTIZED_SUFFIX)
+
+
+def n_mels(model_name: str):
+    """Mel bands of a model's input: 128 for large-v3 and turbo, 80 for the others."""
+    base_name = model_name[:-len(QUANTIZED_SUFFIX)] if is_quantized(model_name) else model_name
+    return 128 if base_name in ("large-v3", "large", "large-v3-turbo", "turbo") else 80
+
+
+def import_torch():
+    """Import torch on first use."""
+    import torch
+
+    # Keep Streamlit's file watcher from inspecting torch.classes, which fails
+    torch.classes.__path__ = []
+    return torch
+
+
+def quantize(model):
+    """Return a copy of a Whisper model with int8 dynamically quantized Linear layers."""
+    torch = import_torch()
+    for module in model.modules():
+        # Whisper's Linear subclass only casts weights to the input dtype, which is
+        # a no-op in fp32. Quantization only swaps exact nn.Linear instances.
+        if isinstance(module, torch.nn.Linear):
+            module.__class__ = torch.nn.Linear
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def load_model(model_name: str, download_root=DOWNLOAD_ROOT):
+    """Load a Whisper model by name, quantizing it on CPU for ``-int8`` variants."""
+    torch = import_torch()
+    import whisper
+    from whisper.model import ModelDimensions, Whisper
+
+    if not is_quantized(model_name):
+        return whisper.load_model(model_name, download_root=download_root)
+
+    base_name = model_name[:-len(QUANTIZED_SUFFIX)]
+    quantized_path = os.path.join(download_root, f"{base_name}{QUANTIZED_SUFFIX}.pt")
+
+    if os.path.exists(quantized_path):
+        # Written by this function, it holds quantized tensors besides plain weights
+        checkpoint = torch.load(quantized_path, map_location="cpu", weights_only=False)
+        model = quantize(Whisper(ModelDimensions(**checkpoint["dims"])))
+        model.load_state_dict(checkpoint["model_state_dict"])
+    else:
+        model = quantize(whisper.load_model(base_name, device="cpu", download_root=download_root))
+        tmp_path = quantized_path + ".tmp"
+        torch.save({"dims": model.dims.__dict__, "model_state_dict": model.state_dict()}, tmp_path)
+        os.replace(tmp_path, quantized_path)
+
+    if base_name in whisper._ALIGNMENT_HEADS:
+        model.set_alignment_heads(whisper._ALIGNMENT_HEADS[base_name])
+    return model
+
+
+def model_bytes(model):
+    """Memory held by the weights and buffers of a loaded model."""
+    torch = import_torch()
+    total = 0
+    for value in model.state_dict().values():
+        # Quantized Linear layers store a (weight, bias) tuple
+        for tensor in value if isinstance(value, tuple) else (value,):
+            if isinstance(tensor, torch.Tensor):
+                total += tensor.numel() * tensor.element_size()
+    return total
+
+
+def estimate_bytes(model_name: str):
+    """Rough memory needed by a model before it is loaded."""
+    base_name = model_name[:-len(QUANTIZED_SUFFIX)] if is_quantized(model_name) else model_name
+    family = base_name.split(".")[0].split("-")[0]
+    parameters = MODEL_PARAMETERS.get(family, MODEL_PARAMETERS["large"])
+    # int8 Linear weights take a quarter of fp32, embeddings and convolutions stay fp32
+    return int(parameters * (1.5 if is_quantized(model_name) else 4))
+
+
+class ModelManager:
+    """
+    Loaded Whisper models shared by all sessions, bounded by a memory budget.
+
+    Models are kept in least recently used order and evicted when a new one
+    needs room. A model is reference counted while it is in use, so it is never
+    evicted in the middle of a transcription; loads that do not fit wait until
+    enough models are released. Only the models of the allow-list are served.
+
+    Memory used by models held elsewhere, like the copies in the worker
+    processes of chunked transcription, is taken from the budget with
+    ``reserve`` while they are loaded.
+    """
+
+    def __init__(self, budget_bytes, allowed=None, loader=load_model):
+        self.budget_bytes = budget_bytes
+        self.allowed = list(allowed) if allowed else available_models()
+        self.loader = loader
+
+        unknown = set(self.allowed) - set(available_models())
+        if unknown:
+            raise ValueError(f"Unknown Whisper models: {', '.join(sorted(unknown))}")
+
+        self._models = OrderedDict()
+        self._sizes = {}
+        self._refs = Counter()
+        self._loading = set()
+        self._reserved = 0
+        self._condition = threading.Condition()
+
+    def check_allowed(self, model_name: str):
+        if model_name not in self.allowed:
+            raise ValueError(f"Model {model_name} is not served by this deployment")
+
+    @contextmanager
+    def acquire(self, model_name: str):
+        """Context manager that yields a loaded model and keeps it resident while in use."""
+        model = self._get(model_name)
+        try:
+            yield model
+        finally:
+            with self._condition:
+                self._refs[model_name] -= 1
+                self._condition.notify_all()
+
+    @contextmanager
+    def reserve(self, nbytes):
+        """Context manager that holds ``nbytes`` of the budget, evicting idle models or waiting for room."""
+        if nbytes > self.budget_bytes:
+            raise MemoryError(f"{nbytes / 1024 ** 2:.0f} MB do not fit in the memory budget")
+        with self._condition:
+            while not self._make_room(nbytes):
+                self._condition.wait()
+            self._reserved += nbytes
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._reserved -= nbytes
+                self._condition.notify_all()
+
+    def loaded(self):
+        """Names and sizes in bytes of the resident models, least recently used first."""
+        with self._condition:
+            return [(name, self._sizes[name]) for name in self._models]
+
+    def _get(self, model_name):
+        self.check_allowed(model_name)
+        needed = estimate_bytes(model_name)
+        if needed > self.budget_bytes:
+            raise MemoryError(f"Model {model_name} does not fit in the memory budget")
+
+        with self._condition:
+            while True:
+                if model_name in self._models:
+                    self._models.move_to_end(model_name)
+                    self._refs[model_name] += 1
+                    return self._models[model_name]
+                if model_name not in self._loading and self._make_room(needed):
+                    break
+                self._condition.wait()
+            self._loading.add(model_name)
+            # Loads in progress count against the budget too
+            self._sizes[model_name] = needed
+
+        try:
+            model = self.loader(model_name)
+        except Exception:
+            with self._condition:
+                self._loading.discard(model_name)
+                del self._sizes[model_name]
+                self._condition.notify_all()
+            raise
+
+        with self._condition:
+            self._loading.discard(model_name)
+            self._sizes[model_name] = model_bytes(model)
+            self._models[model_name] = model
+            self._refs[model_name] += 1
+            self._condition.notify_all()
+        return model
+
+    def _make_room(self, needed):
+        # Evict idle models, least recently used first, until the new one fits.
+        # Nothing is evicted unless that makes room, so a load that has to wait
+        # for models in use does not empty the cache meanwhile
+        total = sum(self._sizes.values()) + self._reserved
+        idle = sum(self._sizes[name] for name in self._models if self._refs[name] == 0)
+        if total - idle + needed > self.budget_bytes:
+            return False
+        for name in list(self._models):
+            if total + needed <= self.budget_bytes:
+                break
+            if self._refs[name] == 0:
+                del self._models[name]
+                total -= self._sizes.pop(name)
+        return total + needed <= self.budget_bytes
+
+
+def warm_up(model):
+    """Transcribe a short synthetic clip so the first real session does not pay for it.
+
+    This builds the mel filters and lets torch pick its kernels for the encoder,
+    language detection and decoding passes.
+    """
+    rng = np.random.default_rng(0)
+    audio = (0.01 * rng.standard_normal(2 * SAMPLE_RATE)).astype(np.float32)
+    model.transcribe(audio, temperature=0.0, fp16=False)
+
+
+class Preloader:
+    """
+    Loads and warms up models through a ``ModelManager`` on a background thread,
+    given ``InferenceSlots`` running the warm-up on them like other model calls.
+    """
+
+    def __init__(self, manager, model_names, slots=None):
+        self.manager = manager
+        self.slots = slots
+        self.status = {name: "pending" for name in model_names}
+        self.seconds = {}
+        threading.Thread(target=self._run, name="model-preload", daemon=True).start()
+
+    def ready(self):
+        return all(status == "ready" for status in self.status.values())
+
+    def _run(self):
+        for name in self.status:
+            self.status[name] = "loading"
+            start = time.perf_counter()
+            try:
+                if self.slots:
+                    self.slots.run_model(self.manager, name, warm_up)
+                else:
+                    with self.manager.acquire(name) as model:
+                        warm_up(model)
+            except Exception as e:
+                self.status[name] = f"failed: {e}"
+            else:
+                self.status[name] = "ready"
+                self.seconds[name] = time.perf_counter() - start
@@ -0,0 +1,91 @@
+"""Decode profiles: the Whisper decoding settings applied to transcriptions.
+
+With its defaults, ``model.transcribe`` detects the language of every window
+and, when a window looks like a failed decode, decodes it again at each
+temperature from 0.0 to 1.0. A profile fixes the language, so detection is
+skipped, and chooses greedy or beam search, whether to fall back through
+temperatures at all, and an initial prompt with vocabulary the model should
+expect.
+
+The deployment sets a default profile and each patient may override any of
+its fields in ``decode_profile.txt`` in their sessions directory, as
+``Key: value`` lines like the session metadata. The resolved profile is part
+of the transcript cache key, so changing it transcribes again.
+"""
+from pathlib import Path
+
+from atomic import write_atomic
+from batching import TEMPERATURES
+
+PROFILE_FILE = "decode_profile.txt"
+
+# Field, file key and parser of the stored value
+FIELDS = {
+    "language": ("Language", str),
+    "beam_size": ("Beam-Size", int),
+    "fallback": ("Fallback", lambda value: value == "yes"),
+    "initial_prompt": ("Initial-Prompt", str),
+}
+
+
+
+def default_profile(language="es", beam_size=0, fallback=False, initial_prompt=""):
+    """
+    A profile as a dict. An empty language is detected by Whisper, a beam
+    size of 0 decodes greedily.
+    """
+    return {"language": language, "beam_size": beam_size, "fallback": fallback, "initial_prompt": initial_prompt}
+
+
+def read_profile(patient_dir):
+    """Fields a patient overrides, as a dict with only those fields."""
+    overrides = {}
+    try:
+        with open(Path(patient_dir) / PROFILE_FILE, "r", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return overrides
+
+    keys = {key: (field, parse) for field, (key, parse) in FIELDS.items()}
+    for line in lines:
+        key, sep, value = line.partition(": ")
+        if sep and key in keys:
+            field, parse = keys[key]
+            try:
+                overrides[field] = parse(value)
+            except ValueError:
+                continue
+    return overrides
+
+
+def write_profile(patient_dir, overrides):
+    """Store the fields a patient overrides, removing the file when there are none."""
+    profile_file = Path(patient_dir) / PROFILE_FILE
+    if not overrides:
+        profile_file.unlink(missing_ok=True)
+        return
+    Path(patient_dir).mkdir(parents=True, exist_ok=True)
+    lines = []
+    for field, value in overrides.items():
+        if isinstance(value, bool):
+            value = "yes" if value else "no"
+        # Keep every field on a single line
+        lines.append(f"{FIELDS[field][0]}: {str(value).replace(chr(10), ' ')}\n")
+    write_atomic(profile_file, "".join(lines))
+
+
+def resolve(default, patient_dir=None):
+    """The default profile with a patient's overrides applied."""
+    return {**default, **(read_profile(patient_dir) if patient_dir else {})}
+
+
+def transcribe_options(profile):
+    """Keyword arguments of ``model.transcribe`` for a profile."""
+    options = {"temperature": TEMPERATURES if profile["fallback"] else 0.0}
+    if profile["language"]:
+        options["language"] = profile["language"]
+    if profile["beam_size"] > 0:
+        options["beam_size"] = profile["beam_size"]
+    if profile["initial_prompt"]:
+        options["initial_prompt"] = profile["initial_prompt"]
+    return options
@@ -0,0 +1,196 @@
+"""Bulk re-transcription of the whole archive with another Whisper model.
+
+Every session with audio is transcribed again by a pool of worker processes,
+each holding its own copy of the model, and the result is written next to the
+current transcript as ``transcript.<model>.txt`` and ``segments.<model>.json``.
+The transcript shown by the app is left as it is.
+
+The pool is sized to the machine: as many workers as fit in the available
+memory, up to one per core, with the cores shared out between them as torch
+threads. The longest sessions are scheduled first, so the run does not end
+waiting on one long recording.
+
+Sessions are decoded with the default decode profile given by the options,
+with the overrides each patient has in the app applied on top.
+
+Progress is appended to a checkpoint file in the data directory as each
+session finishes, so an interrupted run picks up where it stopped when it is
+started again with the same model. Sessions that failed are tried again.
+
+    python retranscribe.py --model large-v3 [--workers 4] [--beam-size 5] [--word-timestamps]
+"""
+import argparse
+import datetime
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from pathlib import Path
+
+import models
+from atomic import write_atomic
+from features import load_pcm, to_float
+from models import SAMPLE_RATE
+from profiles import default_profile, resolve, transcribe_options
+from segments import write_segments
+from storage import audio_file
+from transcription import decode_audio, default_workers, worker_model, worker_pool
+from waveform import read_duration
+
+# Each worker needs room for activations and decoding besides the weights
+WORKER_MEMORY_FACTOR = 2
+
+
+def transcript_name(model_name):
+    return f"transcript.{model_name}.txt"
+
+
+def segments_name(model_name):
+    return f"segments.{model_name}.json"
+
+
+def session_key(session_dir):
+    return f"{session_dir.parent.name}/{session_dir.name}"
+
+
+def checkpoint_file(data_dir, model_name):
+    return Path(data_dir) / f"retranscribe-{model_name}.jsonl"
+
+
+def read_checkpoint(path):
+    """Sessions already done in earlier runs, as ``{session: entry}``."""
+    done = {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Last line of a run that was killed while writing it
+                    continue
+                if entry.get("status") == "done":
+                    done[entry["session"]] = entry
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def available_memory():
+    """Bytes of memory available to new processes, from /proc/meminfo when there is one."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def plan_workers(model_name, workers=None):
+    """Number of worker processes and torch threads for each."""
+    cores = default_workers()
+    if not workers:
+        fits = available_memory() // (models.estimate_bytes(model_name) * WORKER_MEMORY_FACTOR)
+        workers = max(1, min(cores, fits))
+    return workers, max(1, cores // workers)
+
+
+def transcribe_session(session_dir, model_name, profile, options):
+    """Transcribe a session in a worker and write the versioned files. Returns the seconds of audio."""
+    session_dir = Path(session_dir)
+    options = {**transcribe_options(resolve(profile, session_dir.parent)), **options}
+    # Samples cached by the app are read as they are, others decoded in memory
+    pcm = load_pcm(session_dir)
+    audio = to_float(pcm) if pcm is not None else decode_audio(str(audio_file(session_dir)))
+    result = worker_model().transcribe(audio, fp16=False, **options)
+    write_segments(session_dir, result["segments"], segments_name(model_name))
+    write_atomic(session_dir / transcript_name(model_name), result["text"])
+    return len(audio) / SAMPLE_RATE
+
+
+def pending_sessions(sessions_dir, done):
+    """Sessions with audio not done yet, longest first."""
+    session_dirs = []
+    for session_dir in Path(sessions_dir).glob("*/*"):
+        audio = audio_file(session_dir) if session_dir.is_dir() else None
+        if audio and audio.exists() and session_key(session_dir) not in done:
+            session_dirs.append(session_dir)
+    return sorted(session_dirs, key=lambda d: read_duration(d) or 0, reverse=True)
+
+
+def format_hours(seconds):
+    return f"{seconds / 3600:.2f} h"
+
+
+def format_elapsed(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", required=True, choices=models.available_models())
+    parser.add_argument("--data-dir", default="data", type=Path)
+    parser.add_argument("--workers", type=int, help="worker processes, as many as fit in memory by default")
+    parser.add_argument("--language", default="es", help="language of the default profile, empty to detect it")
+    parser.add_argument("--beam-size", type=int, default=0, help="beams of the default profile, 0 for greedy")
+    parser.add_argument("--fallback", action="store_true", help="decode failed windows again at higher temperatures")
+    parser.add_argument("--initial-prompt", default="")
+    parser.add_argument("--word-timestamps", action="store_true")
+    parser.add_argument("--limit", type=int, help="stop after this many sessions")
+    args = parser.parse_args()
+
+    profile = default_profile(args.language, args.beam_size, args.fallback, args.initial_prompt)
+    options = {"word_timestamps": True} if args.word_timestamps else {}
+
+    checkpoint = checkpoint_file(args.data_dir, args.model)
+    done = read_checkpoint(checkpoint)
+    session_dirs = pending_sessions(args.data_dir / "sessions", done)[:args.limit]
+    workers, threads = plan_workers(args.model, args.workers)
+    print(f"{len(done)} sessions done before, {len(session_dirs)} to transcribe "
+          f"with {args.model} on {workers} workers of {threads} threads")
+    if not session_dirs:
+        return
+
+    audio_seconds = 0.0
+    failed = 0
+    start = time.perf_counter()
+    executor = worker_pool(args.model, workers, threads)
+    try:
+        with open(checkpoint, "a", encoding="utf-8") as log:
+            futures = {executor.submit(transcribe_session, str(d), args.model, profile, options): d for d in session_dirs}
+            pending = set(futures)
+            while pending:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    key = session_key(futures[future])
+                    entry = {"session": key, "model": args.model}
+                    try:
+                        seconds = future.result()
+                    except Exception as e:
+                        failed += 1
+                        entry.update(status="failed", error=str(e))
+                        print(f"{key}: {e}")
+                    else:
+                        audio_seconds += seconds
+                        entry.update(status="done", audio_seconds=round(seconds, 2))
+                    log.write(json.dumps(entry) + "\n")
+                    log.flush()
+
+                count = len(session_dirs) - len(pending)
+                elapsed = time.perf_counter() - start
+                print(f"[{count}/{len(session_dirs)}] {format_hours(audio_seconds)} of audio in "
+                      f"{format_elapsed(elapsed)}, {audio_seconds / elapsed:.1f} audio hours per hour")
+    except KeyboardInterrupt:
+        print("Interrupted, run again to resume")
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+
+    elapsed = time.perf_counter() - start
+    print(f"{len(session_dirs) - failed} transcribed, {failed} failed: {format_hours(audio_seconds)} of audio "
+          f"in {format_elapsed(elapsed)}, {audio_seconds / elapsed:.1f} audio hours per wall-clock hour")
+
+
+if __name__ == "__main__":
+    main()
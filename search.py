@@ -0,0 +1,301 @@
+"""Search over sessions and patient names.
+
+Sessions are kept in a SQLite FTS5 inverted index. The unicode61 tokenizer
+lowercases and folds accents, so "sesion" finds "sesión" and the other way
+round, and results are ranked with BM25. The index is updated as sessions are
+saved and transcribed, and built from the archive on first use.
+
+Patient names are matched by prefix and with typos through an in-memory
+index, built once and updated as patients are added.
+"""
+import bisect
+import heapq
+import itertools
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import Counter, OrderedDict, defaultdict
+from pathlib import Path
+
+# Matches weigh more in the notes, written by the therapist, than in transcripts
+NOTES_WEIGHT = 2.0
+TRANSCRIPT_WEIGHT = 1.0
+
+# Words sharing the most trigrams with a query word that are checked for typos
+FUZZY_CANDIDATES = 50
+# Trigrams an edit can change: a swap of two letters touches four
+TRIGRAMS_PER_TYPO = 4
+# Name search results kept, least recently used dropped first
+CACHED_RESULTS = 4096
+
+
+def match_expression(query):
+    """Turn free text into an FTS5 query: every word must appear, the last one as a prefix."""
+    words = re.findall(r"\w+", query)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+class SessionIndex:
+    """Inverted index of the notes and transcript of every session."""
+
+    def __init__(self, db_path):
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "id INTEGER PRIMARY KEY, patient_id TEXT NOT NULL, session_id TEXT NOT NULL, date TEXT, "
+                "UNIQUE (patient_id, session_id))"
+            )
+            self._conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS sessions_fts USING fts5("
+                "notes, transcript, tokenize = 'unicode61 remove_diacritics 2')"
+            )
+
+    def is_empty(self):
+        with self._lock:
+            return self._conn.execute("SELECT NOT EXISTS (SELECT 1 FROM sessions)").fetchone()[0]
+
+    def update(self, patient_id, session_id, date, notes, transcript):
+        """Index a session, replacing what was indexed for it before."""
+        with self._lock, self._conn:
+            self._update(patient_id, session_id, date, notes, transcript)
+
+    def _update(self, patient_id, session_id, date, notes, transcript):
+        self._conn.execute(
+            "INSERT INTO sessions (patient_id, session_id, date) VALUES (?, ?, ?) "
+            "ON CONFLICT (patient_id, session_id) DO UPDATE SET date = excluded.date",
+            (patient_id, session_id, date),
+        )
+        rowid = self._conn.execute(
+            "SELECT id FROM sessions WHERE patient_id = ? AND session_id = ?", (patient_id, session_id)
+        ).fetchone()[0]
+        self._conn.execute("DELETE FROM sessions_fts WHERE rowid = ?", (rowid,))
+        self._conn.execute(
+            "INSERT INTO sessions_fts (rowid, notes, transcript) VALUES (?, ?, ?)", (rowid, notes, transcript)
+        )
+
+    def rebuild(self, sessions):
+        """Index many sessions at once from ``(patient_id, session_id, date, notes, transcript)`` tuples."""
+        with self._lock, self._conn:
+            for session in sessions:
+                self._update(*session)
+
+    def search(self, query, patient_id=None, limit=20):
+        """
+        Return the best matching sessions as dicts with patient_id, session_id,
+        date and a snippet whose matches are wrapped in ``**``.
+        """
+        expression = match_expression(query)
+        if expression is None:
+            return []
+
+        sql = (
+            "SELECT s.patient_id, s.session_id, s.date, snippet(sessions_fts, -1, '**', '**', '…', 16) "
+            "FROM sessions_fts JOIN sessions s ON s.id = sessions_fts.rowid "
+            "WHERE sessions_fts MATCH ?"
+        )
+        params = [expression]
+        if patient_id is not None:
+            sql += " AND s.patient_id = ?"
+            params.append(patient_id)
+        sql += f" ORDER BY bm25(sessions_fts, {NOTES_WEIGHT}, {TRANSCRIPT_WEIGHT}) LIMIT ?"
+        params.append(limit)
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [
+            {"patient_id": pid, "session_id": sid, "date": date, "snippet": snippet}
+            for pid, sid, date, snippet in rows
+        ]
+
+
+def normalize_name(name):
+    """Lowercase a name, fold its accents and collapse whitespace."""
+    name = unicodedata.normalize("NFKD", name.lower())
+    name = "".join(c for c in name if not unicodedata.combining(c))
+    return " ".join(name.split())
+
+
+def name_trigrams(name):
+    """Trigrams of every word, padded at the start so short prefixes have trigrams too."""
+    grams = set()
+    for word in name.split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def prefix_distance(query, word, max_distance=None):
+    """
+    Edit distance between a query and the start of a word, taking the closest
+    of the prefixes one letter shorter than, as long as or one letter longer
+    than the query. Swapping two adjacent letters counts as one edit.
+
+    Given ``max_distance``, stops as soon as the distance is known to exceed
+    it and returns ``max_distance + 1``.
+    """
+    word = word[:len(query) + 1]
+    if max_distance is None:
+        max_distance = len(query) + len(word)
+    # Cells further than max_distance from the diagonal are beyond it anyway
+    beyond = max_distance + 1
+    before, previous = None, [j if j < beyond else beyond for j in range(len(word) + 1)]
+    for i, cq in enumerate(query, 1):
+        row = [i if i < beyond else beyond] + [beyond] * len(word)
+        for j in range(max(1, i - max_distance), min(len(word), i + max_distance) + 1):
+            cw = word[j - 1]
+            cost = previous[j - 1] + (cq != cw)
+            if previous[j] + 1 < cost:
+                cost = previous[j] + 1
+            if row[j - 1] + 1 < cost:
+                cost = row[j - 1] + 1
+            if i > 1 and j > 1 and cq == word[j - 2] and query[i - 2] == cw and before[j - 2] + 1 < cost:
+                cost = before[j - 2] + 1
+            row[j] = cost if cost < beyond else beyond
+        # Later rows only grow from this one, or from the one before by a swap
+        if min(row) >= beyond and min(previous) >= max_distance:
+            return beyond
+        before, previous = previous, row
+    # The last row holds the distance from the query to every prefix of the word
+    return min(previous[min(max(len(query) - 1, 1), len(word)):])
+
+
+class NameIndex:
+    """
+    In-memory index for prefix and typo-tolerant patient name lookup.
+
+    Prefixes are found by binary search over the sorted words of all names.
+    Typos are handled per distinct word, which names share a lot of: the
+    words with enough trigrams in common with a query word to be within its
+    typos, and long enough, are checked with an edit distance, and the names
+    with those words looked up.
+    """
+
+    def __init__(self, patients=()):
+        self._names = {}
+        self._words = []
+        # Word -> ids of the names with it, as a set and as a list of
+        # (normalized name, id) sorted by name; trigram -> words with it
+        self._word_names = defaultdict(set)
+        self._word_entries = defaultdict(list)
+        self._postings = defaultdict(set)
+        # Results per query and limit, the same query comes back on every rerun
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+        for patient_id, name in patients:
+            self._words.extend(self._index(patient_id, name))
+        self._words.sort()
+
+    def _index(self, patient_id, name):
+        normalized = normalize_name(name)
+        self._names[patient_id] = (name, normalized)
+        for word in normalized.split():
+            if word not in self._word_names:
+                for gram in name_trigrams(word):
+                    self._postings[gram].add(word)
+            self._word_names[word].add(patient_id)
+            bisect.insort(self._word_entries[word], (normalized, patient_id))
+        # The full name is a word too, so "ana ma" matches "Ana María"
+        return [(word, patient_id) for word in set(normalized.split()) | {normalized}]
+
+    def add(self, patient_id, name):
+        with self._lock:
+            for entry in self._index(patient_id, name):
+                bisect.insort(self._words, entry)
+            self._results.clear()
+
+    def search(self, query, limit=10):
+        """
+        Return up to ``limit`` ``(id, name)`` candidates, best first: names with
+        a word starting with the query (exact words first), then names whose
+        words start within a few typos of it.
+        """
+        query = normalize_name(query)
+        if not query:
+            return []
+
+        key = (query, limit)
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+            else:
+                self._results[key] = self._search(query, limit)
+                if len(self._results) > CACHED_RESULTS:
+                    self._results.popitem(last=False)
+            return self._results[key]
+
+    def _close_words(self, query_word, max_typos):
+        """Words whose start is within ``max_typos`` of a query word, as ``{word: typos}``."""
+        grams = name_trigrams(query_word)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self._postings.get(gram, ()))
+        # Each typo changes a few trigrams of the start of the word, the others
+        # are still shared; the query's last trigram ends the word, not a prefix
+        needed = max(1, len(grams) - 1 - TRIGRAMS_PER_TYPO * max_typos)
+        close = {}
+        for word, count in shared.most_common(FUZZY_CANDIDATES):
+            if count < needed:
+                break
+            if len(word) >= len(query_word) - max_typos:
+                typos = prefix_distance(query_word, word, max_typos)
+                if typos <= max_typos:
+                    close[word] = typos
+        return close
+
+    def _search(self, query, limit):
+        found = {}
+        i = bisect.bisect_left(self._words, (query,))
+        while i < len(self._words) and len(found) < limit and self._words[i][0].startswith(query):
+            found.setdefault(self._words[i][1], None)
+            i += 1
+        if len(found) >= limit:
+            return [(pid, self._names[pid][0]) for pid in found]
+
+        patients = [(pid, self._names[pid][0]) for pid in found]
+        for _, pid in self._fuzzy(query):
+            if pid not in found:
+                found[pid] = None
+                patients.append((pid, self._names[pid][0]))
+                if len(patients) >= limit:
+                    break
+        return patients
+
+    def _fuzzy(self, query):
+        """
+        ``(normalized name, id)`` of the names close to the query, fewest typos
+        first and then by name. Names may come again with more typos.
+        """
+        # Each query word is compared with the start of the closest name word,
+        # so partially typed names and any word order match; their typos add
+        # up, and a short word does not take more than half its letters
+        max_typos = max(1, len(query) // 4)
+        close = [
+            self._close_words(query_word, min(max_typos, max(1, len(query_word) // 2)))
+            for query_word in query.split()
+        ]
+        for typos in range(max_typos + 1):
+            if len(close) == 1:
+                # The sorted names of the words are merged as they are read,
+                # short queries with a typo are close to a lot of names
+                yield from heapq.merge(*(self._word_entries[word] for word, t in close[0].items() if t == typos))
+                continue
+            # Names with a word close to every query word, for every way of
+            # splitting the typos between the query words
+            names = set()
+            for split in itertools.product(range(typos + 1), repeat=len(close)):
+                if sum(split) == typos:
+                    names |= set.intersection(*(
+                        set().union(*(self._word_names[word] for word, t in words.items() if t == word_typos))
+                        for word_typos, words in zip(split, close)
+                    ))
+            yield from sorted((self._names[pid][1], pid) for pid in names)
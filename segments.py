@@ -0,0 +1,87 @@
+"""Timestamped segments of session transcripts.
+
+Whisper returns the transcript as segments with start and end times, and
+optionally the times of every word. They are kept in ``segments.json`` next
+to ``transcript.txt`` as compact ``[start, end, text]`` rows with times
+rounded to centiseconds, so the transcript can be shown line by line and the
+player started at any line or search hit.
+"""
+import json
+import re
+from pathlib import Path
+
+from atomic import write_atomic
+from search import normalize_name
+
+SEGMENTS_FILE = "segments.json"
+VERSION = 1
+# A pause this long between live words starts a new segment
+SEGMENT_GAP_SECONDS = 1.0
+
+
+def _rows(items, text_key):
+    return [[round(item["start"], 2), round(item["end"], 2), item[text_key]] for item in items]
+
+
+def write_segments(session_dir, segments, file_name=SEGMENTS_FILE):
+    """Write Whisper segments, with their words if they have them, next to the transcript."""
+    data = {"version": VERSION, "segments": _rows(segments, "text")}
+    words = [word for segment in segments for word in segment.get("words") or []]
+    if words:
+        data["words"] = _rows(words, "word")
+
+    write_atomic(Path(session_dir) / file_name, json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+
+
+def read_segments(session_dir):
+    """Segments of a session as dicts with start, end and text, or None if it has none."""
+    try:
+        with open(Path(session_dir) / SEGMENTS_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get("version") != VERSION:
+        return None
+    return [{"start": start, "end": end, "text": text} for start, end, text in data["segments"]]
+
+
+def segments_from_words(words, max_gap=SEGMENT_GAP_SECONDS):
+    """
+    Group ``(start, end, word)`` tuples, as transcribed live, into segments
+    ending at sentence punctuation or pauses.
+    """
+    segments = []
+    current = []
+    for start, end, word in words:
+        if current and start - current[-1]["end"] > max_gap:
+            segments.append(current)
+            current = []
+        current.append({"start": start, "end": end, "word": word})
+        if word.rstrip().endswith((".", "?", "!")):
+            segments.append(current)
+            current = []
+    if current:
+        segments.append(current)
+    return [
+        {"start": s[0]["start"], "end": s[-1]["end"], "text": "".join(w["word"] for w in s), "words": s}
+        for s in segments
+    ]
+
+
+def find_offset(segments, query):
+    """
+    Start of the first segment containing the words of a search query, the
+    last one as a prefix, or else of the first one containing any of them.
+    """
+    words = re.findall(r"\w+", normalize_name(query))
+    if not words:
+        return None
+    texts = [(segment["start"], re.findall(r"\w+", normalize_name(segment["text"]))) for segment in segments]
+    for start, text_words in texts:
+        if all(w in text_words for w in words[:-1]) and any(t.startswith(words[-1]) for t in text_words):
+            return start
+    # The words of a query may fall in different segments
+    for start, text_words in texts:
+        if any(t.startswith(w) for w in words for t in text_words):
+            return start
+    return None
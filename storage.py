@@ -0,0 +1,239 @@
+"""Persistent storage of patients and session history.
+
+Patients live in a SQLite database indexed by id and name, so lookups do not
+scan a text file on every rerun. The pipe-delimited ``patients.txt`` used
+before is imported once when the database is first opened; it is not written
+to afterwards.
+
+Each patient's sessions directory holds a ``manifest.jsonl`` summarizing its
+sessions (date, notes preview, audio and its duration, transcript length), so
+the history is listed without opening every session directory. Entries are
+appended as sessions are saved or transcribed; the last entry of a session wins.
+"""
+import json
+import sqlite3
+import threading
+from pathlib import Path
+
+from pydub.utils import mediainfo
+
+from atomic import write_atomic
+from blobs import BLOBS_DIR_NAME, blob_path
+from waveform import read_duration
+
+SCHEMA_VERSION = 1
+
+MANIFEST_FILE = "manifest.jsonl"
+NOTES_PREVIEW_CHARS = 120
+
+_manifest_lock = threading.Lock()
+
+
+class PatientStore:
+    """Patients stored in SQLite, returned as ``(id, name)`` tuples of strings."""
+
+    def __init__(self, db_path, legacy_file=None):
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        # Shared by the script threads of every session
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+
+        with self._lock, self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS patients (id INTEGER PRIMARY KEY, name TEXT NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS patients_name ON patients (name)")
+            version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+            if version < SCHEMA_VERSION:
+                if legacy_file and Path(legacy_file).exists():
+                    self._migrate(legacy_file)
+                self._conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def _migrate(self, legacy_file):
+        rows = []
+        with open(legacy_file, "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                if line.strip():
+                    pid, name = line.strip().split("|", 1)
+                    rows.append((int(pid), name))
+        self._conn.executemany("INSERT OR IGNORE INTO patients (id, name) VALUES (?, ?)", rows)
+
+    def add(self, name):
+        """Add a patient with the next available ID and return that ID."""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO patients (id, name) SELECT COALESCE(MAX(id), 0) + 1, ? FROM patients", (name,)
+            )
+            return str(cursor.lastrowid)
+
+    def next_id(self):
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM patients").fetchone()[0]
+
+    def get_by_name(self, name):
+        """Return the first patient with exactly this name, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, name FROM patients WHERE name = ? ORDER BY id LIMIT 1", (name,)
+            ).fetchone()
+        return (str(row[0]), row[1]) if row else None
+
+    def all(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT id, name FROM patients ORDER BY id").fetchall()
+        return [(str(pid), name) for pid, name in rows]
+
+
+def _read_metadata_lines(session_dir):
+    lines = []
+    # Older sessions were saved with the platform's default encoding
+    for encoding in ("utf-8", "latin-1"):
+        try:
+            with open(Path(session_dir) / "metadata.txt", "r", encoding=encoding) as f:
+                lines = f.readlines()
+            break
+        except UnicodeDecodeError:
+            continue
+        except OSError:
+            break
+    return lines
+
+
+def read_metadata(session_dir):
+    """Parse a session's metadata.txt into a dict with date, notes, audio and its format."""
+    lines = _read_metadata_lines(session_dir)
+    if not lines:
+        return {"date": "No Date", "notes": "No Notes", "audio": None, "audio_format": None, "audio_blob": None}
+    try:
+        metadata = {
+            "date": lines[0].replace("Date: ", "").strip(),
+            "notes": lines[1].replace("Notes: ", "").strip(),
+            "audio": None,
+            "audio_format": None,
+            "audio_blob": None,
+        }
+    except IndexError:
+        return {"date": "Error", "notes": "Error", "audio": "Error", "audio_format": None, "audio_blob": None}
+    if len(lines) > 2 and lines[2].startswith("Audio: "):
+        metadata["audio"] = lines[2].replace("Audio: ", "").strip()
+    for line in lines[3:]:
+        if line.startswith("Audio-Format: "):
+            metadata["audio_format"] = line.replace("Audio-Format: ", "").strip()
+        elif line.startswith("Audio-Blob: "):
+            metadata["audio_blob"] = line.replace("Audio-Blob: ", "").strip()
+    return metadata
+
+
+def audio_file(session_dir, metadata=None):
+    """
+    Path of a session's audio, or None if it has none: its blob in the store
+    next to the sessions directory, or a file of the session directory for
+    sessions saved before the store.
+    """
+    session_dir = Path(session_dir)
+    metadata = metadata or read_metadata(session_dir)
+    if metadata.get("audio_blob"):
+        # data/sessions/<patient>/<session> -> data/blobs
+        return blob_path(session_dir.parents[2] / BLOBS_DIR_NAME, metadata["audio_blob"])
+    if metadata["audio"]:
+        return session_dir / metadata["audio"]
+    return None
+
+
+def update_metadata(session_dir, fields):
+    """Set ``Key: value`` lines after the date and notes of metadata.txt, replacing the file atomically."""
+    lines = [line.rstrip("\n") + "\n" for line in _read_metadata_lines(session_dir)]
+    head, tail = lines[:2], lines[2:]
+    for key, value in fields.items():
+        line = f"{key}: {value}\n"
+        for i, existing in enumerate(tail):
+            if existing.startswith(f"{key}: "):
+                tail[i] = line
+                break
+        else:
+            tail.append(line)
+
+    write_atomic(Path(session_dir) / "metadata.txt", "".join(head + tail))
+
+
+def read_transcript(session_dir):
+    try:
+        with open(Path(session_dir) / "transcript.txt", "r", errors="replace") as f:
+            return f.read()
+    except OSError:
+        return "Error reading transcript"
+
+
+def audio_duration(audio_file):
+    """Duration in seconds read from the container by ffprobe, without decoding."""
+    try:
+        return float(mediainfo(str(audio_file))["duration"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def session_entry(session_dir, metadata=None, transcript=None):
+    """Build the manifest entry of a session, reading only what is not given."""
+    session_dir = Path(session_dir)
+    metadata = metadata or read_metadata(session_dir)
+    if transcript is None:
+        transcript = read_transcript(session_dir)
+
+    # Sessions saved with their waveform peaks have the duration there
+    duration = read_duration(session_dir)
+    audio = audio_file(session_dir, metadata)
+    if duration is None and audio and audio.exists():
+        duration = audio_duration(audio)
+    return {
+        "session_id": session_dir.name,
+        "date": metadata["date"],
+        "notes": metadata["notes"][:NOTES_PREVIEW_CHARS],
+        "audio": metadata["audio"],
+        "duration": duration,
+        "transcript_chars": len(transcript),
+    }
+
+
+def update_manifest(patient_dir, entry):
+    """Add or replace the entry of one session in a patient's manifest."""
+    manifest_file = Path(patient_dir) / MANIFEST_FILE
+    with _manifest_lock:
+        if not manifest_file.exists():
+            _rebuild_manifest(patient_dir)
+        with open(manifest_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+def load_manifest(patient_dir):
+    """Return the latest entry of every session of a patient, newest first."""
+    patient_dir = Path(patient_dir)
+    if not patient_dir.exists():
+        return []
+
+    manifest_file = patient_dir / MANIFEST_FILE
+    with _manifest_lock:
+        if not manifest_file.exists():
+            _rebuild_manifest(patient_dir)
+
+        entries = {}
+        n_lines = 0
+        with open(manifest_file, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    entries[entry["session_id"]] = entry
+                    n_lines += 1
+
+        # Drop superseded entries once they outnumber the live ones
+        if n_lines > 2 * len(entries):
+            _write_manifest(patient_dir, entries.values())
+
+    return sorted(entries.values(), key=lambda x: x["date"], reverse=True)
+
+
+def _rebuild_manifest(patient_dir):
+    # One-off scan for patients whose sessions predate the manifest
+    entries = [session_entry(d) for d in sorted(Path(patient_dir).iterdir()) if d.is_dir()]
+    _write_manifest(patient_dir, entries)
+
+
+def _write_manifest(patient_dir, entries):
+    write_atomic(Path(patient_dir) / MANIFEST_FILE, "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries))
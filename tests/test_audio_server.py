@@ -0,0 +1,23 @@
+from audio_server import parse_range
+
+
+def test_parse_range():
+    assert parse_range("bytes=0-99", 1000) == (0, 99)
+    # The end is clamped to the file
+    assert parse_range("bytes=900-2000", 1000) == (900, 999)
+
+
+def test_parse_open_ended_and_suffix_ranges():
+    assert parse_range("bytes=500-", 1000) == (500, 999)
+    # The last 200 bytes, or the whole file when it is shorter
+    assert parse_range("bytes=-200", 1000) == (800, 999)
+    assert parse_range("bytes=-2000", 1000) == (0, 999)
+
+
+def test_unsatisfiable_ranges():
+    assert parse_range("bytes=1000-", 1000) is None
+    assert parse_range("bytes=500-100", 1000) is None
+    assert parse_range("bytes=-0", 1000) is None
+    assert parse_range("bytes=-", 1000) is None
+    assert parse_range("bytes=0-1,5-9", 1000) is None
+    assert parse_range("items=0-9", 1000) is None
@@ -0,0 +1,200 @@
+import threading
+import types
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import numpy as np
+
+import models
+from batching import FRAMES_PER_SECOND, HOP_LENGTH, BatchScheduler, timestamp_segments, transcribe_batched
+from models import SAMPLE_RATE
+from transcription import split_on_silence
+
+TIMESTAMP_BEGIN = 1000
+EOT = 999
+
+
+def stamp(seconds):
+    return TIMESTAMP_BEGIN + round(seconds / 0.02)
+
+
+def test_timestamp_segments_split_at_timestamps():
+    tokens = [stamp(0), 5, 6, stamp(1), stamp(1), 7, stamp(2.5), EOT, 8]
+    assert timestamp_segments(tokens, TIMESTAMP_BEGIN, EOT) == [(0.0, 1.0, [5, 6]), (1.0, 2.5, [7])]
+
+
+def test_timestamp_segments_without_timestamps_around_text():
+    # Text before the first timestamp starts the window, text after the last one runs to its end
+    assert timestamp_segments([5, stamp(1), 6, EOT], TIMESTAMP_BEGIN, EOT) == [(0.0, 1.0, [5]), (1.0, None, [6])]
+    assert timestamp_segments([EOT], TIMESTAMP_BEGIN, EOT) == []
+
+
+class FakeManager:
+    def __init__(self):
+        self.acquired = []
+
+    @contextmanager
+    def acquire(self, model_name):
+        self.acquired.append(model_name)
+        yield model_name
+
+
+def test_batches_take_one_window_of_each_job_in_turn():
+    batches = []
+
+    def decode(model, mels, options):
+        batches.append(list(mels))
+        return mels
+
+    scheduler = BatchScheduler(FakeManager(), max_batch=4, max_wait=0.05, decode=decode)
+    # Queued while the scheduler thread waits for the lock, so it sees them all at once
+    with scheduler._condition:
+        futures = [scheduler.submit("base", f"a{i}", {}, "a") for i in range(4)]
+        futures += [scheduler.submit("base", f"b{i}", {}, "b") for i in range(2)]
+
+    assert [f.result(timeout=5) for f in futures] == ["a0", "a1", "a2", "a3", "b0", "b1"]
+    assert batches == [["a0", "b0", "a1", "b1"], ["a2", "a3"]]
+    assert (scheduler.batches, scheduler.windows) == (2, 6)
+
+
+def test_batches_do_not_mix_models_or_options():
+    batches = []
+
+    def decode(model, mels, options):
+        batches.append((model, options, list(mels)))
+        return mels
+
+    scheduler = BatchScheduler(FakeManager(), max_batch=8, max_wait=0.05, decode=decode)
+    with scheduler._condition:
+        futures = [
+            scheduler.submit("base", "x", {"temperature": 0.0}, "a"),
+            scheduler.submit("base", "y", {"temperature": 0.2}, "a"),
+            scheduler.submit("small", "z", {"temperature": 0.0}, "b"),
+        ]
+    for future in futures:
+        future.result(timeout=5)
+
+    assert sorted(batches, key=lambda batch: (batch[0], batch[2])) == [
+        ("base", {"temperature": 0.0}, ["x"]),
+        ("base", {"temperature": 0.2}, ["y"]),
+        ("small", {"temperature": 0.0}, ["z"]),
+    ]
+
+
+def test_decode_errors_fail_every_window_of_the_batch():
+    def decode(model, mels, options):
+        raise RuntimeError("out of memory")
+
+    scheduler = BatchScheduler(FakeManager(), max_batch=2, max_wait=0.05, decode=decode)
+    with scheduler._condition:
+        futures = [scheduler.submit("base", i, {}, "a") for i in range(2)]
+    for future in futures:
+        assert isinstance(future.exception(timeout=5), RuntimeError)
+
+
+def speech_with_pauses(seconds, pauses):
+    """Noise at speech level with near silent ``(start, end)`` pauses, in seconds."""
+    rng = np.random.default_rng(0)
+    audio = (0.3 * rng.standard_normal(seconds * SAMPLE_RATE)).astype(np.float32)
+    for start, end in pauses:
+        audio[start * SAMPLE_RATE:end * SAMPLE_RATE] *= 0.001
+    return audio
+
+
+class FakeScheduler:
+    """Answers every window at once with the results of ``decode(options)``."""
+
+    max_batch = 2
+
+    def __init__(self, decode):
+        self.decode = decode
+        self.manager = FakeManager()
+        self.submitted = []
+
+    def submit(self, model_name, mel, options, job):
+        self.submitted.append(options)
+        future = Future()
+        future.set_result(self.decode(options))
+        return future
+
+
+def window_result(segments, temperature=0.0, compression_ratio=1.0, no_speech_prob=0.1):
+    return {
+        "language": "es",
+        "segments": segments,
+        "avg_logprob": -0.2,
+        "compression_ratio": compression_ratio,
+        "no_speech_prob": no_speech_prob,
+        "temperature": temperature,
+    }
+
+
+def test_segments_are_placed_at_the_offset_of_their_window():
+    audio = speech_with_pauses(60, [(9, 11), (21, 23), (35, 37), (47, 49)])
+    mel = np.zeros((len(audio) // HOP_LENGTH, 80), np.float32)
+    windows = [(start // HOP_LENGTH, end // HOP_LENGTH) for start, end in split_on_silence(audio, 20, 29)]
+    assert len(windows) > 1
+
+    # The end of the last segment is past the window and clamped to it
+    scheduler = FakeScheduler(lambda options: window_result([(0.0, 2.0, " hola", [1]), (2.0, None, " qué tal", [2])]))
+    result = transcribe_batched(scheduler, "base", audio, mel, language="es")
+
+    assert len(result["segments"]) == 2 * len(windows)
+    for (first, last), (hello, rest) in zip(windows, zip(result["segments"][::2], result["segments"][1::2])):
+        offset = first / FRAMES_PER_SECOND
+        assert hello["start"] == round(offset, 2) and hello["end"] == round(offset + 2.0, 2)
+        assert rest["start"] == round(offset + 2.0, 2) and rest["end"] == round(last / FRAMES_PER_SECOND, 2)
+    assert [s["id"] for s in result["segments"]] == list(range(len(result["segments"])))
+    assert result["text"] == " hola qué tal" * len(windows)
+    assert all(options == {"without_timestamps": False, "language": "es", "temperature": 0.0} for options in scheduler.submitted)
+
+
+def test_failed_windows_are_decoded_again_and_silence_is_dropped():
+    audio = speech_with_pauses(20, [(9, 11)])
+    mel = np.zeros((len(audio) // HOP_LENGTH, 80), np.float32)
+
+    def decode(options):
+        # Repetitive at temperature 0, fine at the next temperature
+        if options["temperature"] == 0.0:
+            return window_result([(0.0, 1.0, " sí sí sí", [1])], compression_ratio=3.0)
+        return window_result([(0.0, 1.0, " sí", [1])], temperature=options["temperature"])
+
+    result = transcribe_batched(FakeScheduler(decode), "base", audio, mel)
+    assert [s["temperature"] for s in result["segments"]] == [0.2]
+    assert result["language"] == "es"
+
+    silent = FakeScheduler(lambda options: window_result([(0.0, 1.0, " gracias", [1])], no_speech_prob=0.9) | {"avg_logprob": -2.0})
+    assert transcribe_batched(silent, "base", audio, mel, fallback=False)["segments"] == []
+
+
+def test_jobs_hold_their_model_between_batches(monkeypatch):
+    monkeypatch.setattr(models, "import_torch", lambda: types.SimpleNamespace())
+    monkeypatch.setattr(models, "model_bytes", lambda model: models.estimate_bytes(model))
+    loads = []
+
+    def load(name):
+        loads.append(name)
+        return name
+
+    # Room for one model, and batches of one window so the jobs alternate
+    manager = models.ModelManager(models.estimate_bytes("base"), ["tiny", "base"], loader=load)
+    scheduler = BatchScheduler(manager, max_batch=1, max_wait=0.01, decode=lambda model, mels, options: [
+        window_result([(0.0, 1.0, f" {model}", [1])]) for _ in mels
+    ])
+    audio = speech_with_pauses(60, [(9, 11), (21, 23), (35, 37), (47, 49)])
+    mel = np.zeros((len(audio) // HOP_LENGTH, 80), np.float32)
+
+    results = {}
+
+    def job(model_name):
+        results[model_name] = transcribe_batched(scheduler, model_name, audio, mel, language="es")
+
+    threads = [threading.Thread(target=job, args=(name,), daemon=True) for name in ("tiny", "base")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert sorted(loads) == ["base", "tiny"]
+    assert results["tiny"]["text"].split() == ["tiny"] * len(results["tiny"]["segments"])
+    assert results["base"]["text"].split() == ["base"] * len(results["base"]["segments"])
@@ -0,0 +1,73 @@
+import io
+
+import pytest
+
+from blobs import BlobStore, referenced_blobs
+from transcript_cache import hash_audio
+
+
+def test_same_content_is_stored_once(tmp_path):
+    store = BlobStore(tmp_path / "blobs")
+    first = store.add_staged(*store.stage(io.BytesIO(b"audio")))
+    second = store.add_staged(*store.stage(io.BytesIO(b"audio")))
+
+    assert first == second
+    assert store.refs(first) == 2
+    assert store.path(first).read_bytes() == b"audio"
+    assert hash_audio(store.path(first)) == first
+    # The second staged copy was dropped
+    assert list(store.staging_dir.iterdir()) == []
+
+
+def test_blob_is_deleted_with_its_last_reference(tmp_path):
+    store = BlobStore(tmp_path / "blobs")
+    blob_hash = store.add_staged(*store.stage(io.BytesIO(b"audio")))
+    store.add_staged(*store.stage(io.BytesIO(b"audio")))
+
+    store.release(blob_hash)
+    assert store.refs(blob_hash) == 1
+    assert store.path(blob_hash).exists()
+
+    store.release(blob_hash)
+    assert store.refs(blob_hash) == 0
+    assert not store.path(blob_hash).exists()
+
+
+def test_saving_a_staged_file_again_adds_a_reference(tmp_path):
+    store = BlobStore(tmp_path / "blobs")
+    staged_path, blob_hash = store.stage(io.BytesIO(b"audio"))
+    store.add_staged(staged_path, blob_hash)
+    store.add_staged(staged_path, blob_hash)
+
+    assert store.refs(blob_hash) == 2
+
+
+def test_garbage_collection_follows_the_sessions(tmp_path):
+    store = BlobStore(tmp_path / "blobs")
+    kept = store.add_staged(*store.stage(io.BytesIO(b"kept")))
+    dropped = store.add_staged(*store.stage(io.BytesIO(b"dropped")))
+
+    session_dir = tmp_path / "sessions" / "1" / "20240101_100000"
+    session_dir.mkdir(parents=True)
+    (session_dir / "metadata.txt").write_text(f"Date: 2024-01-01 10:00:00\nNotes: \nAudio: audio.wav\nAudio-Blob: {kept}\n")
+    store.recount(referenced_blobs(tmp_path / "sessions"))
+
+    assert store.collect_garbage(grace_seconds=-1) == len(b"dropped")
+    assert store.path(kept).exists() and not store.path(dropped).exists()
+    assert store.refs(kept) == 1
+    assert store.check() == []
+
+
+def test_staged_file_of_a_released_blob_cannot_be_saved_again(tmp_path):
+    store = BlobStore(tmp_path / "blobs")
+    staged_path, blob_hash = store.stage(io.BytesIO(b"audio"))
+    store.add_staged(staged_path, blob_hash)
+    store.release(blob_hash)
+
+    with pytest.raises(FileNotFoundError):
+        store.add_staged(staged_path, blob_hash)
+    assert store.refs(blob_hash) == 0
+
+    # Staged again, it is stored again
+    store.add_staged(*store.stage(io.BytesIO(b"audio")))
+    assert store.path(blob_hash).read_bytes() == b"audio"
@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+import features
+from features import HOP_LENGTH, compute_mel, to_float
+from models import SAMPLE_RATE
+
+
+@pytest.mark.parametrize("n_mels", [80, 128])
+def test_compute_mel_matches_whisper(tmp_path, monkeypatch, n_mels):
+    pytest.importorskip("torch")
+    whisper = pytest.importorskip("whisper")
+
+    # Blocks of 100 frames, so the 2.5 s below cross block boundaries, and a
+    # length that is not a whole number of frames, for the reflected end
+    monkeypatch.setattr(features, "MEL_BLOCK_FRAMES", 100)
+    rng = np.random.default_rng(0)
+    t = np.arange(int(2.5 * SAMPLE_RATE) + 77) / SAMPLE_RATE
+    signal = 0.3 * np.sin(2 * np.pi * 440 * t) + 0.05 * rng.standard_normal(len(t))
+    pcm = (signal * 32767).astype(np.int16)
+
+    mel = np.load(compute_mel(pcm, tmp_path / "mel.npy", n_mels))
+    expected = whisper.log_mel_spectrogram(to_float(pcm), n_mels).numpy().T
+
+    assert mel.shape == expected.shape == (len(pcm) // HOP_LENGTH, n_mels)
+    # The first and last frames reach past the ends of the audio
+    np.testing.assert_allclose(mel[:2], expected[:2], atol=1e-3)
+    np.testing.assert_allclose(mel[-2:], expected[-2:], atol=1e-3)
+    np.testing.assert_allclose(mel[98:102], expected[98:102], atol=1e-3)
+    np.testing.assert_allclose(mel, expected, atol=1e-3)
@@ -0,0 +1,89 @@
+import threading
+import time
+import types
+
+import numpy as np
+import pytest
+
+import models
+from batching import BatchScheduler, transcribe_batched
+from inference import InferenceSlots, plan_slots
+from models import SAMPLE_RATE
+
+
+@pytest.fixture(autouse=True)
+def fake_torch(monkeypatch):
+    torch = types.SimpleNamespace(set_num_threads=lambda threads: None)
+    monkeypatch.setattr(models, "import_torch", lambda: torch)
+    monkeypatch.setattr(models, "model_bytes", lambda model: models.estimate_bytes(model))
+
+
+def test_plan_slots_covers_the_cores():
+    assert plan_slots(16) == (4, 4)
+    assert plan_slots(16, slots=3) == (3, 5)
+    assert plan_slots(16, threads=8) == (2, 8)
+    assert plan_slots(2) == (1, 2)
+
+
+def test_calls_wait_for_memory_before_taking_a_slot():
+    # Room for one model and one slot. A batched job holds base while its
+    # windows wait for the slot; a call for tiny queued meanwhile has to wait
+    # for memory without holding the slot those windows need
+    manager = models.ModelManager(models.estimate_bytes("base"), ["tiny", "base"], loader=lambda name: name)
+    slots = InferenceSlots(1, 1)
+    decoded = []
+
+    def decode(model, mels, options):
+        assert threading.current_thread().name.startswith("inference-")
+        decoded.append(model)
+        return [{
+            "language": "es", "segments": [(0.0, 1.0, f" {model}", [1])], "avg_logprob": -0.2,
+            "compression_ratio": 1.0, "no_speech_prob": 0.1, "temperature": 0.0,
+        } for _ in mels]
+
+    # The batch waits long enough for the tiny call to be queued first
+    scheduler = BatchScheduler(manager, max_batch=8, max_wait=0.3, decode=decode, slots=slots)
+    release = threading.Event()
+    slots.submit(release.wait, 5)
+
+    audio = np.full(5 * SAMPLE_RATE, 0.3, np.float32)
+    mel = np.zeros((len(audio) // 160, 80), np.float32)
+    results = {}
+
+    def job():
+        results["base"] = transcribe_batched(scheduler, "base", audio, mel, language="es")
+
+    def live():
+        results["tiny"] = slots.run_model(manager, "tiny", lambda model: model)
+
+    first = threading.Thread(target=job, daemon=True)
+    first.start()
+    while not manager.loaded():
+        time.sleep(0.001)
+    second = threading.Thread(target=live, daemon=True)
+    second.start()
+    time.sleep(0.1)
+    release.set()
+
+    first.join(5)
+    second.join(5)
+    assert results["tiny"] == "tiny"
+    assert results["base"]["text"] == " base"
+    assert decoded == ["base"]
+
+
+def test_models_are_warmed_up_on_a_slot(monkeypatch):
+    monkeypatch.setattr(models, "model_bytes", lambda model: 1)
+    warmed_on = []
+
+    class Model:
+        def transcribe(self, audio, **options):
+            warmed_on.append(threading.current_thread().name)
+
+    manager = models.ModelManager(models.estimate_bytes("base"), ["base"], loader=lambda name: Model())
+    preloader = models.Preloader(manager, ["base"], InferenceSlots(1, 1))
+    deadline = time.monotonic() + 5
+    while not preloader.ready() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert preloader.ready()
+    assert warmed_on == ["inference-0"]
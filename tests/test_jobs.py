@@ -0,0 +1,63 @@
+import time
+
+import jobs
+from jobs import DONE, FAILED, TranscriptionQueue, read_job
+
+
+def session(tmp_path, name):
+    session_dir = tmp_path / "sessions" / "1" / name
+    session_dir.mkdir(parents=True)
+    return session_dir
+
+
+def wait_for(queue, session_dirs, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if all(queue.status(d)["status"] in (DONE, FAILED) for d in session_dirs):
+            return
+        time.sleep(0.01)
+    raise TimeoutError("jobs still pending")
+
+
+def transcribe(audio_path, model_name, chunked, session_dir):
+    if session_dir.name == "bad-result":
+        return {"text": "sin segmentos"}
+    return {"text": f"{model_name}: hola", "segments": [{"start": 0.0, "end": 1.0, "text": " hola"}]}
+
+
+def test_jobs_fail_when_their_results_cannot_be_written(tmp_path):
+    def on_done(session_dir, text):
+        if session_dir.name == "index-error":
+            raise RuntimeError("database is locked")
+
+    queue = TranscriptionQueue(tmp_path / "sessions", transcribe, workers=1, on_done=on_done)
+    names = ["index-error", "bad-result", "good"]
+    session_dirs = [session(tmp_path, name) for name in names]
+    for session_dir in session_dirs:
+        queue.submit(session_dir, "base")
+    wait_for(queue, session_dirs)
+
+    statuses = {name: read_job(tmp_path / "sessions" / "1" / name) for name in names}
+    assert statuses["index-error"]["status"] == FAILED
+    assert statuses["index-error"]["error"] == "database is locked"
+    assert statuses["bad-result"]["status"] == FAILED
+    assert statuses["good"]["status"] == DONE
+    assert (tmp_path / "sessions" / "1" / "good" / "transcript.txt").read_text(encoding="utf-8") == "base: hola"
+
+
+def test_worker_survives_a_job_whose_failure_cannot_be_recorded(tmp_path, monkeypatch):
+    write_job = jobs.write_job
+
+    def failing_write_job(session_dir, **fields):
+        if session_dir.name == "disk-full" and fields["status"] != "queued":
+            raise OSError("No space left on device")
+        write_job(session_dir, **fields)
+
+    monkeypatch.setattr(jobs, "write_job", failing_write_job)
+    queue = TranscriptionQueue(tmp_path / "sessions", transcribe, workers=1)
+    queue.submit(session(tmp_path, "disk-full"), "base")
+    next_dir = session(tmp_path, "next")
+    queue.submit(next_dir, "base")
+    wait_for(queue, [next_dir])
+
+    assert read_job(next_dir)["status"] == DONE
@@ -0,0 +1,93 @@
+import numpy as np
+
+from live import LiveTranscriber
+from models import SAMPLE_RATE
+
+# A word every half second
+WORDS = [(0.5 * i, 0.5 * i + 0.4, f" w{i}") for i in range(200)]
+
+
+class Speech:
+    """Fake ``transcribe`` hearing the words of ``WORDS`` that end within the window."""
+
+    def __init__(self, unsettled_last_word=False, agree=True):
+        self.unsettled_last_word = unsettled_last_word
+        self.agree = agree
+        self.fed = 0
+        self.windows = []
+
+    def __call__(self, audio, prompt):
+        start = (self.fed - len(audio)) / SAMPLE_RATE
+        self.windows.append((start, self.fed / SAMPLE_RATE, prompt))
+        words = [(s - start, e - start, w) for s, e, w in WORDS if s >= start and e <= self.fed / SAMPLE_RATE]
+        if not self.agree:
+            # Every pass hears something else
+            words = [(s, e, f"{w}-{len(self.windows)}") for s, e, w in words]
+        elif self.unsettled_last_word and words:
+            # The word at the end of the window is heard differently every time
+            s, e, w = words[-1]
+            words[-1] = (s, e, f"{w}?{len(self.windows)}")
+        return words
+
+
+def feed(transcriber, speech, seconds):
+    samples = np.zeros(int(seconds * SAMPLE_RATE), np.float32)
+    speech.fed += len(samples)
+    transcriber.feed(samples)
+
+
+def live(speech, **kwargs):
+    # Passes are run by the test, not by the background thread
+    return LiveTranscriber(speech, step_seconds=1000, **kwargs)
+
+
+def test_words_are_committed_once_two_passes_agree():
+    speech = Speech()
+    transcriber = live(speech)
+    feed(transcriber, speech, 2)
+    transcriber._step()
+    assert transcriber.text() == ("", "w0 w1 w2 w3")
+
+    feed(transcriber, speech, 2)
+    transcriber._step()
+    assert transcriber.text() == ("w0 w1 w2 w3", "w4 w5 w6 w7")
+    # The window is cut after the last committed word and the committed
+    # text is given to Whisper as context
+    feed(transcriber, speech, 2)
+    transcriber._step()
+    assert speech.windows[-1] == (1.9, 6.0, " w0 w1 w2 w3")
+    assert transcriber.committed[-1] == (3.5, 3.9, " w7")
+
+
+def test_a_word_heard_differently_stays_tentative():
+    speech = Speech(unsettled_last_word=True)
+    transcriber = live(speech)
+    feed(transcriber, speech, 2)
+    transcriber._step()
+    feed(transcriber, speech, 2)
+    transcriber._step()
+    # w3 ended the first window and was heard as "w3?1", the second pass disagrees
+    assert transcriber.text()[0] == "w0 w1 w2"
+    assert transcriber.text()[1].startswith("w3 ")
+
+    assert transcriber.finish() == "w0 w1 w2 w3 w4 w5 w6 w7?3"
+
+
+def test_the_window_is_cut_when_passes_keep_disagreeing():
+    speech = Speech(agree=False)
+    transcriber = live(speech, max_window_seconds=6)
+    for _ in range(4):
+        feed(transcriber, speech, 2)
+        transcriber._step()
+
+    # 8 s without agreement: only the last 5 s are kept, the words before are committed
+    assert len(transcriber._window) == 5 * SAMPLE_RATE
+    assert transcriber._offset == 3 * SAMPLE_RATE
+    assert [w for _, _, w in transcriber.committed] == [f" w{i}-4" for i in range(6)]
+    assert all(end <= 3.0 for _, end, _ in transcriber.committed)
+    assert all(start >= 3.0 for start, _, _ in transcriber._tentative)
+
+    feed(transcriber, speech, 1)
+    transcriber.finish()
+    assert speech.windows[-1][:2] == (3.0, 9.0)
+    assert len(transcriber.committed) == 18
@@ -0,0 +1,71 @@
+import threading
+import types
+
+import pytest
+
+import models
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    monkeypatch.setattr(models, "import_torch", lambda: types.SimpleNamespace())
+    monkeypatch.setattr(models, "model_bytes", lambda model: models.estimate_bytes(model))
+    return models.ModelManager(models.estimate_bytes("base"), ["tiny", "base"], loader=lambda name: name)
+
+
+def test_n_mels():
+    assert models.n_mels("base") == 80
+    assert models.n_mels("large-v3-int8") == 128
+
+
+def test_idle_models_are_evicted_for_a_new_one(manager):
+    with manager.acquire("tiny"):
+        pass
+    with manager.acquire("base") as model:
+        assert model == "base"
+    assert [name for name, _ in manager.loaded()] == ["base"]
+
+
+def test_reserved_memory_evicts_idle_models_and_holds_back_loads(manager):
+    with manager.acquire("base"):
+        pass
+
+    loaded = threading.Event()
+
+    def load():
+        with manager.acquire("tiny"):
+            loaded.set()
+
+    with manager.reserve(models.estimate_bytes("base")):
+        assert manager.loaded() == []
+        thread = threading.Thread(target=load, daemon=True)
+        thread.start()
+        assert not loaded.wait(0.1)
+    assert loaded.wait(5)
+
+    with pytest.raises(MemoryError):
+        with manager.reserve(manager.budget_bytes + 1):
+            pass
+
+
+def test_idle_models_are_kept_while_a_load_cannot_fit(monkeypatch):
+    monkeypatch.setattr(models, "import_torch", lambda: types.SimpleNamespace())
+    monkeypatch.setattr(models, "model_bytes", lambda model: models.estimate_bytes(model))
+    budget = models.estimate_bytes("small") + models.estimate_bytes("tiny")
+    manager = models.ModelManager(budget, ["tiny", "base", "small"], loader=lambda name: name)
+    with manager.acquire("tiny"):
+        pass
+
+    loaded = threading.Event()
+
+    def load():
+        with manager.acquire("base"):
+            loaded.set()
+
+    with manager.acquire("small"):
+        thread = threading.Thread(target=load, daemon=True)
+        thread.start()
+        # Evicting tiny would not make room for base while small is in use
+        assert not loaded.wait(0.1)
+        assert [name for name, _ in manager.loaded()] == ["tiny", "small"]
+    assert loaded.wait(5)
@@ -0,0 +1,69 @@
+import search
+from search import NameIndex, name_trigrams, normalize_name, prefix_distance
+
+PATIENTS = [
+    ("1", "Anabel Ruiz"),
+    ("2", "Ana María López"),
+    ("3", "Juan Pérez"),
+    ("4", "Juana Pereira"),
+]
+
+
+def ids(results):
+    return [patient_id for patient_id, _ in results]
+
+
+def test_normalize_name_folds_case_accents_and_spaces():
+    assert normalize_name("  Ana   MARÍA  López ") == "ana maria lopez"
+
+
+def test_name_trigrams_cover_short_prefixes():
+    assert {"  a", " an", "ana", "na "} <= name_trigrams("ana")
+
+
+def test_prefix_distance():
+    assert prefix_distance("mar", "maria") == 0
+    assert prefix_distance("mra", "maria") == 1
+    assert prefix_distance("lopes", "lopez") == 1
+    assert prefix_distance("xyz", "maria") == 3
+
+
+def test_prefix_matches_come_first_with_exact_words_first():
+    index = NameIndex(PATIENTS)
+    assert ids(index.search("ana")) == ["2", "1"]
+    assert ids(index.search("ANA MA"))[0] == "2"
+    assert ids(index.search("lópez")) == ["2"]
+    assert ids(index.search("juan")) == ["3", "4"]
+
+
+def test_typos_are_ranked_by_distance():
+    index = NameIndex(PATIENTS)
+    assert ids(index.search("lopes")) == ["2"]
+    # Swapped letters count as one typo
+    assert ids(index.search("jaun perez"))[0] == "3"
+    assert ids(index.search("juan pereria")) == ["4", "3"]
+    assert index.search("zzzz") == []
+    # A short word does not take the typos of the whole query
+    assert index.search("juan xyz") == []
+
+
+def test_limit_and_blank_queries():
+    index = NameIndex(PATIENTS)
+    assert len(index.search("j", limit=1)) == 1
+    assert len(index.search("j")) == 2
+    assert index.search("   ") == []
+
+
+def test_cached_results_are_bounded(monkeypatch):
+    monkeypatch.setattr(search, "CACHED_RESULTS", 2)
+    index = NameIndex(PATIENTS)
+    for query in ("a", "an", "ana", "an"):
+        index.search(query)
+    assert list(index._results) == [("ana", 10), ("an", 10)]
+
+
+def test_added_patients_are_found_by_cached_queries():
+    index = NameIndex(PATIENTS)
+    assert ids(index.search("xavi")) == []
+    index.add("5", "Xavier Gil")
+    assert ids(index.search("xavi")) == ["5"]
@@ -0,0 +1,130 @@
+import shutil
+import threading
+import types
+import wave
+from concurrent.futures import Future
+
+import numpy as np
+import pytest
+
+import models
+import transcription
+from inference import InferenceSlots
+from models import SAMPLE_RATE
+from transcription import decode_audio, split_on_silence, transcribe_chunked
+
+
+def speech_with_pauses():
+    rng = np.random.default_rng(0)
+    audio = (0.3 * rng.standard_normal(200 * SAMPLE_RATE)).astype(np.float32)
+    for start in (50, 110, 170):
+        audio[start * SAMPLE_RATE:(start + 2) * SAMPLE_RATE] *= 0.001
+    return audio
+
+
+def test_chunks_end_in_pauses_and_cover_the_audio():
+    audio = speech_with_pauses()
+    chunks = split_on_silence(audio, target_seconds=40, max_seconds=80)
+    assert chunks[0][0] == 0 and chunks[-1][1] == len(audio)
+    assert all(end == next_start for (_, end), (next_start, _) in zip(chunks, chunks[1:]))
+    assert [round(end / SAMPLE_RATE) for _, end in chunks[:-1]] == [51, 111, 171]
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+def test_decode_audio_reads_a_path(tmp_path):
+    samples = (np.sin(np.arange(SAMPLE_RATE) / 10) * 10000).astype(np.int16)
+    with wave.open(str(tmp_path / "audio.wav"), "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes(samples.tobytes())
+
+    audio = decode_audio(tmp_path / "audio.wav")
+    assert audio.dtype == np.float32
+    np.testing.assert_allclose(audio, samples / 32768.0, atol=1e-4)
+
+
+class FakePool:
+    def __init__(self, max_workers, **kwargs):
+        self.running = True
+        self.initargs = kwargs.get("initargs")
+
+    def shutdown(self):
+        self.running = False
+
+
+def test_each_model_has_its_own_pool_until_its_last_user(monkeypatch):
+    monkeypatch.setattr(transcription, "ProcessPoolExecutor", FakePool)
+    with transcription._use_pool("base", 2) as base:
+        with transcription._use_pool("small", 2) as small:
+            with transcription._use_pool("base", 2) as shared:
+                assert shared is base
+            assert small is not base
+        # The small job ending does not stop the base pool
+        assert base.running and not small.running
+    assert not base.running
+    assert transcription._pools == {}
+
+
+def test_concurrent_jobs_with_different_models(monkeypatch):
+    monkeypatch.setattr(transcription, "ProcessPoolExecutor", FakePool)
+    errors = []
+
+    def job(model_name):
+        try:
+            for _ in range(50):
+                with transcription._use_pool(model_name, 2) as pool:
+                    assert pool.running
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=job, args=(name,)) for name in ("tiny", "base", "small", "base")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert errors == []
+    assert transcription._pools == {}
+
+
+def test_the_workers_memory_is_reserved_once_per_pool(monkeypatch):
+    monkeypatch.setattr(transcription, "ProcessPoolExecutor", FakePool)
+    monkeypatch.setattr(models, "import_torch", lambda: types.SimpleNamespace())
+    manager = models.ModelManager(4 * models.estimate_bytes("base"), ["base"], loader=lambda name: name)
+    with transcription._use_pool("base", 2, manager=manager):
+        with transcription._use_pool("base", 2, manager=manager):
+            assert manager._reserved == 2 * models.estimate_bytes("base")
+    assert manager._reserved == 0
+
+
+class InlinePool(FakePool):
+    pools = []
+
+    def __init__(self, max_workers, **kwargs):
+        super().__init__(max_workers, **kwargs)
+        self.pools.append(self)
+
+    def submit(self, function, *args):
+        future = Future()
+        future.set_result(function(*args))
+        return future
+
+
+def test_chunks_are_decoded_holding_an_inference_slot(monkeypatch):
+    monkeypatch.setattr(transcription, "ProcessPoolExecutor", InlinePool)
+    monkeypatch.setattr(models, "import_torch", lambda: types.SimpleNamespace(set_num_threads=lambda threads: None))
+    decoded_on = []
+
+    class Model:
+        def transcribe(self, audio, **options):
+            decoded_on.append(threading.current_thread().name)
+            return {"text": " hola", "segments": [{"start": 0.0, "end": 1.0, "text": " hola"}], "language": "es"}
+
+    monkeypatch.setattr(transcription, "_worker_model", Model())
+    audio = speech_with_pauses()
+    result = transcribe_chunked(audio, "base", slots=InferenceSlots(2, 3))
+
+    # The workers decode with the threads of a slot
+    assert InlinePool.pools[-1].initargs == ("base", 3)
+    assert len(decoded_on) == len(split_on_silence(audio)) == len(result["segments"])
+    assert all(name.startswith("inference-") for name in decoded_on)
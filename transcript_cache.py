@@ -0,0 +1,85 @@
+"""On-disk cache of transcription results.
+
+Entries are keyed by the SHA-256 of the audio content, the Whisper model and
+the decoding options, so re-uploading the same recording or switching back to a
+model that was already used returns the stored result instead of running
+Whisper again. The cache is bounded in size and evicts the least recently used
+entries first.
+"""
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+from atomic import write_atomic
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_audio(audio):
+    """Return the SHA-256 hex digest of an audio file path or a bytes-like buffer."""
+    digest = hashlib.sha256()
+    if isinstance(audio, (str, Path)):
+        with open(audio, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+    else:
+        digest.update(audio)
+    return digest.hexdigest()
+
+
+class TranscriptCache:
+    """Size-bounded LRU cache of transcription results stored as JSON files."""
+
+    def __init__(self, cache_dir, max_bytes=256 * 1024 * 1024):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _path(self, audio_hash, model_name, options):
+        # The audio hash comes first so every entry of a recording can be invalidated
+        settings = json.dumps({"model": model_name, "options": options or {}}, sort_keys=True)
+        settings_hash = hashlib.sha256(settings.encode("utf-8")).hexdigest()[:16]
+        return self.cache_dir / f"{audio_hash}-{settings_hash}.json"
+
+    def get(self, audio_hash, model_name: str, options=None):
+        """Return the cached result, or None on a miss."""
+        path = self._path(audio_hash, model_name, options)
+        with self._lock:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    result = json.load(f)
+            except (OSError, ValueError):
+                return None
+            # Mark the entry as recently used
+            os.utime(path)
+        return result
+
+    def put(self, audio_hash, model_name: str, options, result):
+        """Store a result and evict old entries beyond the size limit."""
+        path = self._path(audio_hash, model_name, options)
+        with self._lock:
+            write_atomic(path, json.dumps(result, ensure_ascii=False))
+            self._evict()
+
+    def invalidate(self, audio_hash=None):
+        """Drop every entry of a recording, or the whole cache when no hash is given."""
+        pattern = f"{audio_hash}-*.json" if audio_hash else "*.json"
+        with self._lock:
+            for path in self.cache_dir.glob(pattern):
+                path.unlink(missing_ok=True)
+
+    def _evict(self):
+        entries = []
+        for path in self.cache_dir.glob("*.json"):
+            stat = path.stat()
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
@@ -0,0 +1,267 @@
+"""Chunked transcription for long session recordings.
+
+Whisper decodes its 30-second windows one after another, so an hour-long
+session keeps a single core busy for a long time. Here the decoded audio is
+split at pauses (frame energy based voice activity detection) and the chunks
+are transcribed in parallel by a pool of worker processes, each with its own
+copy of the model. The text and segment timestamps are stitched back in order.
+There is a pool per model, shared by the transcriptions using that model at
+the time and shut down when none is, so those copies of the model do not stay
+in memory between long sessions. Given a ``ModelManager``, the memory of those
+copies is reserved from its budget once per pool, while the pool runs.
+
+Given the server's ``InferenceSlots`` (see ``inference.py``), the workers
+decode with the torch threads of a slot and every chunk holds a slot while
+a worker decodes it, so the worker processes do not add threads on top of
+the server's own model calls.
+
+Given the ``pcm.npy`` samples cached for a session (see ``features.py``), the
+workers are only sent the range of their chunk and read it from the memory
+map themselves, instead of receiving a pickled copy of the audio.
+"""
+import multiprocessing
+import os
+import subprocess
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
+
+import numpy as np
+
+import models
+from features import to_float
+from models import SAMPLE_RATE
+
+FRAME_SECONDS = 0.03
+# Frames of energy computed at a time, so int16 samples are converted a bit at a time
+ENERGY_BLOCK_FRAMES = 20000
+MIN_SILENCE_SECONDS = 0.5
+TARGET_CHUNK_SECONDS = 60
+MAX_CHUNK_SECONDS = 120
+
+# Model name -> pool of the transcriptions using it, so jobs with different
+# models at the same time each have their own
+_pools = {}
+_pools_lock = threading.Lock()
+
+# Model of the current worker process
+_worker_model = None
+
+
+def decode_audio(audio, sr: int = SAMPLE_RATE):
+    """
+    Decode an audio file to mono float32 PCM at ``sr`` Hz with ffmpeg.
+
+    Uploads and recordings are staged on disk before they are transcribed, so
+    ffmpeg reads the file itself, which also lets it seek in containers with
+    their index at the end (MP4), and its PCM output is streamed from its
+    stdout into NumPy without a temporary WAV file.
+
+    Args:
+        audio: Path of the audio file, as a string or path-like object
+    """
+    cmd = [
+        "ffmpeg", "-nostdin", "-threads", "0", "-i", os.fspath(audio),
+        "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(sr), "-",
+    ]
+    try:
+        out = subprocess.run(cmd, capture_output=True, check=True).stdout
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"Failed to decode audio: {e.stderr.decode(errors='replace')}") from e
+    return np.frombuffer(out, np.int16).astype(np.float32) / 32768.0
+
+
+def frame_energy(audio):
+    """Return the energy in dB of consecutive 30 ms frames of 16 kHz float32 or int16 audio."""
+    frame_length = int(SAMPLE_RATE * FRAME_SECONDS)
+    n_frames = len(audio) // frame_length
+    energy = np.empty(n_frames, np.float32)
+    for first in range(0, n_frames, ENERGY_BLOCK_FRAMES):
+        last = min(first + ENERGY_BLOCK_FRAMES, n_frames)
+        block = audio[first * frame_length:last * frame_length]
+        if block.dtype == np.int16:
+            block = to_float(block)
+        frames = block.reshape(last - first, frame_length)
+        energy[first:last] = 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-10)
+    return energy
+
+
+def find_silences(energy, min_silence=MIN_SILENCE_SECONDS):
+    """Return (start, end) frame ranges of pauses of at least ``min_silence`` seconds."""
+    if len(energy) == 0:
+        return []
+
+    # The threshold sits between the noise floor and the speech level, so it
+    # adapts to the recording gain and background noise
+    noise_floor = np.percentile(energy, 10)
+    speech_level = np.percentile(energy, 90)
+    silent = energy < noise_floor + 0.3 * (speech_level - noise_floor)
+
+    edges = np.diff(np.concatenate(([0], silent.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    min_frames = int(min_silence / FRAME_SECONDS)
+    return [(s, e) for s, e in zip(starts, ends) if e - s >= min_frames]
+
+
+def split_on_silence(audio, target_seconds=TARGET_CHUNK_SECONDS, max_seconds=MAX_CHUNK_SECONDS):
+    """Split audio into (start, end) sample ranges that end in the middle of a pause.
+
+    Chunks are at least ``target_seconds`` long when possible. Stretches without
+    any pause are cut at their quietest frame so no chunk exceeds ``max_seconds``.
+    """
+    frame_length = int(SAMPLE_RATE * FRAME_SECONDS)
+    target = int(target_seconds * SAMPLE_RATE)
+    maximum = int(max_seconds * SAMPLE_RATE)
+
+    energy = frame_energy(audio)
+    cuts = [int(s + e) // 2 * frame_length for s, e in find_silences(energy)]
+
+    bounds = [0]
+    for cut in cuts + [len(audio)]:
+        while cut - bounds[-1] > maximum:
+            lo = (bounds[-1] + target) // frame_length
+            hi = (bounds[-1] + maximum) // frame_length
+            bounds.append((lo + int(np.argmin(energy[lo:hi]))) * frame_length)
+        if cut - bounds[-1] >= target or cut == len(audio):
+            bounds.append(cut)
+
+    # Fold a very short tail into the previous chunk
+    if len(bounds) > 2 and bounds[-1] - bounds[-2] < SAMPLE_RATE:
+        del bounds[-2]
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def init_worker(model_name, threads):
+    """Initializer of worker processes: load the model, decoding with ``threads`` torch threads."""
+    global _worker_model
+    models.import_torch().set_num_threads(threads)
+    _worker_model = models.load_model(model_name)
+
+
+def worker_model():
+    """Model loaded by ``init_worker`` in the current worker process."""
+    return _worker_model
+
+
+def worker_pool(model_name, workers, threads=1):
+    """Process pool whose workers each load the model and decode with ``threads`` torch threads."""
+    # Forking a process that already runs torch threads can deadlock
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(model_name, threads),
+    )
+
+
+def _transcribe_chunk(args):
+    offset, audio, options = args
+    if isinstance(audio, tuple):
+        # (pcm_file, start, end) of the cached samples
+        pcm_file, start, end = audio
+        audio = to_float(np.load(pcm_file, mmap_mode="r")[start:end])
+    result = _worker_model.transcribe(audio, **options)
+    segments = []
+    for s in result["segments"]:
+        segment = {"start": offset + s["start"], "end": offset + s["end"], "text": s["text"]}
+        if "words" in s:
+            segment["words"] = [{**w, "start": offset + w["start"], "end": offset + w["end"]} for w in s["words"]]
+        segments.append(segment)
+    return {"text": result["text"], "segments": segments, "language": result["language"]}
+
+
+def default_workers():
+    """One single-threaded worker per available core."""
+    return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+
+
+class _SharedPool:
+    """Worker processes of one model, started by the first transcription using them."""
+
+    def __init__(self):
+        self.users = 0
+        self.executor = None
+        # Held while the pool starts, so its users wait for the same one
+        self.lock = threading.Lock()
+        self.resources = ExitStack()
+
+
+@contextmanager
+def _use_pool(model_name, workers, threads=1, manager=None):
+    with _pools_lock:
+        pool = _pools.setdefault(model_name, _SharedPool())
+        pool.users += 1
+    try:
+        # Waiting for room in the budget happens outside _pools_lock, so the
+        # pools of other models can still stop and release theirs
+        with pool.lock:
+            if pool.executor is None:
+                if manager is not None:
+                    pool.resources.enter_context(manager.reserve(workers * models.estimate_bytes(model_name)))
+                pool.executor = worker_pool(model_name, workers, threads)
+        yield pool.executor
+    finally:
+        with _pools_lock:
+            pool.users -= 1
+            idle = pool.users == 0
+            if idle:
+                del _pools[model_name]
+        if idle:
+            if pool.executor is not None:
+                pool.executor.shutdown()
+            pool.resources.close()
+
+
+def transcribe_chunked(audio, model_name: str, workers=None, manager=None, slots=None, **options):
+    """
+    Transcribe long audio by splitting it at pauses and decoding the chunks in parallel.
+
+    Args:
+        audio: Path to an audio file, path to a session's cached ``pcm.npy``
+            (as strings or path-like objects), or 16 kHz mono float32 samples
+        model_name: Name of the Whisper model to use
+        workers: Number of worker processes, each loading the model, one per
+            slot given ``slots`` and one per core otherwise by default
+        manager: ``ModelManager`` whose budget the workers' copies of the model
+            are reserved from while the pool runs
+        slots: ``InferenceSlots`` whose threads per slot the workers use, and
+            one of which every chunk holds while it is decoded
+        options: Decoding options passed to ``model.transcribe``
+
+    Returns a dict like ``model.transcribe`` with timestamps relative to the whole recording.
+    """
+    pcm_file = None
+    if isinstance(audio, (str, os.PathLike)) and os.fspath(audio).endswith(".npy"):
+        pcm_file = os.fspath(audio)
+        audio = np.load(pcm_file, mmap_mode="r")
+    elif isinstance(audio, (str, os.PathLike)):
+        audio = decode_audio(audio)
+
+    chunks = [
+        (start / SAMPLE_RATE, (pcm_file, start, end) if pcm_file else audio[start:end], options)
+        for start, end in split_on_silence(audio)
+    ]
+    if slots is None:
+        with _use_pool(model_name, workers or default_workers(), 1, manager) as pool:
+            results = list(pool.map(_transcribe_chunk, chunks))
+    else:
+        workers = min(workers or slots.slots, slots.slots)
+        with _use_pool(model_name, workers, slots.threads, manager) as pool:
+            # Chunks are queued for the slots as others finish, so other model
+            # calls of the server take turns with them
+            results = []
+            in_flight = deque()
+            for chunk in chunks:
+                if len(in_flight) == workers:
+                    results.append(in_flight.popleft().result())
+                in_flight.append(slots.submit(lambda chunk=chunk: pool.submit(_transcribe_chunk, chunk).result()))
+            results += [future.result() for future in in_flight]
+
+    return {
+        "text": " ".join(r["text"].strip() for r in results if r["text"].strip()),
+        "segments": [s for r in results for s in r["segments"]],
+        "language": results[0]["language"] if results else None,
+    }
+
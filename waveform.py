@@ -0,0 +1,129 @@
+"""Waveform peaks and duration of session recordings.
+
+The peaks of a recording are computed once when its session is saved and
+written next to it in ``peaks.bin``: a small header with the duration followed
+by the loudest sample of every tenth of a second as one byte, about 36 KB per
+hour. The history shows durations and waveform thumbnails from these files
+without opening or decoding the audio, which may be Opus by then. Sessions
+with cached samples (see ``features.py``) get their peaks from those instead
+of running ffmpeg.
+"""
+import struct
+import subprocess
+from pathlib import Path
+
+import numpy as np
+
+from atomic import write_atomic
+
+PEAKS_FILE = "peaks.bin"
+PEAKS_PER_SECOND = 10
+# Peaks only need the envelope, a low rate is decoded faster
+DECODE_RATE = 8000
+DECODE_BLOCK_SECONDS = 60
+
+# Magic, format version, peaks per second, duration in seconds
+HEADER = struct.Struct("<4sBHd")
+MAGIC = b"PEAK"
+VERSION = 1
+
+
+def compute_peaks(audio_file):
+    """
+    Decode an audio file with ffmpeg and return its duration in seconds and
+    its peaks as uint8, ``PEAKS_PER_SECOND`` per second.
+
+    The decoded samples are read a minute at a time, so memory stays flat
+    however long the recording is.
+    """
+    block_bytes = DECODE_BLOCK_SECONDS * DECODE_RATE * 2
+    process = subprocess.Popen(
+        ["ffmpeg", "-nostdin", "-v", "error", "-i", str(audio_file),
+         "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(DECODE_RATE), "-"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    )
+    with process.stdout:
+        blocks = iter(lambda: process.stdout.read(block_bytes), b"")
+        result = _peaks((np.frombuffer(b[:len(b) // 2 * 2], np.int16) for b in blocks), DECODE_RATE)
+    stderr = process.stderr.read()
+    process.stderr.close()
+    if process.wait() != 0:
+        raise RuntimeError(f"Failed to decode audio: {stderr.decode(errors='replace')}")
+    return result
+
+
+def pcm_peaks(pcm, rate):
+    """Duration and peaks, like ``compute_peaks``, of int16 samples such as a memory-mapped cache."""
+    block = DECODE_BLOCK_SECONDS * rate
+    return _peaks((pcm[start:start + block] for start in range(0, len(pcm), block)), rate)
+
+
+def _peaks(blocks, rate):
+    samples_per_peak = rate // PEAKS_PER_SECOND
+    peaks = []
+    n_samples = 0
+    for block in blocks:
+        samples = np.abs(np.asarray(block).astype(np.int32))
+        n_samples += len(samples)
+        # Pad the last block to whole peaks; blocks are whole peaks otherwise
+        samples = np.pad(samples, (0, -len(samples) % samples_per_peak))
+        peaks.append(samples.reshape(-1, samples_per_peak).max(axis=1))
+
+    peaks = np.concatenate(peaks) if peaks else np.zeros(0, np.int32)
+    return n_samples / rate, (np.minimum(peaks, 32767) * 255 // 32767).astype(np.uint8)
+
+
+def write_peaks(session_dir, duration, peaks):
+    write_atomic(Path(session_dir) / PEAKS_FILE, HEADER.pack(MAGIC, VERSION, PEAKS_PER_SECOND, duration) + peaks.tobytes())
+
+
+def read_duration(session_dir):
+    """Duration in seconds stored in a session's peaks file, or None."""
+    try:
+        with open(Path(session_dir) / PEAKS_FILE, "rb") as f:
+            magic, version, _, duration = HEADER.unpack(f.read(HEADER.size))
+    except (OSError, struct.error):
+        return None
+    return duration if magic == MAGIC and version == VERSION else None
+
+
+def read_peaks(session_dir):
+    """Duration and peaks of a session as ``(seconds, uint8 array)``, or None."""
+    try:
+        data = (Path(session_dir) / PEAKS_FILE).read_bytes()
+        magic, version, _, duration = HEADER.unpack_from(data)
+    except (OSError, struct.error):
+        return None
+    if magic != MAGIC or version != VERSION:
+        return None
+    return duration, np.frombuffer(data, np.uint8, offset=HEADER.size)
+
+
+def thumbnail(peaks, bars):
+    """Reduce peaks to at most ``bars`` values between 0 and 1, keeping the loudest of each group."""
+    if len(peaks) == 0:
+        return np.zeros(0)
+    starts = np.linspace(0, len(peaks), min(bars, len(peaks)), endpoint=False).astype(int)
+    return np.maximum.reduceat(peaks, starts) / 255
+
+
+def waveform_svg(peaks, bars=120, height=32, color="#4a6fa5", position=None):
+    """
+    Inline SVG of a waveform thumbnail, stretched to the width of its container.
+    ``position`` between 0 and 1 marks the playback position.
+    """
+    values = thumbnail(peaks, bars)
+    # Square root so quiet speech is still visible next to loud passages
+    heights = np.maximum(np.sqrt(values) * height, 1)
+    rects = "".join(
+        f'<rect x="{i + 0.1:.1f}" y="{(height - h) / 2:.1f}" width="0.8" height="{h:.1f}"/>'
+        for i, h in enumerate(heights)
+    )
+    marker = ""
+    if position is not None:
+        x = position * len(values)
+        marker = f'<rect x="{x:.2f}" y="0" width="0.4" height="{height}" fill="#d9534f"/>'
+    return (
+        f'<svg viewBox="0 0 {max(len(values), 1)} {height}" preserveAspectRatio="none" '
+        f'width="100%" height="{height}" fill="{color}">{rects}{marker}</svg>'
+    )